@@ -0,0 +1,135 @@
+"""
+Measure how long the sync events endpoint takes to answer while a sync is
+writing, the way the sync page polls it.
+
+    python benchmarks/events_latency.py [seconds per run]
+
+A simulated sync writes batches of parsed pages and events, as the
+BatchWriter does, on Datasette's write thread. Meanwhile the events for a
+job are read repeatedly, in three ways:
+
+    write thread, rollback journal: reads queued behind the writes, as
+        the endpoint used to
+    read pool, rollback journal: reads on Datasette's read connections,
+        which still wait on the writer's locks
+    read pool, WAL: the plugin's defaults
+
+and the latency of each read is reported.
+"""
+import asyncio
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from datasette.app import Datasette
+
+from datasette_ca460.events import load_job_events
+from datasette_ca460.migrations import ensure_schema
+
+# Rows per simulated BatchWriter flush, and pages in the simulated project
+WRITE_BATCH_SIZE = 500
+PAGES = 5000
+# How often the sync page polls, in seconds
+POLL_INTERVAL = 0.01
+
+
+def populate(conn):
+    conn.execute("INSERT INTO sync_jobs (id, project_id, status) VALUES ('job', 1, 'running')")
+    conn.execute("INSERT INTO documents (id, page_count, title) VALUES (1, ?, 'Filing')", (PAGES,))
+    conn.executemany(
+        "INSERT INTO pages (document_id, page_number) VALUES (1, ?)",
+        [(n,) for n in range(1, PAGES + 1)]
+    )
+    conn.executemany(
+        "INSERT INTO sync_events (sync_job_id, event_type, message) VALUES ('job', 'info', ?)",
+        [(f"Parsed page {n}",) for n in range(200)]
+    )
+
+
+async def simulate_sync(db, stop: asyncio.Event) -> int:
+    """Write batches of parses and events until stopped; returns batches written."""
+    parsed_data = json.dumps({"line_items": [{"full_name": "A", "amount_this_period": 5}] * 10})
+    batches = 0
+    while not stop.is_set():
+        model = f"model-{batches}"
+
+        def _write(conn):
+            conn.executemany(
+                """INSERT INTO page_parsed (page_id, page_type, model, parsed_data)
+                VALUES (?, 'schedule_a', ?, ?)""",
+                [(page_id, model, parsed_data) for page_id in range(1, WRITE_BATCH_SIZE + 1)]
+            )
+            conn.executemany(
+                "INSERT INTO sync_events (sync_job_id, event_type, message) VALUES ('job', 'info', ?)",
+                [(f"Parsed page {n}",) for n in range(20)]
+            )
+
+        await db.execute_write_fn(_write)
+        batches += 1
+        await asyncio.sleep(0)
+    return batches
+
+
+async def poll_events(db, read, stop: asyncio.Event) -> tuple[list[float], int]:
+    """Read the job's events until stopped; returns latencies in ms, and errors."""
+    latencies = []
+    errors = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            await read(db, lambda conn: load_job_events(conn, "job", 100))
+        except Exception:
+            errors += 1
+        else:
+            latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(POLL_INTERVAL)
+    return latencies, errors
+
+
+async def run(name: str, wal: bool, read, seconds: float) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        datasette = Datasette(
+            [str(Path(tmp) / "bench.db")],
+            config={"plugins": {"datasette-ca460": {"wal": wal}}},
+        )
+        db = datasette.get_database("bench")
+        await ensure_schema(db)
+        await db.execute_write_fn(populate)
+
+        stop = asyncio.Event()
+        sync = asyncio.ensure_future(simulate_sync(db, stop))
+        poll = asyncio.ensure_future(poll_events(db, read, stop))
+        await asyncio.sleep(seconds)
+        stop.set()
+        batches = await sync
+        latencies, errors = await poll
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95)] if latencies else float("nan")
+    print(
+        f"{name:<32} {len(latencies):>5} reads  p50 {statistics.median(latencies):7.1f}ms  "
+        f"p95 {p95:7.1f}ms  max {latencies[-1]:7.1f}ms  {errors} errors  "
+        f"({batches} write batches)"
+    )
+
+
+async def on_write_thread(db, fn):
+    return await db.execute_write_fn(fn)
+
+
+async def on_read_pool(db, fn):
+    return await db.execute_fn(fn)
+
+
+async def main(seconds: float) -> None:
+    print(f"{seconds}s per run, {WRITE_BATCH_SIZE}-row write batches")
+    await run("write thread, rollback journal", False, on_write_thread, seconds)
+    await run("read pool, rollback journal", False, on_read_pool, seconds)
+    await run("read pool, WAL", True, on_read_pool, seconds)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 5.0))
@@ -0,0 +1,109 @@
+"""
+Compare the old and new ways of turning page images into LLM attachments.
+
+    python benchmarks/image_processing.py [page.gif ...]
+
+Pass xlarge page images downloaded from DocumentCloud; without any, a few
+synthetic Form 460-sized pages are generated. Reports the time per page
+for the classification crop and the full-page parse image, then the
+throughput of encoding every page on the process pool.
+"""
+import asyncio
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+from datasette_ca460.image_processing import (
+    DEFAULT_IMAGE_WORKERS,
+    PREDICTION_CROP,
+    encode_page_image,
+    run_image_task,
+)
+
+ROUNDS = 5
+
+
+# The implementation this replaced: crop, encode as PNG, then decode that
+# again and re-encode as JPEG
+
+
+def old_crop_page_image_for_prediction(page_image: bytes) -> bytes:
+    img = Image.open(BytesIO(page_image))
+    cropped_img = img.crop((0, 0, img.width // 2, img.height // 6))
+    buffer = BytesIO()
+    cropped_img.save(buffer, format="PNG")
+    return bytes(buffer.getbuffer())
+
+
+def old_gif_to_jpeg(contents: bytes, quality: int = 95) -> bytes:
+    with Image.open(BytesIO(contents)) as im:
+        try:
+            im.seek(0)
+        except EOFError:
+            pass
+        out = BytesIO()
+        im.convert("RGB").save(out, format="JPEG", quality=quality)
+        return out.getvalue()
+
+
+def synthetic_page(n: int) -> bytes:
+    """A 1700x2200 palette GIF with a header, ruled lines and text."""
+    im = Image.new("L", (1700, 2200), 255)
+    draw = ImageDraw.Draw(im)
+    draw.rectangle((60, 60, 800, 300), outline=0, width=4)
+    draw.text((80, 80), f"SCHEDULE A  Monetary Contributions Received  page {n}", fill=0)
+    for y in range(400, 2100, 45):
+        draw.line((60, y, 1640, y), fill=0, width=2)
+        draw.text((80, y + 10), f"Contributor {y} 123 Main St Sacramento CA  $ {y * 3}.00", fill=0)
+    out = BytesIO()
+    im.convert("P").save(out, format="GIF")
+    return out.getvalue()
+
+
+def per_page_ms(fn, pages) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for page in pages:
+            fn(page)
+    return (time.perf_counter() - start) * 1000 / (ROUNDS * len(pages))
+
+
+async def pool_pages_per_second(executor, pages) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        await asyncio.gather(*[
+            run_image_task(executor, encode_page_image, page, crop=PREDICTION_CROP)
+            for page in pages
+        ])
+    return ROUNDS * len(pages) / (time.perf_counter() - start)
+
+
+def main(paths):
+    pages = [Path(p).read_bytes() for p in paths] or [synthetic_page(n) for n in range(8)]
+    print(f"{len(pages)} pages, {ROUNDS} rounds")
+
+    old = per_page_ms(lambda p: old_gif_to_jpeg(old_crop_page_image_for_prediction(p)), pages)
+    new = per_page_ms(lambda p: encode_page_image(p, crop=PREDICTION_CROP), pages)
+    print(f"classification crop: old {old:.1f}ms/page, new {new:.1f}ms/page")
+
+    old = per_page_ms(old_gif_to_jpeg, pages)
+    new = per_page_ms(encode_page_image, pages)
+    print(f"full page:           old {old:.1f}ms/page, new {new:.1f}ms/page")
+
+    thread = asyncio.run(pool_pages_per_second(None, pages))
+    with ProcessPoolExecutor(DEFAULT_IMAGE_WORKERS) as executor:
+        # Start the workers before timing
+        asyncio.run(pool_pages_per_second(executor, pages[:1]))
+        pool = asyncio.run(pool_pages_per_second(executor, pages))
+    print(
+        f"classification crops off the event loop: thread {thread:.0f} pages/s, "
+        f"{DEFAULT_IMAGE_WORKERS} processes {pool:.0f} pages/s"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -5,12 +5,23 @@ from textwrap import dedent
 import json
 from pathlib import Path
 from .routes import router
+from .migrations import migrate_databases
+from .jobs import get_scheduler
 from pydantic import BaseModel
 
 @hookimpl
 def register_routes():
     return router.routes()
 
+@hookimpl
+def startup(datasette):
+    async def inner():
+        await migrate_databases(datasette)
+        # Start queued jobs, and requeue any interrupted by a restart
+        get_scheduler(datasette).wake()
+
+    return inner
+
 @hookimpl
 def database_actions(datasette, database):
     return [
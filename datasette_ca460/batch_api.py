@@ -0,0 +1,223 @@
+import abc
+import asyncio
+import base64
+import json
+import os
+import shutil
+import uuid
+import weakref
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+import llm
+from pydantic import BaseModel
+
+from .limiter import ModelLimiter
+from .models import get_model_cache
+from .options import PLUGIN_NAME
+from .pipeline import close_stage, run_stages, stage_workers
+
+# Statuses reported by BatchBackend.poll()
+BATCH_RUNNING = "running"
+BATCH_COMPLETED = "completed"
+BATCH_FAILED = "failed"
+
+
+class BatchError(RuntimeError):
+    """Raised when a backend reports that a whole batch failed."""
+
+
+def batch_request(
+    custom_id: str,
+    model_id: str,
+    prompt: str,
+    schema: type[BaseModel],
+    attachments: list[tuple[str, bytes]],
+) -> str:
+    """
+    One line of a batch job file: a prompt with its schema and (mime type,
+    content) attachments, identified by custom_id in the results.
+    """
+    return json.dumps({
+        "custom_id": custom_id,
+        "model": model_id,
+        "prompt": prompt,
+        "schema": schema.model_json_schema(),
+        "attachments": [
+            {"type": mime_type, "content": base64.b64encode(content).decode("ascii")}
+            for mime_type, content in attachments
+        ],
+    })
+
+
+def batch_result(custom_id: str, text: Optional[str] = None, usage: Optional[dict] = None, error: Optional[str] = None) -> str:
+    """
+    One line of a batch results file: the response text and usage for a
+    request, or why it failed.
+    """
+    return json.dumps({"custom_id": custom_id, "text": text, "usage": usage, "error": error})
+
+
+def read_jsonl(path: Path) -> Iterator[dict]:
+    with open(path) as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+class BatchBackend(abc.ABC):
+    """
+    Somewhere to send a file of prompts and, later, collect the responses.
+
+    Provider batch APIs trade latency, often hours, for throughput and a
+    lower price, which suits backfills of thousands of pages. A backend
+    takes a JSONL job file of batch_request() lines and eventually provides
+    a JSONL file of batch_result() lines, in any order.
+
+    Batch IDs are stored in the sync_batches table, so a job interrupted by
+    a restart polls the batch it already submitted rather than submitting
+    another.
+
+    Sync jobs pass their `limiter` (see SyncContext.limiter), which returns
+    the ModelLimiter for a model ID, for backends that prompt models
+    themselves.
+    """
+    name: str
+
+    def __init__(self, datasette, limiter: Optional[Callable[[str], ModelLimiter]] = None):
+        self.datasette = datasette
+        self.limiter = limiter
+
+    @abc.abstractmethod
+    async def submit(self, path: Path) -> str:
+        """Submit a job file, returning the backend's ID for the batch."""
+
+    @abc.abstractmethod
+    async def poll(self, batch_id: str) -> str:
+        """BATCH_RUNNING, BATCH_COMPLETED or BATCH_FAILED."""
+
+    @abc.abstractmethod
+    async def results(self, batch_id: str) -> Path:
+        """A local copy of a completed batch's results file."""
+
+
+def default_batch_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or (Path.home() / ".cache")
+    return Path(base) / "datasette-ca460" / "batches"
+
+
+# Datasette instance -> {batch ID: task running it}, across every job
+_local_batch_tasks: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+class LocalBatchBackend(BatchBackend):
+    """
+    Runs batches in this process, through the same models and limiters as
+    interactive syncs. It stands in for a provider's batch API in tests,
+    and lets local models be used for backfills too. Each batch is a
+    directory under the instance-level batch_dir setting:
+
+        <batch ID>/input.jsonl   the submitted job file
+        <batch ID>/output.jsonl  results, once the batch is complete
+        <batch ID>/error         why the batch failed, if it did
+
+    A batch interrupted by a restart is started again when next polled.
+    """
+    name = "local"
+    # Prompts in flight for each batch, at most; the model's limiter may
+    # allow fewer
+    concurrency = 4
+
+    def __init__(self, datasette, limiter=None):
+        super().__init__(datasette, limiter)
+        config = datasette.plugin_config(PLUGIN_NAME) or {}
+        self.directory = Path(config.get("batch_dir") or default_batch_dir()).expanduser()
+        if datasette not in _local_batch_tasks:
+            _local_batch_tasks[datasette] = {}
+        self._tasks: dict[str, asyncio.Task] = _local_batch_tasks[datasette]
+        # Limiters for models, when no job's limiter was passed
+        self._limiters: dict[str, ModelLimiter] = {}
+
+    def _limiter(self, model_id: str) -> ModelLimiter:
+        if self.limiter is not None:
+            return self.limiter(model_id)
+        if model_id not in self._limiters:
+            self._limiters[model_id] = ModelLimiter(model_id, self.concurrency)
+        return self._limiters[model_id]
+
+    async def submit(self, path):
+        batch_id = uuid.uuid4().hex
+        batch_dir = self.directory / batch_id
+        batch_dir.mkdir(parents=True)
+        await asyncio.to_thread(shutil.copyfile, path, batch_dir / "input.jsonl")
+        self._start(batch_id)
+        return batch_id
+
+    async def poll(self, batch_id):
+        batch_dir = self.directory / batch_id
+        if (batch_dir / "output.jsonl").exists():
+            return BATCH_COMPLETED
+        if (batch_dir / "error").exists() or not (batch_dir / "input.jsonl").exists():
+            return BATCH_FAILED
+        task = self._tasks.get(batch_id)
+        # A task from a loop that has since closed won't run again
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._start(batch_id)
+        return BATCH_RUNNING
+
+    async def results(self, batch_id):
+        return self.directory / batch_id / "output.jsonl"
+
+    def _start(self, batch_id: str) -> None:
+        self._tasks[batch_id] = asyncio.ensure_future(self._run(batch_id))
+
+    async def _run(self, batch_id: str) -> None:
+        batch_dir = self.directory / batch_id
+        partial = batch_dir / "output.jsonl.partial"
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        models = get_model_cache(self.datasette)
+
+        async def enqueue():
+            for request in read_jsonl(batch_dir / "input.jsonl"):
+                await queue.put(request)
+            await close_stage(queue, self.concurrency)
+
+        async def run_request(request):
+            try:
+                model = models.get_async_model(request["model"])
+                async with self._limiter(request["model"]).slot() as record_tokens:
+                    response = await model.prompt(
+                        request["prompt"],
+                        schema=request["schema"],
+                        attachments=[
+                            llm.Attachment(
+                                type=attachment["type"],
+                                content=base64.b64decode(attachment["content"])
+                            )
+                            for attachment in request["attachments"]
+                        ]
+                    )
+                    text = await response.text()
+                    usage = await response.usage()
+                    record_tokens((usage.input or 0) + (usage.output or 0))
+                line = batch_result(request["custom_id"], text=text, usage=asdict(usage))
+            except Exception as ex:
+                line = batch_result(request["custom_id"], error=str(ex) or ex.__class__.__name__)
+            out.write(line + "\n")
+
+        try:
+            with open(partial, "w") as out:
+                await run_stages(enqueue(), stage_workers(queue, run_request, self.concurrency))
+            os.replace(partial, batch_dir / "output.jsonl")
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            (batch_dir / "error").write_text(str(ex) or ex.__class__.__name__)
+        finally:
+            self._tasks.pop(batch_id, None)
+
+
+BATCH_BACKENDS: dict[str, type[BatchBackend]] = {
+    LocalBatchBackend.name: LocalBatchBackend,
+}
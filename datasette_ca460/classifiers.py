@@ -0,0 +1,282 @@
+import abc
+import asyncio
+import heapq
+import json
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+
+from .fetch import fetch_bytes
+from .image_processing import DHASH_BITS, PREDICTION_CROP, page_dhash, phash_hex, run_image_task
+
+
+@dataclass
+class PagePrediction:
+    """A page type prediction, and what made it."""
+    page_type: str
+    # "llm", or the name of the local classifier
+    classifier: str
+    # Between 0 and 1, for local classifiers
+    confidence: Optional[float] = None
+    model_usage: Optional[dict] = None
+    image_profile: Optional[dict] = None
+
+
+class PageClassifier(abc.ABC):
+    """
+    A cheap page type classifier tried before prompting the page type model.
+
+    Classifiers are created for each sync job from the page_classifiers
+    option, and tried in order: the first to return a prediction wins. When
+    none does, the model is prompted and every classifier is shown its
+    answer through learn(), so it can do better next time.
+
+    Predictions are stored against the page type model, with the
+    classifier's name and confidence so they can be audited against the
+    model's own labels.
+    """
+    name: str
+
+    def __init__(self, options):
+        self.options = options
+
+    @abc.abstractmethod
+    async def classify(self, ctx, page_id: int, document, page_number: int, model_id: str) -> Optional[PagePrediction]:
+        """A prediction for the page, or None to leave it to the next classifier."""
+
+    async def learn(self, ctx, page_id: int, document, page_number: int, model_id: str, page_type: str) -> None:
+        pass
+
+
+class HeaderHashClassifier(PageClassifier):
+    """
+    Nearest-neighbour matching on the page header.
+
+    Every Form 460 schedule prints its name in the top-left corner, the same
+    corner the model is shown. Pages the model has labelled are kept as
+    templates: the difference hash (see page_dhash) of that corner, and the
+    model's label. A new page is given the label the nearest templates agree
+    on, provided enough of them are close enough.
+    """
+    name = "header-hash"
+    # Templates consulted for each page
+    neighbours = 5
+    # Templates further than this many bits from the page don't count
+    max_distance = DHASH_BITS // 16
+
+    def __init__(self, options):
+        super().__init__(options)
+        # model ID -> [(hash, page_type)]
+        self._templates: dict[str, list[tuple[int, str]]] = {}
+        # Hashes of pages classify() passed on, for learn() to reuse
+        self._hashes: dict[tuple[int, int, str], int] = {}
+        self._lock = asyncio.Lock()
+
+    async def _load(self, ctx, model_id: str) -> list[tuple[int, str]]:
+        async with self._lock:
+            if model_id not in self._templates:
+                rows = await ctx.db.execute_fn(
+                    lambda conn: conn.execute(
+                        "SELECT header_hash, page_type FROM page_type_templates WHERE model = ?",
+                        (model_id,)
+                    ).fetchall()
+                )
+                self._templates[model_id] = [(int(h, 16), page_type) for h, page_type in rows]
+            return self._templates[model_id]
+
+    async def _hash(self, ctx, document, page_number: int, model_id: str) -> int:
+        profile = ctx.options.image_profile_for_model(model_id)
+        page_image = await ctx.page_image(document, page_number, profile.size)
+        return await run_image_task(ctx.image_executor, page_dhash, page_image, PREDICTION_CROP)
+
+    def match(self, templates: list[tuple[int, str]], value: int) -> Optional[PagePrediction]:
+        if len(templates) < self.neighbours:
+            return None
+        nearest = heapq.nsmallest(
+            self.neighbours,
+            (((value ^ h).bit_count(), page_type) for h, page_type in templates),
+        )
+        votes = Counter(page_type for distance, page_type in nearest if distance <= self.max_distance)
+        if not votes:
+            return None
+        page_type, count = votes.most_common(1)[0]
+        return PagePrediction(page_type, self.name, count / self.neighbours)
+
+    async def classify(self, ctx, page_id, document, page_number, model_id):
+        templates = await self._load(ctx, model_id)
+        if len(templates) < self.neighbours:
+            return None
+        value = await self._hash(ctx, document, page_number, model_id)
+        prediction = self.match(templates, value)
+        if prediction is None:
+            self._hashes[(document.id, page_number, model_id)] = value
+        return prediction
+
+    async def learn(self, ctx, page_id, document, page_number, model_id, page_type):
+        templates = await self._load(ctx, model_id)
+        value = self._hashes.pop((document.id, page_number, model_id), None)
+        if value is None:
+            value = await self._hash(ctx, document, page_number, model_id)
+        templates.append((value, page_type))
+        await ctx.writer.write(
+            """INSERT INTO page_type_templates (page_id, model, page_type, header_hash)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (page_id, model) DO NOTHING""",
+            (page_id, model_id, page_type, phash_hex(value))
+        )
+
+
+class FingerprintClassifier(PageClassifier):
+    """
+    Reuse the prediction for a page seen before, in this document or another.
+
+    Amended filings and duplicate uploads repeat pages. A page whose image
+    is byte-identical to one the model has labelled gets the same label
+    with confidence 1; failing that, the nearest page whose whole-page
+    difference hash is within max_distance bits, with confidence falling
+    as the distance grows.
+    """
+    name = "fingerprint"
+    max_distance = DHASH_BITS // 32
+
+    def __init__(self, options):
+        super().__init__(options)
+        # model ID -> ({content_hash: page_type}, [(phash, page_type)])
+        self._seen: dict[str, tuple[dict[str, str], list[tuple[int, str]]]] = {}
+        self._lock = asyncio.Lock()
+
+    async def _load(self, ctx, model_id: str):
+        async with self._lock:
+            if model_id not in self._seen:
+                # Only the model's own labels, so mistakes aren't compounded
+                rows = await ctx.db.execute_fn(
+                    lambda conn: conn.execute(
+                        """SELECT p.content_hash, p.phash, ptp.predicted_page_type
+                        FROM pages p
+                        JOIN page_type_predictions ptp ON ptp.page_id = p.id
+                        WHERE ptp.model = ? AND ptp.classifier = 'llm'
+                        AND p.content_hash IS NOT NULL""",
+                        (model_id,)
+                    ).fetchall()
+                )
+                self._seen[model_id] = (
+                    {content_hash: page_type for content_hash, _, page_type in rows},
+                    [(int(phash, 16), page_type) for _, phash, page_type in rows],
+                )
+            return self._seen[model_id]
+
+    async def classify(self, ctx, page_id, document, page_number, model_id):
+        by_content, by_phash = await self._load(ctx, model_id)
+        if not by_phash:
+            return None
+        fingerprint = await ctx.page_fingerprint(page_id, document, page_number)
+        if fingerprint.content_hash in by_content:
+            return PagePrediction(by_content[fingerprint.content_hash], self.name, 1.0)
+        distance, page_type = min(
+            ((fingerprint.phash ^ phash).bit_count(), page_type) for phash, page_type in by_phash
+        )
+        if distance > self.max_distance:
+            return None
+        return PagePrediction(page_type, self.name, 1 - distance / DHASH_BITS)
+
+    async def learn(self, ctx, page_id, document, page_number, model_id, page_type):
+        by_content, by_phash = await self._load(ctx, model_id)
+        fingerprint = await ctx.page_fingerprint(page_id, document, page_number)
+        by_content[fingerprint.content_hash] = page_type
+        by_phash.append((fingerprint.phash, page_type))
+
+
+# Only the start of a page's OCR text is looked at, where its title is
+TEXT_HEADER_CHARS = 300
+
+SCHEDULE_PAGE_TYPES = {
+    "A": "schedule_a",
+    "C": "schedule_c_nonmonetary_contributions",
+    "D": "schedule_d_summary_expenditures",
+    "E": "schedule_e_payments_made",
+    "F": "schedule_f_accrued_expenses",
+}
+# Schedules with a continuation sheet
+CONTINUED_SCHEDULES = {"A", "D", "E", "F"}
+
+
+def classify_page_text(text: str) -> Optional[str]:
+    """
+    The page type named in the title at the top of a page's text, if it is
+    unambiguous: a title naming more than one kind of page returns None.
+    """
+    header = " ".join(text.upper().split())[:TEXT_HEADER_CHARS]
+    header = header.replace("\u2013", "-").replace("\u2014", "-")
+    candidates = set()
+    if "COVER PAGE" in header:
+        candidates.add(
+            "cover_page_2" if re.search(r"COVER PAGE\s*-?\s*PART 2", header) else "cover_page"
+        )
+    if "SUMMARY PAGE" in header:
+        candidates.add("campaign_disclosure_summary_page")
+    for letter in set(re.findall(r"\bSCHEDULE ([A-F])\b", header)):
+        if letter == "B":
+            parts = set(re.findall(r"\bPART ([12])\b", header))
+            if len(parts) != 1:
+                return None
+            candidates.add(
+                "schedule_b_part1_loans_received"
+                if parts == {"1"}
+                else "schedule_b_part2_loan_guarantors"
+            )
+        elif letter in CONTINUED_SCHEDULES and re.search(r"\((CONT\.?|CONTINUATION SHEET)\)", header):
+            candidates.add(f"{SCHEDULE_PAGE_TYPES[letter]}_continuation")
+        else:
+            candidates.add(SCHEDULE_PAGE_TYPES[letter])
+    if len(candidates) != 1:
+        return None
+    return candidates.pop()
+
+
+class TextRulesClassifier(PageClassifier):
+    """
+    Keyword rules over the OCR text DocumentCloud already has for each page.
+
+    A document's text is fetched in one request, the first time one of its
+    pages is classified, so pages with an obvious title are classified
+    without downloading their image.
+    """
+    name = "text-rules"
+
+    def __init__(self, options):
+        super().__init__(options)
+        # document ID -> task fetching {page_number: text}
+        self._texts: dict[int, asyncio.Task] = {}
+
+    async def _fetch_texts(self, ctx, document) -> dict[int, str]:
+        try:
+            content = await fetch_bytes(
+                ctx.http, document.get_json_text_url(), retries=ctx.options.http_retries
+            )
+        except httpx.HTTPError:
+            # Not every document has text; its pages go to the next classifier
+            return {}
+        # Pages are numbered from 0 in the text file
+        return {
+            page["page"] + 1: page.get("contents") or ""
+            for page in json.loads(content).get("pages", [])
+        }
+
+    async def classify(self, ctx, page_id, document, page_number, model_id):
+        if document.id not in self._texts:
+            self._texts[document.id] = asyncio.ensure_future(self._fetch_texts(ctx, document))
+        texts = await asyncio.shield(self._texts[document.id])
+        page_type = classify_page_text(texts.get(page_number, ""))
+        if page_type is None:
+            return None
+        return PagePrediction(page_type, self.name, 1.0)
+
+
+PAGE_CLASSIFIERS: dict[str, type[PageClassifier]] = {
+    TextRulesClassifier.name: TextRulesClassifier,
+    FingerprintClassifier.name: FingerprintClassifier,
+    HeaderHashClassifier.name: HeaderHashClassifier,
+}
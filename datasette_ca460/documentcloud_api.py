@@ -0,0 +1,86 @@
+import asyncio
+import json
+import math
+from typing import Optional
+
+import httpx
+from documentcloud import DocumentCloud
+from documentcloud.constants import PER_PAGE_MAX
+from documentcloud.documents import Document
+
+from .fetch import fetch_bytes
+
+DOCUMENTCLOUD_API_URL = "https://api.www.documentcloud.org/api/"
+# Listing requests in flight at once for a project
+LIST_CONCURRENCY = 4
+
+
+def document_version(document) -> str:
+    """
+    A document's updated_at, as a string. DocumentCloud bumps it whenever
+    the document or its assets change, so it identifies a version of it.
+    """
+    version = getattr(document, "updated_at", None)
+    return version.isoformat() if hasattr(version, "isoformat") else str(version or "")
+
+
+async def _get_json(http: httpx.AsyncClient, url: httpx.URL, retries: int) -> dict:
+    return json.loads(await fetch_bytes(http, str(url), retries=retries))
+
+
+async def list_project_documents(
+    http: httpx.AsyncClient,
+    project_id: int,
+    retries: int = 3,
+    concurrency: int = LIST_CONCURRENCY,
+    api_url: str = DOCUMENTCLOUD_API_URL,
+    client: Optional[DocumentCloud] = None,
+) -> list[Document]:
+    """
+    Every document in a project, with its metadata, bound to `client` (by
+    default an anonymous client for api_url) for any further API calls.
+
+    The documentcloud client follows a project's `next` links one page at
+    a time, on a thread. Here the first page's count and size say how many
+    pages there are, and the rest are fetched `concurrency` at a time. If the API
+    paginates with cursors instead of page numbers, `next` links are
+    followed in turn.
+    """
+    url = httpx.URL(
+        f"{api_url}projects/{project_id}/documents/",
+        params={"per_page": PER_PAGE_MAX, "expand": "document"},
+    )
+    first = await _get_json(http, url, retries)
+    results = list(first["results"])
+    next_url: Optional[str] = first.get("next")
+    if next_url and results and "page" in httpx.URL(next_url).params and first.get("count") is not None:
+        next_page = int(httpx.URL(next_url).params["page"])
+        # The API may return fewer per page than were asked for
+        page_count = math.ceil(first["count"] / len(results))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_page(page: int) -> list:
+            async with semaphore:
+                data = await _get_json(
+                    http, httpx.URL(next_url).copy_set_param("page", page), retries
+                )
+                return data["results"]
+
+        for page_results in await asyncio.gather(
+            *(fetch_page(page) for page in range(next_page, page_count + 1))
+        ):
+            results.extend(page_results)
+    else:
+        while next_url:
+            data = await _get_json(http, httpx.URL(next_url), retries)
+            results.extend(data["results"])
+            next_url = data.get("next")
+
+    if client is None:
+        client = DocumentCloud(base_uri=api_url)
+    # A document added while paging can shift another onto a second page
+    documents = {}
+    for result in results:
+        document = Document(client, result["document"])
+        documents.setdefault(document.id, document)
+    return list(documents.values())
@@ -0,0 +1,95 @@
+import asyncio
+import weakref
+from datetime import datetime, timezone
+from typing import Optional
+
+# Job statuses after which no more events will be logged
+FINISHED_STATUSES = {"completed", "failed", "cancelled"}
+
+
+def now_timestamp() -> str:
+    """The current UTC time, formatted like SQLite's CURRENT_TIMESTAMP."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class EventBroker:
+    """
+    In-process pub/sub for sync progress in one database.
+
+    log_event() and SyncContext.log() publish each event once it has been
+    committed, and job status changes are published as they are written,
+    so open progress streams are pushed updates instead of re-reading the
+    sync_events table.
+    """
+
+    def __init__(self):
+        self._subscribers: dict[str, set[asyncio.Queue]] = {}
+
+    def subscribe(self, sync_job_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(sync_job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, sync_job_id: str, queue: asyncio.Queue) -> None:
+        subscribers = self._subscribers.get(sync_job_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[sync_job_id]
+
+    def _publish(self, sync_job_id: str, message: tuple) -> None:
+        for queue in self._subscribers.get(sync_job_id, ()):
+            queue.put_nowait(message)
+
+    def publish_event(self, sync_job_id: str, event: dict) -> None:
+        self._publish(sync_job_id, ("event", event))
+
+    def publish_job(self, sync_job_id: str, job: dict) -> None:
+        self._publish(sync_job_id, ("job", job))
+
+
+_brokers: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def broker_for(db) -> EventBroker:
+    if db not in _brokers:
+        _brokers[db] = EventBroker()
+    return _brokers[db]
+
+
+def load_job_events(conn, sync_job_id: str, since: Optional[int] = None) -> Optional[dict]:
+    """Job status plus its events with an id greater than `since`."""
+    cursor = conn.execute(
+        "SELECT status, error, started_at, completed_at FROM sync_jobs WHERE id = ?",
+        (sync_job_id,)
+    )
+    job = cursor.fetchone()
+
+    if not job:
+        return None
+
+    cursor = conn.execute(
+        """SELECT id, event_type, message, created_at FROM sync_events
+        WHERE sync_job_id = ? AND id > ? ORDER BY id""",
+        (sync_job_id, since or 0)
+    )
+    events = cursor.fetchall()
+
+    return {
+        "job": {
+            "status": job[0],
+            "error": job[1],
+            "started_at": job[2],
+            "completed_at": job[3],
+        },
+        "events": [
+            {
+                "id": e[0],
+                "type": e[1],
+                "message": e[2],
+                "created_at": e[3],
+            }
+            for e in events
+        ]
+    }
@@ -0,0 +1,71 @@
+import asyncio
+import random
+from typing import Optional
+
+import httpx
+
+from .options import SyncOptions
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def create_http_client(options: SyncOptions) -> httpx.AsyncClient:
+    """
+    A pooled client for DocumentCloud asset downloads.
+
+    One client is shared by every download in a sync job, so connections
+    (and their TLS sessions) are kept alive and reused instead of being
+    set up again for each page.
+    """
+    return httpx.AsyncClient(
+        http2=options.http2,
+        limits=httpx.Limits(
+            max_connections=options.http_max_connections,
+            max_keepalive_connections=options.http_max_keepalive_connections,
+        ),
+        timeout=httpx.Timeout(options.http_timeout),
+        follow_redirects=True,
+    )
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Exponential backoff with full jitter for the given (0-based) attempt."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+async def fetch_bytes(client: httpx.AsyncClient, url: str, retries: int = 3) -> bytes:
+    """
+    GET url and return the response body, retrying 429s, 5xx responses and
+    transport errors with jittered exponential backoff (honouring
+    Retry-After when the server sends one).
+    """
+    attempt = 0
+    while True:
+        try:
+            response = await client.get(url)
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        if response.status_code in RETRY_STATUS_CODES and attempt < retries:
+            delay = _retry_after(response)
+            await asyncio.sleep(delay if delay is not None else backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        response.raise_for_status()
+        return response.content
@@ -0,0 +1,188 @@
+import sqlite3
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Awaitable, Callable, NamedTuple, Optional
+from urllib.parse import parse_qsl
+
+from datasette import Response
+
+from .options import PLUGIN_NAME, _positive_int
+
+# Responses larger than this aren't cached
+MAX_CACHED_BODY_BYTES = 4 * 1024 * 1024
+DEFAULT_RESPONSE_CACHE_ENTRIES = 200
+DEFAULT_RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class DataVersion(NamedTuple):
+    """The ca460_data_version row: bumped by every write the API can see."""
+    version: int
+    updated_at: datetime
+
+    @property
+    def etag(self) -> str:
+        return f'"ca460-{self.version}"'
+
+    def headers(self) -> dict:
+        return {
+            "etag": self.etag,
+            "last-modified": format_datetime(self.updated_at, usegmt=True),
+            # Browsers may keep responses, but must check they're current
+            "cache-control": "no-cache",
+        }
+
+
+async def data_version(db) -> Optional[DataVersion]:
+    """The database's data version, or None before it has been migrated."""
+    def _read(conn):
+        try:
+            return conn.execute(
+                "SELECT version, updated_at FROM ca460_data_version WHERE id = 1"
+            ).fetchone()
+        except sqlite3.OperationalError as ex:
+            if "no such table" in str(ex):
+                return None
+            raise
+
+    row = await db.execute_fn(_read)
+    if row is None:
+        return None
+    updated_at = datetime.fromisoformat(row[1]).replace(tzinfo=timezone.utc)
+    return DataVersion(row[0], updated_at)
+
+
+def is_not_modified(request, version: DataVersion) -> bool:
+    """
+    Whether the client's cached copy, per its If-None-Match header, is
+    current. If-Modified-Since is ignored: Last-Modified only has second
+    precision, so a copy fetched just before a write in the same second
+    would pass as current.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or version.etag in tags
+
+
+def not_modified(version: DataVersion) -> Response:
+    return Response("", status=304, headers=version.headers())
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    status: int
+    content_type: str
+
+
+class ResponseCache:
+    """
+    An LRU cache of API responses, keyed by database, path, query string
+    and data version. A write moves the data version on, so entries
+    are never stale: they just stop being used, and are evicted in time.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_RESPONSE_CACHE_ENTRIES,
+        max_bytes: int = DEFAULT_RESPONSE_CACHE_BYTES,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: tuple, entry: CachedResponse) -> None:
+        if len(entry.body) > MAX_CACHED_BODY_BYTES:
+            return
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key).body)
+        self._entries[key] = entry
+        self._bytes += len(entry.body)
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.body)
+
+
+_caches: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def get_response_cache(datasette) -> ResponseCache:
+    """
+    The process-wide response cache for a Datasette instance, configured by
+    instance-level plugin config:
+
+        plugins:
+          datasette-ca460:
+            response_cache_max_entries: 200
+            response_cache_max_bytes: 67108864
+    """
+    if datasette not in _caches:
+        config = datasette.plugin_config(PLUGIN_NAME) or {}
+        _caches[datasette] = ResponseCache(
+            _positive_int(
+                "response_cache_max_entries",
+                config.get("response_cache_max_entries", DEFAULT_RESPONSE_CACHE_ENTRIES),
+            ),
+            _positive_int(
+                "response_cache_max_bytes",
+                config.get("response_cache_max_bytes", DEFAULT_RESPONSE_CACHE_BYTES),
+            ),
+        )
+    return _caches[datasette]
+
+
+def cache_key(db, request, version: DataVersion) -> tuple:
+    params = tuple(sorted(parse_qsl(request.query_string, keep_blank_values=True)))
+    return (db.name, request.path, params, version.version)
+
+
+async def cached_response(
+    request,
+    datasette,
+    db,
+    build: Callable[[], Awaitable[Response]],
+) -> Response:
+    """
+    Answer a read-only API request from the response cache, or with a 304
+    if the client's copy is current, calling build() only when neither
+    will do. Successful responses carry ETag and Last-Modified headers
+    derived from the database's data version.
+    """
+    version = await data_version(db)
+    if version is None:
+        return await build()
+    if is_not_modified(request, version):
+        return not_modified(version)
+
+    cache = get_response_cache(datasette)
+    key = cache_key(db, request, version)
+    entry = cache.get(key)
+    if entry is None:
+        response = await build()
+        if response.status != 200:
+            return response
+        body = response.body if isinstance(response.body, bytes) else response.body.encode("utf-8")
+        entry = CachedResponse(body, response.status, response.content_type)
+        cache.put(key, entry)
+    return Response(
+        entry.body,
+        status=entry.status,
+        headers=version.headers(),
+        content_type=entry.content_type,
+    )
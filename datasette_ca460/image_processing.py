@@ -0,0 +1,131 @@
+import asyncio
+import functools
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from io import BytesIO
+from typing import Callable, Optional, TypeVar
+
+from PIL import Image
+
+from .options import PLUGIN_NAME, ImageProfile, _non_negative_int
+
+T = TypeVar("T")
+
+# The page type is printed in the top-left corner of every Form 460 page:
+# classify on the left half of the top sixth
+PREDICTION_CROP = (1 / 2, 1 / 6)
+
+DEFAULT_IMAGE_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def encode_page_image(
+    content: bytes,
+    profile: ImageProfile = ImageProfile(),
+    crop: Optional[tuple[float, float]] = None,
+) -> bytes:
+    """
+    Turn a DocumentCloud page image into an attachment as described by
+    profile, decoding it once.
+
+    With `crop`, only the top-left (width, height) fraction of the page is
+    kept. The crop is taken before converting and scaling, so the rest of
+    the page is never converted or re-encoded. Images are scaled down with
+    Pillow's reducing_gap, which shrinks by whole factors before resampling.
+
+    This is CPU-bound and runs in a worker process (see run_image_task), so
+    it takes and returns plain bytes.
+    """
+    with Image.open(BytesIO(content)) as im:
+        if crop is not None:
+            im = im.crop((0, 0, int(im.width * crop[0]), int(im.height * crop[1])))
+        mode = "L" if profile.grayscale else "RGB"
+        if im.mode != mode:
+            im = im.convert(mode)
+        if profile.max_long_edge and max(im.size) > profile.max_long_edge:
+            im.thumbnail(
+                (profile.max_long_edge, profile.max_long_edge),
+                Image.Resampling.LANCZOS,
+                reducing_gap=2.0,
+            )
+        out = BytesIO()
+        im.save(out, format=profile.format.upper(), quality=profile.quality)
+        return out.getvalue()
+
+
+# dHash grid: each row compares DHASH_SIZE + 1 neighbouring pixels, giving
+# DHASH_SIZE * DHASH_SIZE bits
+DHASH_SIZE = 16
+DHASH_BITS = DHASH_SIZE * DHASH_SIZE
+
+
+def page_dhash(content: bytes, crop: Optional[tuple[float, float]] = None) -> int:
+    """
+    Difference hash of a page image, or of its top-left `crop`.
+
+    Pages that look alike have hashes a small Hamming distance apart,
+    whatever size variant they were downloaded at.
+    """
+    with Image.open(BytesIO(content)) as im:
+        if crop is not None:
+            im = im.crop((0, 0, int(im.width * crop[0]), int(im.height * crop[1])))
+        small = im.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.BOX)
+        pixels = small.tobytes()
+    value = 0
+    for row in range(DHASH_SIZE):
+        offset = row * (DHASH_SIZE + 1)
+        for col in range(DHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def phash_hex(value: int) -> str:
+    """A difference hash as fixed-width hex, for storing in SQLite."""
+    return format(value, f"0{DHASH_BITS // 4}x")
+
+
+def fingerprint_page_image(content: bytes) -> tuple[str, int]:
+    """
+    A page image's SHA-256, which matches byte-identical images, and its
+    difference hash, which also matches near-identical ones.
+    """
+    return hashlib.sha256(content).hexdigest(), page_dhash(content)
+
+
+_executors: dict[int, Optional[Executor]] = {}
+
+
+def get_image_executor(datasette) -> Optional[Executor]:
+    """
+    Process-wide pool for image processing, configured by instance-level
+    plugin config:
+
+        plugins:
+          datasette-ca460:
+            image_workers: 4
+
+    image_workers: 0 processes images on a thread instead, for environments
+    where starting worker processes isn't possible.
+    """
+    config = datasette.plugin_config(PLUGIN_NAME) or {}
+    workers = _non_negative_int(
+        "image_workers", config.get("image_workers", DEFAULT_IMAGE_WORKERS)
+    )
+    if workers not in _executors:
+        _executors[workers] = (
+            # Datasette runs threads of its own, which fork() doesn't mix with
+            ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+            if workers
+            else None
+        )
+    return _executors[workers]
+
+
+async def run_image_task(executor: Optional[Executor], fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run fn off the event loop, in executor or else on a worker thread."""
+    if executor is None:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(fn, *args, **kwargs)
+    )
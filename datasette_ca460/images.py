@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from .documentcloud_api import document_version
+from .options import PLUGIN_NAME, _non_negative_int
+
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+
+
+def default_cache_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or (Path.home() / ".cache")
+    return Path(base) / "datasette-ca460" / "page-images"
+
+
+def page_image_key(document, page_number: int, size: str = "xlarge") -> str:
+    """
+    Cache key for a page image.
+
+    DocumentCloud bumps a document's updated_at whenever its assets are
+    regenerated, so it acts as the asset version: a re-processed document
+    gets fresh keys and stale images simply age out of the cache.
+    """
+    raw = f"{document.id}:{page_number}:{size}:{document_version(document)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class PageImageCache:
+    """
+    Two-tier LRU cache of DocumentCloud page images.
+
+    A small in-memory tier holds recently used images; every image is also
+    written to disk under `directory`, which is evicted least-recently-used
+    first once it grows beyond `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        memory_bytes: int = DEFAULT_CACHE_MEMORY_BYTES,
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        # Disk index of key -> size, oldest first. Loaded lazily.
+        self._disk: Optional["OrderedDict[str, int]"] = None
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    # Disk tier: these run in a worker thread
+
+    def _load_index(self) -> None:
+        if self._disk is not None:
+            return
+        entries = []
+        if self.directory.exists():
+            for path in self.directory.glob("*/*"):
+                if path.suffix == ".tmp":
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path.name, stat.st_size))
+        entries.sort()
+        self._disk = OrderedDict((name, size) for _, name, size in entries)
+        self._disk_size = sum(size for _, _, size in entries)
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            self._load_index()
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        path = self._path(key)
+        try:
+            content = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._disk_size -= self._disk.pop(key, 0)
+            return None
+        return content
+
+    def _write_disk(self, key: str, content: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{key}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(content)
+        os.replace(tmp, path)
+        evict = []
+        with self._lock:
+            self._load_index()
+            self._disk_size -= self._disk.pop(key, 0)
+            self._disk[key] = len(content)
+            self._disk_size += len(content)
+            while self._disk_size > self.max_bytes and len(self._disk) > 1:
+                old_key, old_size = self._disk.popitem(last=False)
+                self._disk_size -= old_size
+                evict.append(old_key)
+        for old_key in evict:
+            try:
+                self._path(old_key).unlink()
+            except FileNotFoundError:
+                pass
+
+    # Memory tier: event loop only
+
+    def _remember(self, key: str, content: bytes) -> None:
+        if len(content) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = content
+        self._memory_size += len(content)
+        while self._memory_size > self.memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        """Return the cached image for key, calling fetch() on a miss."""
+        while True:
+            content = self._memory.get(key)
+            if content is not None:
+                self._memory.move_to_end(key)
+                return content
+            if key not in self._inflight:
+                break
+            # Concurrent requests for the same page share a single download.
+            # None means it was cancelled along with the job that started
+            # it, so the next waiter starts its own.
+            content = await asyncio.shield(self._inflight[key])
+            if content is not None:
+                return content
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            content = await asyncio.to_thread(self._read_disk, key)
+            if content is None:
+                content = await fetch()
+                await asyncio.to_thread(self._write_disk, key, content)
+            self._remember(key, content)
+            future.set_result(content)
+            return content
+        except asyncio.CancelledError:
+            # Cancelling one job mustn't cancel the others waiting on the page
+            future.set_result(None)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody else may be waiting on this future
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+
+_caches: dict[tuple, PageImageCache] = {}
+
+
+def get_page_image_cache(datasette) -> PageImageCache:
+    """
+    Process-wide page image cache, configured by instance-level plugin config:
+
+        plugins:
+          datasette-ca460:
+            image_cache_dir: /var/cache/ca460
+            image_cache_max_bytes: 2147483648
+            image_cache_memory_bytes: 67108864
+    """
+    config = datasette.plugin_config(PLUGIN_NAME) or {}
+    directory = Path(config.get("image_cache_dir") or default_cache_dir()).expanduser()
+    max_bytes = _non_negative_int(
+        "image_cache_max_bytes", config.get("image_cache_max_bytes", DEFAULT_CACHE_MAX_BYTES)
+    )
+    memory_bytes = _non_negative_int(
+        "image_cache_memory_bytes",
+        config.get("image_cache_memory_bytes", DEFAULT_CACHE_MEMORY_BYTES),
+    )
+    cache_key = (str(directory.resolve()), max_bytes, memory_bytes)
+    if cache_key not in _caches:
+        _caches[cache_key] = PageImageCache(directory, max_bytes, memory_bytes)
+    return _caches[cache_key]
@@ -0,0 +1,140 @@
+import sqlite3
+from dataclasses import dataclass, field
+
+from .documentcloud_api import document_version
+
+
+@dataclass
+class ProjectChanges:
+    """How a project's documents differ from when it was last listed."""
+    added: list[int] = field(default_factory=list)
+    # Documents with a new version (updated_at) since the last listing
+    modified: list[int] = field(default_factory=list)
+    removed: list[int] = field(default_factory=list)
+    # Documents whose pages were deleted, as their page count or file hash
+    # changed
+    invalidated: list[int] = field(default_factory=list)
+
+    def describe(self) -> str:
+        return (
+            f"{len(self.added)} new, {len(self.modified)} changed and "
+            f"{len(self.removed)} removed documents since the last sync"
+        )
+
+
+def document_file_hash(document):
+    return getattr(document, "file_hash", None) or None
+
+
+def pages_are_stale(stored: tuple, document) -> bool:
+    """
+    Whether the pages of a stored (page_count, file_hash) document no
+    longer match it. A changed title or other metadata bumps updated_at
+    too, but leaves the pages alone.
+    """
+    page_count, file_hash = stored
+    if page_count is not None and page_count != document.page_count:
+        return True
+    new_hash = document_file_hash(document)
+    return bool(file_hash and new_hash and file_hash != new_hash)
+
+
+def invalidate_documents(conn: sqlite3.Connection, document_ids: list[int]) -> None:
+    """
+    Delete the pages of documents, along with everything derived from them,
+    so their next sync starts again from scratch.
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _stale_pages(id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM _stale_pages")
+    conn.executemany(
+        "INSERT INTO _stale_pages SELECT id FROM pages WHERE document_id = ?",
+        [(document_id,) for document_id in document_ids]
+    )
+    stale_parsed = "SELECT id FROM page_parsed WHERE page_id IN (SELECT id FROM _stale_pages)"
+    for sql in (
+        f"UPDATE page_parsed SET reused_from = NULL WHERE reused_from IN ({stale_parsed})",
+        f"DELETE FROM schedule_a_itemizations WHERE page_parsed_id IN ({stale_parsed})",
+        f"DELETE FROM summary_pages WHERE page_parsed_id IN ({stale_parsed})",
+        "DELETE FROM page_parsed WHERE page_id IN (SELECT id FROM _stale_pages)",
+        "DELETE FROM page_type_predictions WHERE page_id IN (SELECT id FROM _stale_pages)",
+        "DELETE FROM page_type_templates WHERE page_id IN (SELECT id FROM _stale_pages)",
+        "DELETE FROM page_failures WHERE page_id IN (SELECT id FROM _stale_pages)",
+        "DELETE FROM pages WHERE id IN (SELECT id FROM _stale_pages)",
+        "DELETE FROM _stale_pages",
+    ):
+        conn.execute(sql)
+    conn.executemany(
+        "DELETE FROM document_syncs WHERE document_id = ?",
+        [(document_id,) for document_id in document_ids]
+    )
+
+
+def apply_project_listing(conn: sqlite3.Connection, project_id: int, documents: list) -> ProjectChanges:
+    """
+    Compare a fresh listing of a project's documents with the last one,
+    invalidate the pages of any that were re-uploaded, and store the
+    listing for next time. Run with execute_write_fn, so it all happens in
+    one transaction.
+    """
+    listed = {
+        row[0]: (row[1], bool(row[2]))
+        for row in conn.execute(
+            """SELECT document_id, updated_at, removed_at IS NOT NULL
+            FROM project_documents WHERE project_id = ?""",
+            (project_id,)
+        )
+    }
+    stored = {
+        row[0]: (row[1], row[2])
+        for row in conn.execute(
+            "SELECT id, page_count, file_hash FROM documents WHERE id IN (SELECT value FROM json_each(?))",
+            (f"[{','.join(str(document.id) for document in documents)}]",)
+        )
+    }
+
+    changes = ProjectChanges()
+    for document in documents:
+        previous = listed.get(document.id)
+        if previous is None or previous[1]:
+            changes.added.append(document.id)
+        elif previous[0] != document_version(document):
+            changes.modified.append(document.id)
+        # Pages are shared by every project a document is in, so they are
+        # checked against the documents table even for new documents
+        if document.id in stored and pages_are_stale(stored[document.id], document):
+            changes.invalidated.append(document.id)
+    seen = {document.id for document in documents}
+    changes.removed = [
+        document_id for document_id, (_, removed) in listed.items()
+        if document_id not in seen and not removed
+    ]
+
+    if changes.invalidated:
+        invalidate_documents(conn, changes.invalidated)
+    conn.executemany(
+        """INSERT INTO project_documents
+        (project_id, document_id, updated_at, page_count, file_hash)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (project_id, document_id) DO UPDATE SET
+            updated_at = excluded.updated_at,
+            page_count = excluded.page_count,
+            file_hash = excluded.file_hash,
+            last_seen_at = CURRENT_TIMESTAMP,
+            removed_at = NULL""",
+        [
+            (
+                project_id,
+                document.id,
+                document_version(document),
+                document.page_count,
+                document_file_hash(document),
+            )
+            for document in documents
+        ]
+    )
+    conn.executemany(
+        """UPDATE project_documents SET removed_at = CURRENT_TIMESTAMP
+        WHERE project_id = ? AND document_id = ?""",
+        [(project_id, document_id) for document_id in changes.removed]
+    )
+    return changes
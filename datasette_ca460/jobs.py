@@ -0,0 +1,337 @@
+import asyncio
+import json
+import os
+import socket
+import uuid
+import weakref
+from typing import Iterable, Optional
+
+from .events import broker_for
+from .migrations import is_migrated
+from .options import PLUGIN_NAME, SyncOptions, _positive_int, resolve_sync_options, sync_options_from_dict
+from .sync import log_event, run_sync_in_background
+
+# Identifies this process. Each run of a job adds its own suffix (see
+# run_worker_id) in sync_jobs.worker_id and work unit leases
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+DEFAULT_MAX_CONCURRENT_JOBS = 2
+# How often running jobs record a heartbeat and the scheduler looks for work
+HEARTBEAT_SECONDS = 15
+# A running job whose heartbeat is older than this has lost its worker,
+# most likely because the process running it was restarted
+ORPHAN_AFTER_SECONDS = 4 * HEARTBEAT_SECONDS
+
+# action: (statuses it applies to, resulting status)
+TRANSITIONS = {
+    "pause": ({"queued", "running"}, "paused"),
+    "resume": ({"paused"}, "queued"),
+    "cancel": ({"queued", "running", "paused"}, "cancelled"),
+}
+
+
+def run_worker_id() -> str:
+    """
+    A worker ID for one run of a job by this process. If the job is requeued
+    and claimed again, a task left over from the earlier run can't renew it.
+    """
+    return f"{WORKER_ID}:{uuid.uuid4().hex[:8]}"
+
+
+class JobStateError(ValueError):
+    """Raised when a job can't be paused, resumed or cancelled from its current status."""
+
+
+def enqueue_job(
+    conn,
+    sync_job_id: str,
+    project_id: int,
+    page_type_model: str,
+    parser_model: str,
+    options: SyncOptions,
+) -> None:
+    conn.execute(
+        """INSERT INTO sync_jobs (id, project_id, page_type_model, parser_model, status, options)
+        VALUES (?, ?, ?, ?, 'queued', ?)""",
+        (sync_job_id, project_id, page_type_model, parser_model, json.dumps(options.to_dict()))
+    )
+    conn.commit()
+
+
+def claim_next_job(conn, worker_id: str) -> Optional[dict]:
+    """Move the oldest queued job to running, owned by worker_id."""
+    row = conn.execute(
+        """SELECT id, project_id, page_type_model, parser_model, options
+        FROM sync_jobs WHERE status = 'queued'
+        ORDER BY started_at, rowid LIMIT 1"""
+    ).fetchone()
+    if row is None:
+        return None
+    cursor = conn.execute(
+        """UPDATE sync_jobs
+        SET status = 'running', worker_id = ?, heartbeat_at = datetime('now'),
+            completed_at = NULL, error = NULL
+        WHERE id = ? AND status = 'queued'""",
+        (worker_id, row[0])
+    )
+    conn.commit()
+    if not cursor.rowcount:
+        return None
+    return {
+        "id": row[0],
+        "project_id": row[1],
+        "page_type_model": row[2],
+        "parser_model": row[3],
+        "options": json.loads(row[4]) if row[4] else None,
+    }
+
+
+def record_heartbeat(conn, sync_job_id: str, worker_id: str) -> bool:
+    """
+    Record that worker_id is still running a job, which keeps its work unit
+    leases. Returns False if the job is no longer running on this worker.
+    """
+    cursor = conn.execute(
+        """UPDATE sync_jobs SET heartbeat_at = datetime('now')
+        WHERE id = ? AND status = 'running' AND worker_id = ?""",
+        (sync_job_id, worker_id)
+    )
+    conn.commit()
+    return bool(cursor.rowcount)
+
+
+def _release_work_units(conn, sync_job_id: str) -> None:
+    conn.execute(
+        """UPDATE sync_work_units
+        SET status = 'pending', lease_owner = NULL
+        WHERE sync_job_id = ? AND status = 'leased'""",
+        (sync_job_id,)
+    )
+
+
+def requeue_orphaned_jobs(
+    conn, orphan_after: int = ORPHAN_AFTER_SECONDS, running: Iterable[str] = ()
+) -> list[str]:
+    """
+    Put running jobs whose worker has stopped sending heartbeats back on the
+    queue, releasing their work units. Returns the requeued job IDs.
+
+    Jobs in `running` are still running in the calling process, so they are
+    left alone: a stale heartbeat there means a slow event loop, not a lost
+    worker.
+    """
+    running = set(running)
+    cursor = conn.execute(
+        """SELECT id FROM sync_jobs
+        WHERE status = 'running'
+        AND (heartbeat_at IS NULL OR heartbeat_at < datetime('now', ?))""",
+        (f"-{orphan_after} seconds",)
+    )
+    orphaned = [row[0] for row in cursor.fetchall() if row[0] not in running]
+    for sync_job_id in orphaned:
+        conn.execute(
+            "UPDATE sync_jobs SET status = 'queued', worker_id = NULL WHERE id = ?",
+            (sync_job_id,)
+        )
+        _release_work_units(conn, sync_job_id)
+    conn.commit()
+    return orphaned
+
+
+def has_active_jobs(conn) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sync_jobs WHERE status IN ('queued', 'running') LIMIT 1"
+    ).fetchone() is not None
+
+
+class JobScheduler:
+    """
+    Runs queued sync jobs, at most `max_concurrent_jobs` at a time across
+    all databases.
+
+    Jobs live in the sync_jobs table, so the queue survives restarts: each
+    running job records a heartbeat, and jobs whose heartbeat goes stale are
+    requeued and resume from their unfinished work units. The scheduler
+    loop only runs while there are queued or running jobs; wake() starts it.
+    """
+
+    def __init__(self, datasette, max_concurrent_jobs: int = DEFAULT_MAX_CONCURRENT_JOBS):
+        self.datasette = datasette
+        self.max_concurrent_jobs = max_concurrent_jobs
+        # (database name, sync job ID) -> task running the sync
+        self.running: dict[tuple[str, str], asyncio.Task] = {}
+        self._wake = asyncio.Event()
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def wake(self) -> None:
+        """Look for work now, starting the scheduler loop if it isn't running."""
+        self._wake.set()
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.ensure_future(self._loop())
+
+    def stop(self, database_name: str, sync_job_id: str) -> None:
+        """Cancel a job running in this process, if it is."""
+        task = self.running.get((database_name, sync_job_id))
+        if task is not None:
+            task.cancel()
+
+    def _databases(self):
+        # Databases without ca460 tables are migrated (and so picked up
+        # here) when a sync is first started against them
+        return [
+            (name, db)
+            for name, db in list(self.datasette.databases.items())
+            if db.is_mutable and is_migrated(db)
+        ]
+
+    async def _loop(self) -> None:
+        while True:
+            self._wake.clear()
+            active = await self._tick()
+            if not active and not self.running and not self._wake.is_set():
+                return
+            try:
+                await asyncio.wait_for(self._wake.wait(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _tick(self) -> bool:
+        active = False
+        for name, db in self._databases():
+            running = [sync_job_id for database_name, sync_job_id in self.running if database_name == name]
+            requeued = await db.execute_write_fn(
+                lambda conn: requeue_orphaned_jobs(conn, running=running)
+            )
+            for sync_job_id in requeued:
+                await log_event(
+                    db, sync_job_id, "info",
+                    "Sync was interrupted, probably by a restart. Resuming it."
+                )
+                broker_for(db).publish_job(
+                    sync_job_id, {"status": "queued", "error": None, "completed_at": None}
+                )
+            while len(self.running) < self.max_concurrent_jobs:
+                worker_id = run_worker_id()
+                job = await db.execute_write_fn(
+                    lambda conn: claim_next_job(conn, worker_id)
+                )
+                if job is None:
+                    break
+                self._start(name, db, job, worker_id)
+            active = active or await db.execute_fn(has_active_jobs)
+        return active
+
+    def _start(self, database_name: str, db, job: dict, worker_id: str) -> None:
+        sync_job_id = job["id"]
+        if job["options"] is None:
+            # Queued before options were stored with the job
+            options = resolve_sync_options(self.datasette, database_name)
+        else:
+            options = sync_options_from_dict(job["options"])
+        broker_for(db).publish_job(
+            sync_job_id, {"status": "running", "error": None, "completed_at": None}
+        )
+        task = asyncio.ensure_future(
+            run_sync_in_background(
+                self.datasette,
+                database_name,
+                sync_job_id,
+                job["project_id"],
+                job["page_type_model"],
+                job["parser_model"],
+                options,
+                worker_id=worker_id,
+            )
+        )
+        heartbeat = asyncio.ensure_future(self._heartbeat(db, sync_job_id, worker_id, task))
+        key = (database_name, sync_job_id)
+        self.running[key] = task
+
+        def _done(_):
+            heartbeat.cancel()
+            self.running.pop(key, None)
+            self._wake.set()
+
+        task.add_done_callback(_done)
+
+    async def _heartbeat(self, db, sync_job_id: str, worker_id: str, task: asyncio.Task) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            still_running = await db.execute_write_fn(
+                lambda conn: record_heartbeat(conn, sync_job_id, worker_id)
+            )
+            if not still_running:
+                # Paused or cancelled, possibly by another process, or
+                # requeued and claimed by another run
+                task.cancel()
+                return
+
+
+_schedulers: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def get_scheduler(datasette) -> JobScheduler:
+    """
+    The job scheduler for a Datasette instance, configured by instance-level
+    plugin config:
+
+        plugins:
+          datasette-ca460:
+            max_concurrent_jobs: 2
+    """
+    if datasette not in _schedulers:
+        config = datasette.plugin_config(PLUGIN_NAME) or {}
+        _schedulers[datasette] = JobScheduler(
+            datasette,
+            _positive_int(
+                "max_concurrent_jobs",
+                config.get("max_concurrent_jobs", DEFAULT_MAX_CONCURRENT_JOBS),
+            ),
+        )
+    return _schedulers[datasette]
+
+
+async def transition_job(datasette, database_name: str, sync_job_id: str, action: str) -> Optional[str]:
+    """
+    Pause, resume or cancel a job. Returns its new status, or None if there
+    is no such job. Raises JobStateError if the job's status doesn't allow it.
+    """
+    allowed, status = TRANSITIONS[action]
+    db = datasette.get_database(database_name)
+
+    def _transition(conn):
+        row = conn.execute(
+            "SELECT status, completed_at FROM sync_jobs WHERE id = ?", (sync_job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[0] not in allowed:
+            raise JobStateError(f"Can't {action} a sync job that is {row[0]}")
+        conn.execute(
+            """UPDATE sync_jobs
+            SET status = ?, worker_id = NULL,
+                completed_at = CASE WHEN ? = 'cancelled' THEN CURRENT_TIMESTAMP END
+            WHERE id = ?""",
+            (status, status, sync_job_id)
+        )
+        _release_work_units(conn, sync_job_id)
+        conn.commit()
+        return conn.execute(
+            "SELECT completed_at FROM sync_jobs WHERE id = ?", (sync_job_id,)
+        ).fetchone()
+
+    row = await db.execute_write_fn(_transition)
+    if row is None:
+        return None
+    completed_at = row[0]
+
+    scheduler = get_scheduler(datasette)
+    scheduler.stop(database_name, sync_job_id)
+    messages = {"paused": "Sync paused", "queued": "Sync resumed", "cancelled": "Sync cancelled"}
+    await log_event(db, sync_job_id, "info", messages[status])
+    broker_for(db).publish_job(
+        sync_job_id, {"status": status, "error": None, "completed_at": completed_at}
+    )
+    if status == "queued":
+        scheduler.wake()
+    return status
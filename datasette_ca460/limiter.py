@@ -0,0 +1,272 @@
+import asyncio
+import re
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+from .fetch import RETRY_STATUS_CODES
+
+# Error messages that mean the provider is rate limiting or overloaded
+THROTTLED_PATTERN = re.compile(
+    r"\b429\b|rate.?limit|too many requests|resource.?exhausted|quota|overloaded",
+    re.IGNORECASE,
+)
+# Error messages that mean a retry may well succeed
+TRANSIENT_PATTERN = re.compile(
+    r"\b(500|502|503|504)\b|timed? ?out|temporarily|unavailable|connection (reset|refused|error)",
+    re.IGNORECASE,
+)
+
+
+def _status_code(ex: BaseException) -> Optional[int]:
+    status_code = getattr(ex, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(ex, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def is_throttled(ex: BaseException) -> bool:
+    """Whether an error from a model means it is rate limiting us."""
+    return _status_code(ex) == 429 or bool(THROTTLED_PATTERN.search(str(ex)))
+
+
+def is_transient(ex: BaseException) -> bool:
+    """
+    Whether an error from a model is worth retrying. Model plugins raise
+    their own exception types, so this goes by status code where there is
+    one and by the message where there isn't.
+    """
+    if isinstance(ex, (httpx.TransportError, asyncio.TimeoutError, ConnectionError, TimeoutError)):
+        return True
+    if _status_code(ex) in RETRY_STATUS_CODES:
+        return True
+    return is_throttled(ex) or bool(TRANSIENT_PATTERN.search(str(ex)))
+
+
+class TokenBucket:
+    """
+    Allows `per_minute` units a minute, refilled continuously. The level may
+    go below zero when units are taken after the fact (tokens are only known
+    once a response arrives), in which case nothing more is allowed until it
+    has refilled.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.per_minute, self.level + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float = 1) -> float:
+        """Seconds until `amount` units are available."""
+        self._refill()
+        # A bucket in debt only needs to climb back above zero
+        needed = min(amount, self.per_minute) if self.level >= 0 else 1e-9
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) * 60 / self.per_minute
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+
+class ModelLimiter:
+    """
+    Caps the prompts in flight against one model, adapting to how it copes.
+
+    Concurrency follows AIMD (additive increase, multiplicative decrease),
+    as TCP does: every successful prompt raises the limit by 1/limit, so it
+    grows by about one per round of prompts, up to `max_concurrency`, and
+    every throttled or failed prompt halves it. Optional token buckets also
+    hold prompts back to a number of requests and of tokens (input plus
+    output, from each response's usage) per minute.
+
+    There is one limiter per model for the whole process (see
+    get_model_limiter), so the limits hold across every running job.
+    Listeners added with add_listener() are called whenever concurrency
+    is decreased.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        max_concurrency: int,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        on_decrease: Optional[Callable[["ModelLimiter"], Awaitable[None]]] = None,
+    ):
+        self.model_id = model_id
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.succeeded = 0
+        self.failed = 0
+        self.throttled = 0
+        self._listeners: list[Callable[["ModelLimiter"], Awaitable[None]]] = []
+        if on_decrease is not None:
+            self._listeners.append(on_decrease)
+        self._condition = asyncio.Condition()
+
+    def configure(
+        self,
+        max_concurrency: int,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ) -> None:
+        """
+        Apply new caps, keeping the current concurrency if it is within them.
+        Token buckets are only replaced if their rate changes.
+        """
+        self.max_concurrency = max_concurrency
+        self.limit = min(self.limit, float(max_concurrency))
+        if (self.requests.per_minute if self.requests else None) != (requests_per_minute or None):
+            self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        if (self.tokens.per_minute if self.tokens else None) != (tokens_per_minute or None):
+            self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def add_listener(self, on_decrease: Callable[["ModelLimiter"], Awaitable[None]]) -> None:
+        self._listeners.append(on_decrease)
+
+    def remove_listener(self, on_decrease: Callable[["ModelLimiter"], Awaitable[None]]) -> None:
+        if on_decrease in self._listeners:
+            self._listeners.remove(on_decrease)
+
+    @property
+    def concurrency(self) -> int:
+        return max(1, int(self.limit))
+
+    def state(self) -> dict:
+        state = {
+            "model": self.model_id,
+            "concurrency": self.concurrency,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "throttled": self.throttled,
+        }
+        if self.requests is not None:
+            state["requests_available"] = max(0, int(self.requests.level))
+        if self.tokens is not None:
+            state["tokens_available"] = int(self.tokens.level)
+        return state
+
+    def describe(self) -> str:
+        state = self.state()
+        return (
+            f"Model {self.model_id}: concurrency {state['concurrency']}/{state['max_concurrency']}, "
+            f"{state['succeeded']} prompts succeeded, {state['failed']} failed "
+            f"({state['throttled']} throttled)"
+        )
+
+    def _wait_time(self) -> Optional[float]:
+        """
+        0 if a prompt can start now, seconds until a token bucket allows
+        one, or None to wait for a prompt in flight to finish.
+        """
+        if self.in_flight >= self.concurrency:
+            return None
+        return max(
+            self.requests.wait_time() if self.requests else 0.0,
+            self.tokens.wait_time() if self.tokens else 0.0,
+        )
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            while True:
+                wait = self._wait_time()
+                if wait == 0:
+                    self.in_flight += 1
+                    if self.requests is not None:
+                        self.requests.take(1)
+                    return
+                try:
+                    await asyncio.wait_for(self._condition.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, ok: Optional[bool], tokens: int = 0, throttled: bool = False) -> None:
+        """
+        Give back a slot. `ok` is whether the prompt succeeded, or None if
+        it was cancelled and says nothing about the model.
+        """
+        decreased = False
+        async with self._condition:
+            self.in_flight -= 1
+            if self.tokens is not None and tokens:
+                self.tokens.take(tokens)
+            if ok:
+                self.succeeded += 1
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            elif ok is False:
+                self.failed += 1
+                self.throttled += throttled
+                before = self.concurrency
+                self.limit = max(1.0, self.limit / 2)
+                decreased = self.concurrency < before
+            self._condition.notify_all()
+        if decreased:
+            for on_decrease in list(self._listeners):
+                await on_decrease(self)
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Hold a slot for one prompt. Failures (and whether they were
+        throttling) are recorded from the exception; on success, call the
+        yielded function with the response's token count.
+        """
+        await self.acquire()
+        used = {"tokens": 0}
+
+        def record(tokens: int) -> None:
+            used["tokens"] = tokens
+
+        try:
+            yield record
+        except Exception as ex:
+            await self.release(False, throttled=is_throttled(ex))
+            raise
+        except BaseException:
+            await self.release(None)
+            raise
+        else:
+            await self.release(True, used["tokens"])
+
+
+_limiters: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def get_model_limiter(
+    datasette,
+    model_id: str,
+    max_concurrency: int,
+    requests_per_minute: Optional[int] = None,
+    tokens_per_minute: Optional[int] = None,
+) -> ModelLimiter:
+    """
+    The process-wide limiter for a model on a Datasette instance, shared by
+    every sync job. Its caps are set to the ones given, so the settings of
+    the job that most recently started using a model apply.
+    """
+    limiters = _limiters.setdefault(datasette, {})
+    if model_id not in limiters:
+        limiters[model_id] = ModelLimiter(
+            model_id,
+            max_concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+        )
+    else:
+        limiters[model_id].configure(max_concurrency, requests_per_minute, tokens_per_minute)
+    return limiters[model_id]
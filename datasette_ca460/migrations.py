@@ -0,0 +1,515 @@
+from pathlib import Path
+from typing import Callable, NamedTuple
+import sqlite3
+import weakref
+
+from .options import PLUGIN_NAME
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[sqlite3.Connection], None]
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, name: str):
+    """Register a forward migration. Versions must be added in increasing order."""
+    def decorator(fn):
+        assert not MIGRATIONS or MIGRATIONS[-1].version < version, "migrations out of order"
+        MIGRATIONS.append(Migration(version, name, fn))
+        return fn
+    return decorator
+
+
+@migration(1, "initial_schema")
+def _initial_schema(conn):
+    # schema.sql is the original schema, written to be re-runnable against
+    # databases created before migrations were tracked
+    conn.executescript((Path(__file__).parent / "schema.sql").read_text())
+
+
+@migration(2, "indexes_and_unique_constraints")
+def _indexes_and_unique_constraints(conn):
+    # Earlier versions used SELECT-then-INSERT, so concurrent syncs could
+    # leave duplicate rows behind. Keep the oldest copy of each before
+    # adding unique indexes. The transaction is committed by migrate(),
+    # along with the row recording this version.
+    conn.executescript("""
+    BEGIN;
+
+    CREATE TEMP TABLE _duplicate_pages AS
+      SELECT p.id AS id, keep.id AS keep_id
+      FROM pages p
+      JOIN (
+        SELECT MIN(id) AS id, document_id, page_number
+        FROM pages
+        GROUP BY document_id, page_number
+      ) keep ON keep.document_id IS p.document_id AND keep.page_number IS p.page_number
+      WHERE p.id != keep.id;
+
+    UPDATE page_type_predictions
+      SET page_id = (SELECT keep_id FROM _duplicate_pages WHERE id = page_type_predictions.page_id)
+      WHERE page_id IN (SELECT id FROM _duplicate_pages);
+    UPDATE page_parsed
+      SET page_id = (SELECT keep_id FROM _duplicate_pages WHERE id = page_parsed.page_id)
+      WHERE page_id IN (SELECT id FROM _duplicate_pages);
+    DELETE FROM pages WHERE id IN (SELECT id FROM _duplicate_pages);
+    DROP TABLE _duplicate_pages;
+
+    DELETE FROM page_type_predictions WHERE id NOT IN (
+      SELECT MIN(id) FROM page_type_predictions GROUP BY page_id, model
+    );
+
+    CREATE TEMP TABLE _duplicate_page_parsed AS
+      SELECT id FROM page_parsed WHERE id NOT IN (
+        SELECT MIN(id) FROM page_parsed GROUP BY page_id, page_type, model
+      );
+    DELETE FROM schedule_a_itemizations
+      WHERE page_parsed_id IN (SELECT id FROM _duplicate_page_parsed);
+    DELETE FROM summary_pages
+      WHERE page_parsed_id IN (SELECT id FROM _duplicate_page_parsed);
+    DELETE FROM page_parsed WHERE id IN (SELECT id FROM _duplicate_page_parsed);
+    DROP TABLE _duplicate_page_parsed;
+
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_pages_document_page
+      ON pages(document_id, page_number);
+
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_page_type_predictions_page_model
+      ON page_type_predictions(page_id, model);
+    -- Covers "pages predicted as X by model Y"
+    CREATE INDEX IF NOT EXISTS idx_page_type_predictions_model_type
+      ON page_type_predictions(model, predicted_page_type, page_id);
+
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_page_parsed_page_type_model
+      ON page_parsed(page_id, page_type, model);
+
+    CREATE INDEX IF NOT EXISTS idx_sync_events_sync_job
+      ON sync_events(sync_job_id, id);
+
+    CREATE INDEX IF NOT EXISTS idx_schedule_a_itemizations_page_parsed
+      ON schedule_a_itemizations(page_parsed_id);
+    CREATE INDEX IF NOT EXISTS idx_summary_pages_page_parsed
+      ON summary_pages(page_parsed_id);
+    """)
+
+
+@migration(3, "durable_sync_jobs")
+def _durable_sync_jobs(conn):
+    # Jobs are now queued and run by a scheduler, which needs each job's
+    # options to (re)start it, and heartbeats to spot jobs orphaned by a
+    # restart. Work units record which documents a job has finished so an
+    # interrupted job can resume where it left off.
+    conn.executescript("""
+    BEGIN;
+
+    ALTER TABLE sync_jobs ADD COLUMN options JSON;
+    ALTER TABLE sync_jobs ADD COLUMN worker_id TEXT;
+    ALTER TABLE sync_jobs ADD COLUMN heartbeat_at TIMESTAMP;
+
+    CREATE INDEX IF NOT EXISTS idx_sync_jobs_status
+      ON sync_jobs(status, started_at);
+
+    CREATE TABLE IF NOT EXISTS sync_work_units(
+      sync_job_id TEXT REFERENCES sync_jobs(id),
+      document_id INTEGER REFERENCES documents(id),
+      status TEXT DEFAULT 'pending',
+      lease_owner TEXT,
+      lease_expires_at TIMESTAMP,
+      completed_at TIMESTAMP,
+      PRIMARY KEY (sync_job_id, document_id)
+    );
+    """)
+
+
+@migration(4, "image_profiles")
+def _image_profiles(conn):
+    # The image profile (size, scaling, format) used for each prompt, stored
+    # next to model_usage so cost and latency can be compared across them
+    conn.executescript("""
+    BEGIN;
+
+    ALTER TABLE page_type_predictions ADD COLUMN image_profile JSON;
+    ALTER TABLE page_parsed ADD COLUMN image_profile JSON;
+    """)
+
+
+@migration(5, "local_page_classifiers")
+def _local_page_classifiers(conn):
+    # Predictions can now come from a local classifier rather than the
+    # model. Templates are pages the model labelled, for classifiers to
+    # learn from.
+    conn.executescript("""
+    BEGIN;
+
+    ALTER TABLE page_type_predictions ADD COLUMN classifier TEXT;
+    ALTER TABLE page_type_predictions ADD COLUMN confidence REAL;
+    UPDATE page_type_predictions SET classifier = 'llm';
+
+    CREATE TABLE IF NOT EXISTS page_type_templates(
+      page_id INTEGER REFERENCES pages(id),
+      model TEXT,
+      page_type TEXT,
+      header_hash TEXT,
+      PRIMARY KEY (page_id, model)
+    );
+    """)
+
+
+@migration(6, "page_fingerprints")
+def _page_fingerprints(conn):
+    # Fingerprints let duplicate pages (amended filings, re-uploads) reuse
+    # the predictions and parses of pages already seen
+    conn.executescript("""
+    BEGIN;
+
+    ALTER TABLE pages ADD COLUMN content_hash TEXT;
+    ALTER TABLE pages ADD COLUMN phash TEXT;
+    CREATE INDEX IF NOT EXISTS idx_pages_content_hash ON pages(content_hash);
+
+    ALTER TABLE page_parsed ADD COLUMN reused_from INTEGER REFERENCES page_parsed(id);
+    """)
+
+
+@migration(7, "sync_batches")
+def _sync_batches(conn):
+    # Batches submitted to a batch backend, so an interrupted job polls the
+    # batch it already submitted instead of submitting it again
+    conn.executescript("""
+    BEGIN;
+
+    CREATE TABLE IF NOT EXISTS sync_batches(
+      id TEXT PRIMARY KEY,
+      sync_job_id TEXT REFERENCES sync_jobs(id),
+      backend TEXT,
+      -- 'page_type' or 'parse'
+      stage TEXT,
+      -- 'submitted', 'completed', 'ingested' or 'failed'
+      status TEXT DEFAULT 'submitted',
+      request_count INTEGER,
+      submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+      completed_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_sync_batches_sync_job_id
+      ON sync_batches(sync_job_id, stage);
+    """)
+
+
+@migration(8, "page_failures")
+def _page_failures(conn):
+    # Pages that couldn't be classified or parsed, recorded rather than
+    # failing the whole sync job
+    conn.executescript("""
+    BEGIN;
+
+    CREATE TABLE IF NOT EXISTS page_failures(
+      id INTEGER PRIMARY KEY,
+      sync_job_id TEXT REFERENCES sync_jobs(id),
+      page_id INTEGER REFERENCES pages(id),
+      -- 'page_type' or 'parse'
+      stage TEXT,
+      model TEXT,
+      error TEXT,
+      failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_page_failures_sync_job_id
+      ON page_failures(sync_job_id);
+    """)
+
+
+@migration(9, "document_versions")
+def _document_versions(conn):
+    # Documents remember the DocumentCloud version (updated_at) their
+    # metadata is from, and which versions have been completely synced with
+    # which models, so resyncs can skip documents that haven't changed
+    conn.executescript("""
+    BEGIN;
+
+    ALTER TABLE documents ADD COLUMN title TEXT;
+    ALTER TABLE documents ADD COLUMN updated_at TEXT;
+
+    CREATE TABLE IF NOT EXISTS document_syncs(
+      document_id INTEGER REFERENCES documents(id),
+      page_type_model TEXT,
+      parser_model TEXT,
+      -- documents.updated_at when every page was classified and parsed
+      updated_at TEXT,
+      synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+      PRIMARY KEY (document_id, page_type_model, parser_model)
+    );
+    """)
+
+
+@migration(10, "project_documents")
+def _project_documents(conn):
+    # The documents each project had when it was last listed, so a sync can
+    # tell which were added, changed or removed since. A document's file
+    # hash changes when it is re-uploaded, which makes its pages stale.
+    conn.executescript("""
+    BEGIN;
+
+    ALTER TABLE documents ADD COLUMN file_hash TEXT;
+
+    CREATE TABLE IF NOT EXISTS project_documents(
+      project_id INTEGER,
+      document_id INTEGER REFERENCES documents(id),
+      updated_at TEXT,
+      page_count INTEGER,
+      file_hash TEXT,
+      first_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+      last_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+      -- Set when a listing no longer includes the document
+      removed_at TIMESTAMP,
+      PRIMARY KEY (project_id, document_id)
+    );
+    """)
+
+
+# Recomputes document_stats rows from document_parse_counts, for the
+# documents selected by the subquery that replaces :documents
+_REFRESH_DOCUMENT_STATS = """
+    INSERT INTO document_stats (
+      document_id, title, page_count, model_count, parsed_pages,
+      summary_pages, schedule_a_pages, last_parsed_at
+    )
+    SELECT
+      d.id,
+      COALESCE(d.title, d.data->>'title'),
+      d.page_count,
+      (SELECT COUNT(DISTINCT model) FROM document_parse_counts WHERE document_id = d.id),
+      (SELECT COALESCE(SUM(pages), 0) FROM document_parse_counts WHERE document_id = d.id),
+      (SELECT COALESCE(MAX(pages), 0) FROM document_parse_counts
+        WHERE document_id = d.id AND page_type = 'campaign_disclosure_summary_page'),
+      (SELECT COALESCE(MAX(pages), 0) FROM document_parse_counts
+        WHERE document_id = d.id AND page_type = 'schedule_a'),
+      (SELECT MAX(last_parsed_at) FROM document_parse_counts WHERE document_id = d.id)
+    FROM documents d
+    WHERE d.id IN (:documents)
+    ON CONFLICT (document_id) DO UPDATE SET
+      title = excluded.title,
+      page_count = excluded.page_count,
+      model_count = excluded.model_count,
+      parsed_pages = excluded.parsed_pages,
+      summary_pages = excluded.summary_pages,
+      schedule_a_pages = excluded.schedule_a_pages,
+      last_parsed_at = excluded.last_parsed_at;
+    -- Only documents with parsed pages are listed
+    DELETE FROM document_stats WHERE document_id IN (:documents) AND model_count = 0;
+"""
+
+
+@migration(11, "document_stats")
+def _document_stats(conn):
+    # A summary row per parsed document for /api/documents, kept up to date
+    # by triggers so listing documents doesn't join every parsed page.
+    # document_parse_counts counts each document's parses by model and page
+    # type, which lets the triggers recompute a document's stats from a
+    # handful of rows.
+    page_document = "SELECT document_id FROM pages WHERE id = {}.page_id"
+    conn.executescript(f"""
+    BEGIN;
+
+    CREATE TABLE IF NOT EXISTS document_parse_counts(
+      document_id INTEGER REFERENCES documents(id),
+      model TEXT,
+      page_type TEXT,
+      pages INTEGER NOT NULL,
+      last_parsed_at TIMESTAMP,
+      PRIMARY KEY (document_id, model, page_type)
+    );
+
+    CREATE TABLE IF NOT EXISTS document_stats(
+      document_id INTEGER PRIMARY KEY REFERENCES documents(id),
+      title TEXT,
+      page_count INTEGER,
+      -- Parser models with at least one parsed page
+      model_count INTEGER,
+      -- Rows in page_parsed, across every model
+      parsed_pages INTEGER,
+      -- Pages of each type parsed by the model that parsed the most of them
+      summary_pages INTEGER,
+      schedule_a_pages INTEGER,
+      last_parsed_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_document_parse_counts_model
+      ON document_parse_counts(model, document_id);
+
+    INSERT INTO document_parse_counts (document_id, model, page_type, pages, last_parsed_at)
+      SELECT p.document_id, pp.model, pp.page_type, COUNT(*), MAX(pp.created_at)
+      FROM page_parsed pp JOIN pages p ON p.id = pp.page_id
+      GROUP BY p.document_id, pp.model, pp.page_type;
+    {_REFRESH_DOCUMENT_STATS.replace(":documents", "SELECT document_id FROM document_parse_counts")}
+
+    CREATE TRIGGER IF NOT EXISTS page_parsed_document_stats_insert
+    AFTER INSERT ON page_parsed
+    BEGIN
+      INSERT INTO document_parse_counts (document_id, model, page_type, pages, last_parsed_at)
+        SELECT document_id, NEW.model, NEW.page_type, 1, NEW.created_at
+        FROM pages WHERE id = NEW.page_id
+        ON CONFLICT (document_id, model, page_type) DO UPDATE SET
+          pages = pages + 1,
+          last_parsed_at = MAX(COALESCE(last_parsed_at, ''), excluded.last_parsed_at);
+      {_REFRESH_DOCUMENT_STATS.replace(":documents", page_document.format("NEW"))}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS page_parsed_document_stats_delete
+    AFTER DELETE ON page_parsed
+    BEGIN
+      UPDATE document_parse_counts SET pages = pages - 1
+        WHERE document_id = ({page_document.format("OLD")})
+        AND model = OLD.model AND page_type = OLD.page_type;
+      DELETE FROM document_parse_counts
+        WHERE document_id = ({page_document.format("OLD")}) AND pages <= 0;
+      {_REFRESH_DOCUMENT_STATS.replace(":documents", page_document.format("OLD"))}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS documents_document_stats_update
+    AFTER UPDATE OF title, page_count, data ON documents
+    BEGIN
+      UPDATE document_stats SET
+        title = COALESCE(NEW.title, NEW.data->>'title'),
+        page_count = NEW.page_count
+      WHERE document_id = NEW.id;
+    END;
+    """)
+
+
+@migration(12, "data_version")
+def _data_version(conn):
+    # A counter bumped by every write that changes what the read-only API
+    # endpoints return, used for their ETags and response cache keys.
+    # Parses and documents are all they read: pages only matter through
+    # their parses, which are deleted first.
+    bump = """
+      UPDATE ca460_data_version
+      SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+      WHERE id = 1;
+    """
+    conn.executescript(f"""
+    BEGIN;
+
+    CREATE TABLE IF NOT EXISTS ca460_data_version(
+      id INTEGER PRIMARY KEY CHECK (id = 1),
+      version INTEGER NOT NULL,
+      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    INSERT OR IGNORE INTO ca460_data_version (id, version) VALUES (1, 1);
+
+    CREATE TRIGGER IF NOT EXISTS page_parsed_data_version_insert
+    AFTER INSERT ON page_parsed BEGIN {bump} END;
+    CREATE TRIGGER IF NOT EXISTS page_parsed_data_version_delete
+    AFTER DELETE ON page_parsed BEGIN {bump} END;
+    CREATE TRIGGER IF NOT EXISTS documents_data_version_insert
+    AFTER INSERT ON documents BEGIN {bump} END;
+    CREATE TRIGGER IF NOT EXISTS documents_data_version_update
+    AFTER UPDATE ON documents BEGIN {bump} END;
+    CREATE TRIGGER IF NOT EXISTS documents_data_version_delete
+    AFTER DELETE ON documents BEGIN {bump} END;
+    """)
+
+
+@migration(13, "drop_work_unit_lease_expiry")
+def _drop_work_unit_lease_expiry(conn):
+    # Lease expiry times were renewed by each heartbeat but never read: a
+    # job's heartbeat is what shows its worker has gone, and requeueing the
+    # job releases its leases.
+    conn.executescript("""
+    BEGIN;
+
+    ALTER TABLE sync_work_units DROP COLUMN lease_expires_at;
+    """)
+
+
+def applied_version(conn) -> int:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ca460_schema_migrations(
+          version INTEGER PRIMARY KEY,
+          name TEXT,
+          applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    return conn.execute(
+        "SELECT COALESCE(MAX(version), 0) FROM ca460_schema_migrations"
+    ).fetchone()[0]
+
+
+def migrate(conn) -> list[str]:
+    """
+    Bring a database up to the latest schema version, applying each pending
+    migration in order. Returns the names of the migrations applied.
+    """
+    current = applied_version(conn)
+    applied = []
+    for m in MIGRATIONS:
+        if m.version <= current:
+            continue
+        try:
+            m.apply(conn)
+            conn.execute(
+                "INSERT INTO ca460_schema_migrations (version, name) VALUES (?, ?)",
+                (m.version, m.name)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(m.name)
+    return applied
+
+
+# Databases already migrated to the latest version by this process
+_migrated: "weakref.WeakSet" = weakref.WeakSet()
+
+
+async def ensure_schema(db) -> None:
+    """
+    Make sure db is on the latest schema version.
+
+    Migrations run on the write thread the first time this is called for a
+    database; after that it returns immediately, without queueing anything
+    behind other writes.
+    """
+    if db in _migrated:
+        return
+    await db.execute_write_fn(migrate, transaction=False)
+    config = db.ds.plugin_config(PLUGIN_NAME) or {}
+    if config.get("wal", True):
+        await db.execute_write_fn(enable_wal, transaction=False)
+    _migrated.add(db)
+
+
+def enable_wal(conn) -> str:
+    """
+    Switch the database to write-ahead logging, so reads on Datasette's
+    read connections don't wait for syncs writing on the write thread, and
+    commits only need to sync the log. Returns the journal mode in use,
+    which stays "memory" for in-memory databases.
+    """
+    mode = conn.execute("PRAGMA journal_mode = wal").fetchone()[0]
+    if mode == "wal":
+        # Per connection: this is Datasette's long-lived write connection.
+        # In WAL mode NORMAL can lose the last commits on power loss, but
+        # never corrupts the database.
+        conn.execute("PRAGMA synchronous = normal")
+    return mode
+
+
+def is_migrated(db) -> bool:
+    return db in _migrated
+
+
+async def migrate_databases(datasette) -> None:
+    """
+    Upgrade databases at startup: those listed in the plugin's `databases`
+    setting, plus any that already hold ca460 tables. Other databases are
+    left untouched until a sync is first started against them.
+    """
+    config = datasette.plugin_config(PLUGIN_NAME) or {}
+    configured = set(config.get("databases") or [])
+    for name, db in list(datasette.databases.items()):
+        if not db.is_mutable:
+            continue
+        if name in configured or await db.table_exists("sync_jobs"):
+            await ensure_schema(db)
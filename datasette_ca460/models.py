@@ -0,0 +1,103 @@
+import hashlib
+import json
+import threading
+import weakref
+from typing import Any, Optional
+
+import llm
+from datasette_llm_accountant import LlmWrapper
+
+# Files in llm's user directory that change which models resolve, or how
+_LLM_CONFIG_FILES = ("keys.json", "extra-openai-models.yaml", "default_model.txt")
+
+
+def config_version(datasette) -> str:
+    """
+    Changes whenever Datasette's config or llm's keys and model config do,
+    i.e. whenever a model could resolve differently.
+    """
+    parts = [json.dumps(datasette.config or {}, sort_keys=True, default=str)]
+    user_dir = llm.user_dir()
+    for name in _LLM_CONFIG_FILES:
+        try:
+            stat = (user_dir / name).stat()
+        except OSError:
+            parts.append(f"{name}:-")
+        else:
+            parts.append(f"{name}:{stat.st_mtime_ns}:{stat.st_size}")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+class ModelCache:
+    """
+    Model handles resolved through LlmWrapper, shared by every sync job and
+    request in the process.
+
+    Resolving a model looks it up in llm's plugin registry and sets up its
+    client, so doing it once per model, rather than once per page, saves
+    that work and lets the client reuse its HTTP connections. The cache is
+    emptied when config_version() changes.
+    """
+
+    def __init__(self, datasette):
+        self.datasette = datasette
+        self._version: Optional[str] = None
+        self._wrapper: Optional[LlmWrapper] = None
+        self._models: dict[str, Any] = {}
+        self._model_ids: Optional[list[str]] = None
+        self._lock = threading.Lock()
+
+    def _current(self) -> LlmWrapper:
+        version = config_version(self.datasette)
+        if version != self._version or self._wrapper is None:
+            self._version = version
+            self._wrapper = LlmWrapper(self.datasette)
+            self._models = {}
+            self._model_ids = None
+        return self._wrapper
+
+    def get_async_model(self, model_id: str):
+        with self._lock:
+            wrapper = self._current()
+            if model_id not in self._models:
+                self._models[model_id] = wrapper.get_async_model(model_id)
+            return self._models[model_id]
+
+    def model_ids(self) -> list[str]:
+        """IDs of the async models available, as listed by /api/models."""
+        with self._lock:
+            wrapper = self._current()
+            if self._model_ids is None:
+                self._model_ids = [model.model_id for model in wrapper.get_async_models()]
+            return self._model_ids
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._version = None
+            self._wrapper = None
+
+
+_caches: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def get_model_cache(datasette) -> ModelCache:
+    """The process-wide model cache for a Datasette instance."""
+    if datasette not in _caches:
+        _caches[datasette] = ModelCache(datasette)
+    return _caches[datasette]
+
+
+class JobModels:
+    """
+    The models used by one sync job, each resolved from the process-wide
+    cache the first time it is needed, so pages don't check the config.
+    """
+
+    def __init__(self, datasette):
+        self._cache = get_model_cache(datasette)
+        self._models: dict[str, Any] = {}
+
+    def get_async_model(self, model_id: str):
+        if model_id not in self._models:
+            self._models[model_id] = self._cache.get_async_model(model_id)
+        return self._models[model_id]
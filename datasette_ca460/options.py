@@ -0,0 +1,330 @@
+from dataclasses import asdict, dataclass, field, fields, replace
+from typing import Optional
+
+PLUGIN_NAME = "datasette-ca460"
+
+
+class InvalidOptionError(ValueError):
+    """Raised when a plugin config or per-job sync option is invalid."""
+
+
+# DocumentCloud page image sizes, smallest first
+IMAGE_SIZES = ("thumbnail", "small", "normal", "large", "xlarge")
+IMAGE_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+@dataclass(frozen=True)
+class ImageProfile:
+    """
+    How page images are prepared before being attached to a prompt.
+
+    Smaller, grayscale images mean fewer bytes uploaded and fewer image
+    tokens billed; the defaults send DocumentCloud's largest image as-is.
+    """
+    # DocumentCloud size variant to download
+    size: str = "xlarge"
+    # Scale images down so their longest side is at most this many pixels
+    max_long_edge: Optional[int] = None
+    grayscale: bool = False
+    format: str = "jpeg"
+    quality: int = 95
+
+    @property
+    def mime_type(self) -> str:
+        return IMAGE_FORMATS[self.format]
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class SyncOptions:
+    """
+    Tunables for a sync job.
+
+    Defaults can be set in the plugin configuration for a database, e.g.
+
+        plugins:
+          datasette-ca460:
+            max_concurrent_pages: 16
+            model_concurrency:
+              llama-server: 4
+              gemini-3-flash-preview: 32
+
+    and individual sync jobs can override them in the POST body.
+    """
+    # How many pages are downloaded and classified (and, separately, parsed)
+    # at the same time
+    max_concurrent_pages: int = 4
+    # Capacity of each queue between sync pipeline stages
+    queue_size: int = 32
+    # Per-model cap on in-flight LLM prompts, keyed by model ID
+    model_concurrency: dict[str, int] = field(default_factory=dict)
+    # Cap for models not listed in model_concurrency
+    default_model_concurrency: int = 4
+    # Per-model request and token (input plus output) rate limits, keyed
+    # by model ID; models not listed are only limited by concurrency
+    model_requests_per_minute: dict[str, int] = field(default_factory=dict)
+    model_tokens_per_minute: dict[str, int] = field(default_factory=dict)
+    # Retries for prompts that fail with rate limiting or transient errors
+    llm_retries: int = 3
+    # Connection pool for DocumentCloud asset downloads
+    http2: bool = True
+    http_max_connections: int = 20
+    http_max_keepalive_connections: int = 10
+    # Seconds before a download times out
+    http_timeout: float = 30.0
+    # Retries for 429s, 5xx responses and connection errors
+    http_retries: int = 3
+    # Predictions, parsed pages and events are written in batches of up to
+    # this many rows, or after this many milliseconds, whichever comes first
+    write_batch_size: int = 500
+    write_batch_delay_ms: int = 250
+    # Per-model image profiles, keyed by model ID
+    image_profiles: dict[str, ImageProfile] = field(default_factory=dict)
+    # Profile for models not listed in image_profiles
+    default_image_profile: ImageProfile = field(default_factory=ImageProfile)
+    # Local classifiers tried, in order, before prompting the page type
+    # model (see classifiers.py). Off by default, as a page's predicted type
+    # decides whether and how it is parsed: the empty list prompts the
+    # model for every page.
+    page_classifiers: list[str] = field(default_factory=list)
+    # Local predictions less confident than this fall back to the model
+    classifier_min_confidence: float = 0.8
+    # Per-model number of Schedule A pages of a document parsed with a
+    # single prompt, keyed by model ID
+    schedule_a_batch_size: dict[str, int] = field(default_factory=dict)
+    # Batch size for models not listed in schedule_a_batch_size; 1 parses
+    # each page with its own prompt
+    default_schedule_a_batch_size: int = 1
+    # Skip documents that haven't changed since they were last synced with
+    # the same models; off re-checks every page of every document
+    incremental: bool = True
+    # Send prompts through this batch backend (see batch_api.py) instead of
+    # one at a time, for backfills that don't need results straight away
+    batch_backend: Optional[str] = None
+    # Seconds between checks on a submitted batch
+    batch_poll_seconds: float = 60.0
+
+    def concurrency_for_model(self, model_id: str) -> int:
+        return self.model_concurrency.get(model_id, self.default_model_concurrency)
+
+    def image_profile_for_model(self, model_id: str) -> ImageProfile:
+        return self.image_profiles.get(model_id, self.default_image_profile)
+
+    def schedule_a_batch_size_for_model(self, model_id: str) -> int:
+        return self.schedule_a_batch_size.get(model_id, self.default_schedule_a_batch_size)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def _positive_int(name: str, value) -> int:
+    if isinstance(value, bool):
+        raise InvalidOptionError(f"{name} must be a positive integer")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise InvalidOptionError(f"{name} must be a positive integer")
+    if value < 1:
+        raise InvalidOptionError(f"{name} must be a positive integer")
+    return value
+
+
+def _non_negative_int(name: str, value) -> int:
+    if isinstance(value, bool):
+        raise InvalidOptionError(f"{name} must be a non-negative integer")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise InvalidOptionError(f"{name} must be a non-negative integer")
+    if value < 0:
+        raise InvalidOptionError(f"{name} must be a non-negative integer")
+    return value
+
+
+def _positive_number(name: str, value) -> float:
+    if isinstance(value, bool):
+        raise InvalidOptionError(f"{name} must be a positive number")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise InvalidOptionError(f"{name} must be a positive number")
+    if value <= 0:
+        raise InvalidOptionError(f"{name} must be a positive number")
+    return value
+
+
+def _bool(name: str, value) -> bool:
+    if not isinstance(value, bool):
+        raise InvalidOptionError(f"{name} must be true or false")
+    return value
+
+
+def _image_profile(name: str, value) -> ImageProfile:
+    if not isinstance(value, dict):
+        raise InvalidOptionError(f"{name} must be an object")
+    unknown = set(value) - {f.name for f in fields(ImageProfile)}
+    if unknown:
+        raise InvalidOptionError(f"{name} has unknown keys: {', '.join(sorted(unknown))}")
+    profile = ImageProfile()
+    if "size" in value:
+        if value["size"] not in IMAGE_SIZES:
+            raise InvalidOptionError(f"{name}.size must be one of {', '.join(IMAGE_SIZES)}")
+        profile = replace(profile, size=value["size"])
+    if value.get("max_long_edge") is not None:
+        profile = replace(
+            profile,
+            max_long_edge=_positive_int(f"{name}.max_long_edge", value["max_long_edge"]),
+        )
+    if "grayscale" in value:
+        profile = replace(profile, grayscale=_bool(f"{name}.grayscale", value["grayscale"]))
+    if "format" in value:
+        if value["format"] not in IMAGE_FORMATS:
+            raise InvalidOptionError(f"{name}.format must be one of {', '.join(IMAGE_FORMATS)}")
+        profile = replace(profile, format=value["format"])
+    if "quality" in value:
+        quality = _positive_int(f"{name}.quality", value["quality"])
+        if quality > 100:
+            raise InvalidOptionError(f"{name}.quality must be between 1 and 100")
+        profile = replace(profile, quality=quality)
+    return profile
+
+
+def _page_classifiers(value) -> list[str]:
+    # Imported here as the classifiers depend on image processing, which
+    # depends on this module
+    from .classifiers import PAGE_CLASSIFIERS
+
+    if not isinstance(value, list) or any(name not in PAGE_CLASSIFIERS for name in value):
+        raise InvalidOptionError(
+            f"page_classifiers must be a list of: {', '.join(PAGE_CLASSIFIERS)}"
+        )
+    return list(value)
+
+
+def _batch_backend(value) -> Optional[str]:
+    # Imported here as batch_api depends on this module
+    from .batch_api import BATCH_BACKENDS
+
+    if value is not None and value not in BATCH_BACKENDS:
+        raise InvalidOptionError(
+            f"batch_backend must be null or one of: {', '.join(BATCH_BACKENDS)}"
+        )
+    return value
+
+
+def _reject_unknown(values: dict) -> None:
+    unknown = set(values) - {f.name for f in fields(SyncOptions)}
+    if unknown:
+        raise InvalidOptionError(f"Unknown sync options: {', '.join(sorted(unknown))}")
+
+
+def _apply(options: SyncOptions, values: dict) -> None:
+    if "max_concurrent_pages" in values:
+        options.max_concurrent_pages = _positive_int(
+            "max_concurrent_pages", values["max_concurrent_pages"]
+        )
+    if "queue_size" in values:
+        options.queue_size = _positive_int("queue_size", values["queue_size"])
+    if "default_model_concurrency" in values:
+        options.default_model_concurrency = _positive_int(
+            "default_model_concurrency", values["default_model_concurrency"]
+        )
+    if "http2" in values:
+        options.http2 = _bool("http2", values["http2"])
+    for name in ("http_max_connections", "http_max_keepalive_connections"):
+        if name in values:
+            setattr(options, name, _positive_int(name, values[name]))
+    if "http_timeout" in values:
+        options.http_timeout = _positive_number("http_timeout", values["http_timeout"])
+    if "write_batch_size" in values:
+        options.write_batch_size = _positive_int("write_batch_size", values["write_batch_size"])
+    if "write_batch_delay_ms" in values:
+        options.write_batch_delay_ms = _non_negative_int(
+            "write_batch_delay_ms", values["write_batch_delay_ms"]
+        )
+    if "http_retries" in values:
+        options.http_retries = _non_negative_int("http_retries", values["http_retries"])
+    for name in ("model_concurrency", "model_requests_per_minute", "model_tokens_per_minute"):
+        if name in values:
+            limits = values[name] or {}
+            if not isinstance(limits, dict):
+                raise InvalidOptionError(f"{name} must be an object of model ID to integer")
+            setattr(options, name, {
+                **getattr(options, name),
+                **{
+                    str(model_id): _positive_int(f"{name}.{model_id}", limit)
+                    for model_id, limit in limits.items()
+                },
+            })
+    if "llm_retries" in values:
+        options.llm_retries = _non_negative_int("llm_retries", values["llm_retries"])
+    if "default_schedule_a_batch_size" in values:
+        options.default_schedule_a_batch_size = _positive_int(
+            "default_schedule_a_batch_size", values["default_schedule_a_batch_size"]
+        )
+    if "schedule_a_batch_size" in values:
+        schedule_a_batch_size = values["schedule_a_batch_size"] or {}
+        if not isinstance(schedule_a_batch_size, dict):
+            raise InvalidOptionError("schedule_a_batch_size must be an object of model ID to integer")
+        options.schedule_a_batch_size = {
+            **options.schedule_a_batch_size,
+            **{
+                str(model_id): _positive_int(f"schedule_a_batch_size.{model_id}", size)
+                for model_id, size in schedule_a_batch_size.items()
+            },
+        }
+    if "incremental" in values:
+        options.incremental = _bool("incremental", values["incremental"])
+    if "batch_backend" in values:
+        options.batch_backend = _batch_backend(values["batch_backend"])
+    if "batch_poll_seconds" in values:
+        options.batch_poll_seconds = _positive_number(
+            "batch_poll_seconds", values["batch_poll_seconds"]
+        )
+    if "page_classifiers" in values:
+        options.page_classifiers = _page_classifiers(values["page_classifiers"])
+    if "classifier_min_confidence" in values:
+        confidence = _positive_number("classifier_min_confidence", values["classifier_min_confidence"])
+        if confidence > 1:
+            raise InvalidOptionError("classifier_min_confidence must be between 0 and 1")
+        options.classifier_min_confidence = confidence
+    if "default_image_profile" in values:
+        options.default_image_profile = _image_profile(
+            "default_image_profile", values["default_image_profile"]
+        )
+    if "image_profiles" in values:
+        image_profiles = values["image_profiles"] or {}
+        if not isinstance(image_profiles, dict):
+            raise InvalidOptionError("image_profiles must be an object of model ID to profile")
+        options.image_profiles = {
+            **options.image_profiles,
+            **{
+                str(model_id): _image_profile(f"image_profiles.{model_id}", profile)
+                for model_id, profile in image_profiles.items()
+            },
+        }
+
+
+def sync_options_from_dict(values: Optional[dict]) -> SyncOptions:
+    """Rebuild SyncOptions saved with SyncOptions.to_dict()."""
+    options = SyncOptions()
+    _reject_unknown(values or {})
+    _apply(options, values or {})
+    return options
+
+
+def resolve_sync_options(
+    datasette, database: str, overrides: Optional[dict] = None
+) -> SyncOptions:
+    """
+    Build SyncOptions from plugin configuration, then per-job overrides.
+    Plugin configuration also holds instance-level settings, which are
+    ignored, but every override must be a sync option.
+    """
+    options = SyncOptions()
+    _apply(options, datasette.plugin_config(PLUGIN_NAME, database=database) or {})
+    _reject_unknown(overrides or {})
+    _apply(options, overrides or {})
+    return options
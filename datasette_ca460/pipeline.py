@@ -0,0 +1,81 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+# Sentinel put on a stage queue to tell one worker to exit
+DONE = object()
+
+
+async def run_stages(*coros: Awaitable) -> None:
+    """
+    Run pipeline stages concurrently until they all finish.
+
+    If any stage raises, every other stage is cancelled and the exception is
+    re-raised, so a failed worker can't leave a producer blocked forever on
+    a full queue. Stages should therefore only call close_stage() after
+    finishing normally.
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def stage_workers(
+    queue: asyncio.Queue,
+    handler: Callable[[Any], Awaitable[None]],
+    concurrency: int,
+) -> None:
+    """Consume a queue with `concurrency` workers until each receives DONE."""
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is DONE:
+                return
+            await handler(item)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def close_stage(queue: asyncio.Queue, concurrency: int) -> None:
+    """Tell every worker consuming `queue` to exit once it has drained."""
+    for _ in range(concurrency):
+        await queue.put(DONE)
+
+
+class OrderedCompletions:
+    """
+    Track outstanding work per key and report keys as complete in the order
+    they were registered, even if later keys finish first.
+    """
+
+    def __init__(self, on_complete: Callable[[Hashable], Awaitable[None]]):
+        self._on_complete = on_complete
+        self._order: list[Hashable] = []
+        self._remaining: dict[Hashable, int] = {}
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def register(self, key: Hashable, count: int) -> None:
+        self._order.append(key)
+        self._remaining[key] = count
+        await self._flush()
+
+    async def finish(self, key: Hashable, count: int = 1) -> None:
+        self._remaining[key] -= count
+        await self._flush()
+
+    async def _flush(self) -> None:
+        async with self._lock:
+            while self._next < len(self._order):
+                key = self._order[self._next]
+                if self._remaining[key] > 0:
+                    return
+                self._next += 1
+                del self._remaining[key]
+                await self._on_complete(key)
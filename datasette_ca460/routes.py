@@ -1,11 +1,15 @@
-from pathlib import Path
-from typing import Optional
-from datasette_llm_accountant import LlmWrapper
+from typing import NamedTuple, Optional
 from datasette import Response
+from datasette.utils.asgi import AsgiStream
 from datasette_plugin_router import Router
 from pydantic import BaseModel
 import json
-from .sync import run_sync_in_background
+from .migrations import ensure_schema
+from .models import get_model_cache
+from .events import FINISHED_STATUSES, broker_for, load_job_events
+from .http_cache import cached_response, data_version, is_not_modified, not_modified
+from .jobs import JobStateError, enqueue_job, get_scheduler, transition_job
+from .options import InvalidOptionError, resolve_sync_options
 import asyncio
 import uuid
 
@@ -64,8 +68,7 @@ async def ca460_api_models(request, datasette):
     except KeyError:
         return Response.json({"error": "Database not found"}, status=404)
 
-    llm_wrapper = LlmWrapper(datasette)
-    available_models = list(map(lambda x: x.model_id, llm_wrapper.get_async_models()))
+    available_models = get_model_cache(datasette).model_ids()
 
     return Response.json({"models": available_models})
 
@@ -75,14 +78,48 @@ class DocumentListItem(BaseModel):
     page_count: int
     title: Optional[str]
     model_count: int
+    parsed_pages: int
+    summary_pages: int
+    schedule_a_pages: int
+    last_parsed_at: Optional[str]
 
 class DocumentListResponse(BaseModel):
     documents: list[DocumentListItem]
+    # Pass as ?before= for the next page, if there is one
+    next: Optional[int]
+
+
+DOCUMENTS_PAGE_SIZE = 100
+DOCUMENTS_MAX_PAGE_SIZE = 1000
+
+
+def _positive_int_arg(request, name: str) -> Optional[int]:
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    value = int(value)
+    if value < 1:
+        raise ValueError(name)
+    return value
+
 
 # TODO permissions check
 @router.GET(r"^/(?P<database>[^/]+)/-/ca460/api/documents$", output=DocumentListResponse)
 async def ca460_api_documents(request, datasette):
-    """API endpoint to get list of documents with parsed data."""
+    """
+    API endpoint to get list of documents with parsed data, newest first.
+
+    Reads the document_stats table, so each page of results costs the same
+    however many pages have been parsed, and responses are cached until the
+    data changes (see http_cache.py). Optional parameters:
+
+        ?before=<id>      keyset pagination: documents with lower IDs, as
+                          given by `next` in the previous response
+        ?limit=<n>        documents per response, up to 1000
+        ?model=<model>    only documents parsed by this model
+        ?q=<text>         only documents with titles containing this text
+        ?min_models=<n>   only documents parsed by at least this many models
+    """
     database_name = request.url_vars["database"]
 
     try:
@@ -90,126 +127,270 @@ async def ca460_api_documents(request, datasette):
     except KeyError:
         return Response.json({"error": "Database not found"}, status=404)
 
-    def _get_documents(conn):
-        # Get documents that have been parsed by at least one model
-        cursor = conn.execute("""
-            SELECT DISTINCT 
-                d.id,
-                d.page_count,
-                d.data->>'title' as title,
-                (
-                    SELECT COUNT(DISTINCT pp.model)
-                    FROM pages p
-                    JOIN page_parsed pp ON p.id = pp.page_id
-                    WHERE p.document_id = d.id
-                ) as model_count
-            FROM documents d
-            JOIN pages p ON d.id = p.document_id
-            JOIN page_parsed pp ON p.id = pp.page_id
-            ORDER BY d.id DESC
-        """)
-        rows = cursor.fetchall()
-        return [
-            {
-                "id": row[0],
-                "page_count": row[1],
-                "title": row[2],
-                "model_count": row[3],
-            }
-            for row in rows
+    try:
+        before = _positive_int_arg(request, "before")
+        limit = min(_positive_int_arg(request, "limit") or DOCUMENTS_PAGE_SIZE, DOCUMENTS_MAX_PAGE_SIZE)
+        min_models = _positive_int_arg(request, "min_models")
+    except ValueError:
+        return Response.json(
+            {"error": "before, limit and min_models must be positive integers"}, status=400
+        )
+
+    async def build():
+        # Databases that haven't been synced yet have no ca460 tables
+        if not await db.table_exists("document_stats"):
+            return Response.json(DocumentListResponse(documents=[], next=None).model_dump())
+
+        where = []
+        params: dict = {"limit": limit + 1}
+        if before is not None:
+            where.append("document_id < :before")
+            params["before"] = before
+        if request.args.get("model"):
+            where.append(
+                "document_id IN (SELECT document_id FROM document_parse_counts WHERE model = :model)"
+            )
+            params["model"] = request.args["model"]
+        if request.args.get("q"):
+            where.append("title LIKE '%' || :q || '%'")
+            params["q"] = request.args["q"]
+        if min_models is not None:
+            where.append("model_count >= :min_models")
+            params["min_models"] = min_models
+
+        sql = """
+            SELECT document_id, page_count, title, model_count, parsed_pages,
+                summary_pages, schedule_a_pages, last_parsed_at
+            FROM document_stats
+            {where}
+            ORDER BY document_id DESC
+            LIMIT :limit
+        """.format(where=("WHERE " + " AND ".join(where)) if where else "")
+        rows = await db.execute_fn(lambda conn: conn.execute(sql, params).fetchall())
+
+        documents = [
+            DocumentListItem(
+                id=row[0],
+                page_count=row[1] or 0,
+                title=row[2],
+                model_count=row[3],
+                parsed_pages=row[4],
+                summary_pages=row[5],
+                schedule_a_pages=row[6],
+                last_parsed_at=row[7],
+            )
+            for row in rows[:limit]
         ]
+        response = DocumentListResponse(
+            documents=documents,
+            next=documents[-1].id if len(rows) > limit else None,
+        )
+        return Response.json(response.model_dump())
+
+    return await cached_response(request, datasette, db, build)
+
+
+# Each parse as a JSON object, built by SQLite from the stored JSON so it is
+# never decoded in Python
+PARSE_JSON = """json_object(
+    'model', pp.model,
+    'page_type', pp.page_type,
+    'page_number', p.page_number,
+    'parsed_data', COALESCE(json(pp.parsed_data), json('{}')),
+    'timing', COALESCE(json(pp.timing), json('{}')),
+    'created_at', pp.created_at
+)"""
+
+# Page numbers read per query when streaming NDJSON
+PARSED_STREAM_PAGES = 50
+
+
+class ParsedFilters(NamedTuple):
+    document_id: int
+    models: list[str]
+    page_types: list[str]
+
+    def where(self) -> tuple[str, list]:
+        """SQL conditions on page_parsed pp joined to pages p, and their parameters."""
+        where = ["p.document_id = ?"]
+        params: list = [self.document_id]
+        for column, values in (("pp.model", self.models), ("pp.page_type", self.page_types)):
+            if values:
+                where.append(f"{column} IN ({', '.join('?' for _ in values)})")
+                params.extend(values)
+        return " AND ".join(where), params
+
+
+def _parsed_page_numbers(conn, filters: ParsedFilters, after: int, limit: Optional[int]) -> list[int]:
+    """Page numbers after `after` with matching parses, up to `limit` of them."""
+    where, params = filters.where()
+    sql = f"""
+        SELECT DISTINCT p.page_number
+        FROM page_parsed pp JOIN pages p ON p.id = pp.page_id
+        WHERE {where} AND p.page_number > ?
+        ORDER BY p.page_number
+    """
+    params.append(after)
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return [row[0] for row in conn.execute(sql, params)]
+
+
+def _parsed_range_condition(filters: ParsedFilters, first: int, last: int) -> tuple[str, list]:
+    where, params = filters.where()
+    return f"{where} AND p.page_number BETWEEN ? AND ?", params + [first, last]
+
+
+def _parsed_models_json(conn, filters: ParsedFilters, first: int, last: int) -> str:
+    """{model: [parse, ...]} for pages first to last, as a JSON string."""
+    where, params = _parsed_range_condition(filters, first, last)
+    # json_group_array() keeps the order rows arrive in from the subquery
+    return conn.execute(f"""
+        SELECT COALESCE(json_group_object(model, json(pages)), '{{}}') FROM (
+            SELECT model, json_group_array(json(parse)) AS pages FROM (
+                SELECT pp.model AS model, json_remove({PARSE_JSON}, '$.model') AS parse
+                FROM page_parsed pp JOIN pages p ON p.id = pp.page_id
+                WHERE {where}
+                ORDER BY pp.model, p.page_number, pp.page_type
+            )
+            GROUP BY model
+            ORDER BY model
+        )
+    """, params).fetchone()[0]
 
-    try:
-        documents = await db.execute_fn(_get_documents)
-    except Exception:
-        # Table might not exist yet
-        documents = []
 
-    response = DocumentListResponse(
-        documents=[DocumentListItem(**doc) for doc in documents]
-    )
-    return Response.json(response.model_dump())
+def _parsed_lines(conn, filters: ParsedFilters, first: int, last: int) -> list[str]:
+    """One JSON line per parse of pages first to last."""
+    where, params = _parsed_range_condition(filters, first, last)
+    return [row[0] for row in conn.execute(f"""
+        SELECT {PARSE_JSON}
+        FROM page_parsed pp JOIN pages p ON p.id = pp.page_id
+        WHERE {where}
+        ORDER BY p.page_number, pp.model, pp.page_type
+    """, params)]
+
+
+def _document_json(conn, document_id: int) -> Optional[str]:
+    row = conn.execute("""
+        SELECT json_object(
+            'id', id,
+            'page_count', page_count,
+            'title', COALESCE(title, data->>'title', 'Document ' || id)
+        ) FROM documents WHERE id = ?
+    """, (document_id,)).fetchone()
+    return row[0] if row else None
 
 
 @router.GET(r"^/(?P<database>[^/]+)/-/ca460/api/document/(?P<document_id>\d+)/parsed$")
 async def ca460_api_document_parsed(request, datasette, database: str, document_id: str):
-    """API endpoint to get all parsed data for a document, grouped by model."""
+    """
+    API endpoint to get parsed data for a document, grouped by model.
+
+    Optional parameters:
+
+        ?model=<model>          only parses by this model; can be repeated
+        ?page_type=<type>       only parses of this page type; can be repeated
+        ?after=<page number>    keyset pagination: pages after this one, as
+                                given by `next` in the previous response
+        ?limit=<n>              parses of at most this many pages
+        ?format=ndjson          stream one JSON object per parse instead,
+                                ordered by page number; after and limit apply
+
+    Responses are assembled from stored JSON by SQLite, without decoding it,
+    and cached until the data changes (see http_cache.py).
+    """
     try:
         db = datasette.get_database(database)
     except KeyError:
         return Response.json({"error": "Database not found"}, status=404)
 
-    def _get_parsed_data(conn):
-        # Get document info
-        cursor = conn.execute(
-            "SELECT id, page_count, data FROM documents WHERE id = ?",
-            (document_id,)
+    try:
+        after = int(request.args.get("after") or 0)
+        limit = _positive_int_arg(request, "limit")
+    except ValueError:
+        return Response.json({"error": "after and limit must be integers"}, status=400)
+
+    filters = ParsedFilters(
+        int(document_id),
+        request.args.getlist("model"),
+        request.args.getlist("page_type"),
+    )
+
+    if request.args.get("format") == "ndjson":
+        # Streams aren't cached, but can still be revalidated
+        version = await data_version(db)
+        if version is not None and is_not_modified(request, version):
+            return not_modified(version)
+        if await db.execute_fn(lambda conn: _document_json(conn, filters.document_id)) is None:
+            return Response.json({"error": "Document not found"}, status=404)
+
+        async def stream(response):
+            last = after
+            remaining = limit
+            while remaining is None or remaining > 0:
+                chunk = PARSED_STREAM_PAGES if remaining is None else min(remaining, PARSED_STREAM_PAGES)
+                page_numbers = await db.execute_fn(
+                    lambda conn: _parsed_page_numbers(conn, filters, last, chunk)
+                )
+                if not page_numbers:
+                    return
+                lines = await db.execute_fn(
+                    lambda conn: _parsed_lines(conn, filters, page_numbers[0], page_numbers[-1])
+                )
+                await response.write("\n".join(lines) + "\n")
+                last = page_numbers[-1]
+                if remaining is not None:
+                    remaining -= len(page_numbers)
+
+        return AsgiStream(
+            stream,
+            headers=version.headers() if version is not None else {},
+            content_type="application/x-ndjson",
         )
-        doc_row = cursor.fetchone()
-        if not doc_row:
-            return None
 
-        doc_data = json.loads(doc_row[2]) if doc_row[2] else {}
-
-        # Get all parsed data for this document, grouped by model
-        cursor = conn.execute("""
-            SELECT 
-                pp.model,
-                pp.page_type,
-                p.page_number,
-                pp.parsed_data,
-                pp.timing,
-                pp.created_at
-            FROM page_parsed pp
-            JOIN pages p ON pp.page_id = p.id
-            WHERE p.document_id = ?
-            ORDER BY pp.model, p.page_number
-        """, (document_id,))
-
-        rows = cursor.fetchall()
-
-        # Group by model
-        models = {}
-        for row in rows:
-            model = row[0]
-            if model not in models:
-                models[model] = []
-            
-            parsed = json.loads(row[3]) if row[3] else {}
-            timing = json.loads(row[4]) if row[4] else {}
-            
-            models[model].append({
-                "page_type": row[1],
-                "page_number": row[2],
-                "parsed_data": parsed,
-                "timing": timing,
-                "created_at": row[5],
-            })
-
-        return {
-            "document": {
-                "id": doc_row[0],
-                "page_count": doc_row[1],
-                "title": doc_data.get("title", f"Document {doc_row[0]}"),
-            },
-            "models": models,
-        }
+    def _get_parsed_data(conn) -> Optional[str]:
+        document_json = _document_json(conn, filters.document_id)
+        if document_json is None:
+            return None
+        # One more page number than asked for says whether there's a next page
+        page_numbers = _parsed_page_numbers(
+            conn, filters, after, None if limit is None else limit + 1
+        )
+        next_page = None
+        if limit is not None and len(page_numbers) > limit:
+            page_numbers = page_numbers[:limit]
+            next_page = page_numbers[-1]
+        models_json = "{}"
+        if page_numbers:
+            models_json = _parsed_models_json(conn, filters, page_numbers[0], page_numbers[-1])
+        return (
+            f'{{"document": {document_json}, "models": {models_json}, '
+            f'"next": {json.dumps(next_page)}}}'
+        )
 
-    try:
-        data = await db.execute_fn(_get_parsed_data)
-    except Exception as e:
-        return Response.json({"error": str(e)}, status=500)
+    async def build():
+        body = await db.execute_fn(_get_parsed_data)
+        if body is None:
+            return Response.json({"error": "Document not found"}, status=404)
+        return Response(body, content_type="application/json; charset=utf-8")
 
-    if data is None:
-        return Response.json({"error": "Document not found"}, status=404)
+    return await cached_response(request, datasette, db, build)
 
-    return Response.json(data)
 
+def _since(value) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    return int(value)
 
 
 @router.GET(r"^/(?P<database>[^/]+)/-/ca460/sync/(?P<sync_job_id>[^/]+)/events$")
 async def ca460_events_view(request, datasette):
-    """API endpoint to get sync events for a job."""
+    """
+    API endpoint to get sync events for a job.
+
+    Pass ?since=<event id> to only get events logged after that one.
+    """
     database_name = request.url_vars["database"]
     sync_job_id = request.url_vars["sync_job_id"]
 
@@ -222,43 +403,13 @@ async def ca460_events_view(request, datasette):
             status=404
         )
 
-    # Get job status and events
-    def _get_data(conn):
-        # Get job info
-        cursor = conn.execute(
-            "SELECT status, error, started_at, completed_at FROM sync_jobs WHERE id = ?",
-            (sync_job_id,)
-        )
-        job = cursor.fetchone()
-
-        if not job:
-            return None
-
-        # Get events
-        cursor = conn.execute(
-            "SELECT event_type, message, created_at FROM sync_events WHERE sync_job_id = ? ORDER BY id",
-            (sync_job_id,)
-        )
-        events = cursor.fetchall()
-
-        return {
-            "job": {
-                "status": job[0],
-                "error": job[1],
-                "started_at": job[2],
-                "completed_at": job[3],
-            },
-            "events": [
-                {
-                    "type": e[0],
-                    "message": e[1],
-                    "created_at": e[2],
-                }
-                for e in events
-            ]
-        }
+    try:
+        since = _since(request.args.get("since"))
+    except ValueError:
+        return Response.json({"error": "since must be an event ID"}, status=400)
 
-    data = await db.execute_write_fn(_get_data)
+    # Get job status and events
+    data = await db.execute_fn(lambda conn: load_job_events(conn, sync_job_id, since))
 
     if data is None:
         return Response.json(
@@ -268,11 +419,100 @@ async def ca460_events_view(request, datasette):
 
     return Response.json(data)
 
-SCHEMA = (Path(__file__).parent / "schema.sql").read_text()
+
+# Streams end after this long; EventSource reconnects with Last-Event-ID
+STREAM_MAX_SECONDS = 300
+STREAM_KEEPALIVE_SECONDS = 15
+
+
+def _sse(event: str, data: dict, id: Optional[int] = None) -> str:
+    lines = [f"event: {event}"]
+    if id is not None:
+        lines.append(f"id: {id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+@router.GET(r"^/(?P<database>[^/]+)/-/ca460/sync/(?P<sync_job_id>[^/]+)/events/stream$")
+async def ca460_events_stream(request, datasette):
+    """
+    Server-Sent Events stream of a sync job's progress.
+
+    Sends `event` messages for each sync event (with the event ID as the SSE
+    id, so reconnecting clients resume after the last one they saw) and
+    `job` messages with the job status, ending once the job has finished.
+    """
+    database_name = request.url_vars["database"]
+    sync_job_id = request.url_vars["sync_job_id"]
+
+    try:
+        db = datasette.get_database(database_name)
+    except KeyError:
+        return Response.json({"error": "Database not found"}, status=404)
+
+    try:
+        since = _since(request.headers.get("last-event-id") or request.args.get("since"))
+    except ValueError:
+        return Response.json({"error": "since must be an event ID"}, status=400)
+
+    # Subscribe before reading history so nothing logged in between is lost
+    broker = broker_for(db)
+    queue = broker.subscribe(sync_job_id)
+    try:
+        data = await db.execute_fn(lambda conn: load_job_events(conn, sync_job_id, since))
+    except Exception:
+        broker.unsubscribe(sync_job_id, queue)
+        raise
+    if data is None:
+        broker.unsubscribe(sync_job_id, queue)
+        return Response.json({"error": "Sync job not found"}, status=404)
+
+    async def stream(response):
+        last_id = since or 0
+        try:
+            for event in data["events"]:
+                await response.write(_sse("event", event, id=event["id"]))
+                last_id = event["id"]
+            await response.write(_sse("job", data["job"]))
+            if data["job"]["status"] in FINISHED_STATUSES:
+                return
+
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + STREAM_MAX_SECONDS
+            while loop.time() < deadline:
+                try:
+                    kind, payload = await asyncio.wait_for(
+                        queue.get(), STREAM_KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    await response.write(": keepalive\n\n")
+                    continue
+                if kind == "event":
+                    # Already sent as part of the history read above
+                    if payload["id"] <= last_id:
+                        continue
+                    await response.write(_sse("event", payload, id=payload["id"]))
+                    last_id = payload["id"]
+                else:
+                    await response.write(_sse("job", payload))
+                    if payload["status"] in FINISHED_STATUSES:
+                        return
+        finally:
+            broker.unsubscribe(sync_job_id, queue)
+
+    return AsgiStream(
+        stream,
+        headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+        content_type="text/event-stream",
+    )
+
 
 @router.POST(r"^/(?P<database>[^/]+)/-/ca460/api/sync$")
 async def ca460_api_sync(request, datasette):
-    """API endpoint to start a sync job."""
+    """
+    API endpoint to queue a sync job. The job scheduler starts it once fewer
+    than max_concurrent_jobs jobs are running.
+    """
     database_name = request.url_vars["database"]
 
     if request.method != "POST":
@@ -302,40 +542,65 @@ async def ca460_api_sync(request, datasette):
     except ValueError:
         return Response.json({"error": "Project ID must be a number"}, status=400)
 
-    # Initialize schema first
-    def init_schema(conn):
-        conn.executescript(SCHEMA)
+    # Everything else in the body overrides a sync option
+    overrides = {
+        key: value for key, value in data.items()
+        if key not in ("project_id", "page_type_model", "parser_model")
+    }
+    try:
+        options = resolve_sync_options(datasette, database_name, overrides)
+    except InvalidOptionError as e:
+        return Response.json({"error": str(e)}, status=400)
 
-    await db.execute_write_fn(init_schema)
+    # No-op unless this database has not been migrated yet
+    await ensure_schema(db)
 
     # Create sync job
     sync_job_id = str(uuid.uuid4())
 
-    def _create_job(conn):
-        conn.execute(
-            "INSERT INTO sync_jobs (id, project_id, page_type_model, parser_model) VALUES (?, ?, ?, ?)",
-            (sync_job_id, project_id, page_type_model, parser_model)
-        )
-        conn.commit()
-
-    await db.execute_write_fn(_create_job)
-
-    # Start background sync
-    asyncio.create_task(
-        run_sync_in_background(
-            datasette,
-            database_name,
-            sync_job_id,
-            project_id,
-            page_type_model,
-            parser_model
+    await db.execute_write_fn(
+        lambda conn: enqueue_job(
+            conn, sync_job_id, project_id, page_type_model, parser_model, options
         )
     )
+    get_scheduler(datasette).wake()
 
     return Response.json({
         "sync_job_id": sync_job_id,
+        "status": "queued",
         "project_id": project_id,
         "page_type_model": page_type_model,
         "parser_model": parser_model,
+        "options": options.to_dict(),
     })
 
+
+
+@router.POST(r"^/(?P<database>[^/]+)/-/ca460/api/sync/(?P<sync_job_id>[^/]+)/(?P<action>pause|resume|cancel)$")
+async def ca460_api_sync_action(request, datasette):
+    """
+    API endpoint to pause, resume or cancel a sync job.
+
+    Paused jobs keep their progress: resuming one puts it back on the queue,
+    and it picks up from the documents it had not finished.
+    """
+    database_name = request.url_vars["database"]
+    sync_job_id = request.url_vars["sync_job_id"]
+    action = request.url_vars["action"]
+
+    try:
+        db = datasette.get_database(database_name)
+    except KeyError:
+        return Response.json({"error": "Database not found"}, status=404)
+
+    await ensure_schema(db)
+
+    try:
+        status = await transition_job(datasette, database_name, sync_job_id, action)
+    except JobStateError as e:
+        return Response.json({"error": str(e)}, status=409)
+
+    if status is None:
+        return Response.json({"error": "Sync job not found"}, status=404)
+
+    return Response.json({"sync_job_id": sync_job_id, "status": status})
@@ -1,3 +1,5 @@
+-- Version 1 of the schema. Later changes (indexes, new columns and tables)
+-- are numbered migrations in migrations.py: don't edit this file, add one.
 CREATE TABLE IF NOT EXISTS sync_jobs(
     id TEXT PRIMARY KEY,
     project_id INTEGER NOT NULL,
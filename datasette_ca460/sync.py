@@ -1,23 +1,72 @@
-from dataclasses import asdict
+from dataclasses import asdict, dataclass, field
 import json
+import os
+import tempfile
 import time                                                                               
 import httpx
-from io import BytesIO
-from PIL import Image
-from pathlib import Path
-from datasette_llm_accountant import LlmWrapper
+from concurrent.futures import Executor
 import asyncio
 from contextlib import contextmanager
-from documentcloud import DocumentCloud
 from datetime import datetime
 import traceback
 import llm
+from pydantic import BaseModel, ValidationError
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
+
+from .batch_api import (
+    BATCH_BACKENDS,
+    BATCH_FAILED,
+    BATCH_RUNNING,
+    BatchBackend,
+    BatchError,
+    batch_request,
+    read_jsonl,
+)
+from .documentcloud_api import document_version, list_project_documents
+from .events import broker_for, now_timestamp
+from .incremental import apply_project_listing, document_file_hash
+from .fetch import backoff_delay, create_http_client, fetch_bytes
+from .limiter import ModelLimiter, get_model_limiter, is_transient
+from .models import JobModels
+from .migrations import ensure_schema
+from .images import PageImageCache, get_page_image_cache, page_image_key
+from .classifiers import PAGE_CLASSIFIERS, PageClassifier, PagePrediction
+from .image_processing import (
+    PREDICTION_CROP,
+    encode_page_image,
+    fingerprint_page_image,
+    get_image_executor,
+    phash_hex,
+    run_image_task,
+)
+from .options import SyncOptions
+from .writer import BatchWriter
+from .pipeline import OrderedCompletions, close_stage, run_stages, stage_workers
  
 from extract_ca460.form460_page_type import Form460PageTypeModel, PROMPT as PAGE_TYPE_PROMPT
 from extract_ca460.form460_summary_page import Form460SummaryPage, PROMPT as SUMMARY_PAGE_PROMPT
 from extract_ca460.form_460_schedule_a import Form460ScheduleA, PROMPT as SCHEDULE_A_PROMPT
 
 
+class Form460ScheduleAPages(BaseModel):
+    """Schema for a batch of Schedule A pages: one parse per attached page."""
+    pages: list[Form460ScheduleA]
+
+
+SCHEDULE_A_BATCH_PROMPT = SCHEDULE_A_PROMPT + """
+  {count} consecutive pages of the schedule are attached. Parse each page
+  separately, and return one entry in `pages` for each attached page, in
+  the order they are attached.
+"""
+
+# Prompt and schema for each page type that is parsed
+PARSERS = {
+    "campaign_disclosure_summary_page": (SUMMARY_PAGE_PROMPT, Form460SummaryPage),
+    "schedule_a": (SCHEDULE_A_PROMPT, Form460ScheduleA),
+}
+
+
 @contextmanager
 def timer():
     """Context manager to time code execution."""
@@ -25,285 +74,795 @@ def timer():
     yield lambda: time.time() - start
 
 
-def crop_page_image_for_prediction(page_image: bytes) -> bytes:
+# Page types that have a parser, and the page_type their parse is stored as
+PARSED_PAGE_TYPES = {
+    "campaign_disclosure_summary_page": "campaign_disclosure_summary_page",
+    "schedule_a": "schedule_a",
+    "schedule_a_continuation": "schedule_a",
+}
+
+
+INSERT_EVENT_SQL = """INSERT INTO sync_events (sync_job_id, event_type, message, created_at)
+VALUES (?, ?, ?, ?)"""
+
+
+# Pages are always fingerprinted from this size of image, whatever size
+# their models are sent, so fingerprints from different jobs compare
+FINGERPRINT_IMAGE_SIZE = "normal"
+
+
+@dataclass(frozen=True)
+class PageFingerprint:
+    """See fingerprint_page_image()."""
+    content_hash: str
+    phash: int
+
+
+@dataclass
+class SyncContext:
+    """State shared by every page processed in a single sync job."""
+    datasette: Any
+    db: Any
+    sync_job_id: str
+    options: SyncOptions
+    images: PageImageCache
+    http: httpx.AsyncClient
+    writer: BatchWriter
+    # Identifies the process holding this job's work unit leases
+    worker_id: Optional[str] = None
+    # Pool that page images are cropped and encoded on; None for a thread
+    image_executor: Optional[Executor] = None
+    # Local classifiers tried before the page type model, in order
+    page_classifiers: list[PageClassifier] = field(default_factory=list)
+    # Process-wide limiters for the models this job has prompted
+    limiters: dict[str, ModelLimiter] = field(init=False, default_factory=dict)
+    # Models resolved by this job
+    models: JobModels = field(init=False)
+    image_downloads: int = field(init=False, default=0)
+    # page ID -> fingerprint, for pages fingerprinted or loaded by this job
+    fingerprints: dict[int, PageFingerprint] = field(init=False, default_factory=dict)
+
+    def __post_init__(self):
+        self.models = JobModels(self.datasette)
+
+    async def log(self, event_type: str, message: str):
+        """
+        Log a sync event for this job through the batched writer. It is
+        published to progress streams once its batch is committed.
+        """
+        event = {"type": event_type, "message": message, "created_at": now_timestamp()}
+
+        def _publish(event_id):
+            broker_for(self.db).publish_event(self.sync_job_id, {"id": event_id, **event})
+
+        await self.writer.write(
+            INSERT_EVENT_SQL,
+            (self.sync_job_id, event_type, message, event["created_at"]),
+            on_insert=_publish,
+        )
+
+    async def page_image(self, document, page_number: int, size: str = "xlarge") -> bytes:
+        return await get_page_image(self, document, page_number, size)
+
+    async def page_fingerprint(self, page_id: int, document, page_number: int) -> PageFingerprint:
+        return await get_page_fingerprint(self, page_id, document, page_number)
+
+    async def encode_image(self, content: bytes, **kwargs) -> bytes:
+        """Encode a page image as an attachment, off the event loop."""
+        return await run_image_task(self.image_executor, encode_page_image, content, **kwargs)
+
+    def limiter(self, model_id: str) -> ModelLimiter:
+        """
+        The limiter for prompts against a single model, see run_prompt().
+        It is shared with every other job, but backoffs are logged as this
+        job's events until close() is called.
+        """
+        if model_id not in self.limiters:
+            limiter = get_model_limiter(
+                self.datasette,
+                model_id,
+                self.options.concurrency_for_model(model_id),
+                requests_per_minute=self.options.model_requests_per_minute.get(model_id),
+                tokens_per_minute=self.options.model_tokens_per_minute.get(model_id),
+            )
+            limiter.add_listener(self._limiter_decreased)
+            self.limiters[model_id] = limiter
+        return self.limiters[model_id]
+
+    async def _limiter_decreased(self, limiter: ModelLimiter):
+        await self.log("warning", f"Backing off: {limiter.describe()}")
+
+    def close(self):
+        """Stop logging this job's events for the limiters it used."""
+        for limiter in self.limiters.values():
+            limiter.remove_listener(self._limiter_decreased)
+
+
+async def run_prompt(
+    ctx: SyncContext,
+    model_id: str,
+    prompt: str,
+    schema,
+    attachments: list,
+) -> tuple[str, Any]:
     """
-    Crop the page image to the top-left 1/6th corner for page type prediction.
+    Prompt a model through its limiter, returning the response text and
+    usage. Rate limiting and transient errors are retried, up to the
+    llm_retries option, with jittered exponential backoff.
     """
-    img = Image.open(BytesIO(page_image))
-    crop_width = img.width // 2
-    crop_height = img.height // 6
-    cropped_img = img.crop((0, 0, crop_width, crop_height))
-    buffer = BytesIO()
-    cropped_img.save(buffer, format="PNG")
-    image = buffer.getbuffer()
-    return bytes(image)
+    model = ctx.models.get_async_model(model_id)
+    limiter = ctx.limiter(model_id)
+    attempt = 0
+    while True:
+        try:
+            async with limiter.slot() as record_tokens:
+                response = await model.prompt(prompt, schema=schema, attachments=attachments)
+                response_text = await response.text()
+                response_usage = await response.usage()
+                record_tokens((response_usage.input or 0) + (response_usage.output or 0))
+            return response_text, response_usage
+        except Exception as ex:
+            if attempt >= ctx.options.llm_retries or not is_transient(ex):
+                raise
+            delay = backoff_delay(attempt, base=1.0, cap=60.0)
+            await ctx.log(
+                "warning",
+                f"Prompt to {model_id} failed ({ex}), retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+            attempt += 1
 
 
-def gif_to_jpeg(contents: bytes, quality: int = 95) -> bytes:
-    """Convert GIF bytes to JPEG bytes."""
-    buf = BytesIO(contents)
-    with Image.open(buf) as im:
-        try:
-            im.seek(0)
-        except EOFError:
-            pass
-        rgb = im.convert("RGB")
-        out = BytesIO()
-        rgb.save(out, format="JPEG", quality=quality)
-        return out.getvalue()
+async def get_page_image(ctx: SyncContext, document, page_number: int, size: str = "xlarge") -> bytes:
+    """Fetch an image of a page, via the shared page image cache."""
+    page_image_url: str = document.get_image_url(page_number, size)
+
+    async def _download():
+        content = await fetch_bytes(ctx.http, page_image_url, retries=ctx.options.http_retries)
+        ctx.image_downloads += 1
+        return content
+
+    return await ctx.images.get(page_image_key(document, page_number, size), _download)
+
+
+async def get_page_fingerprint(
+    ctx: SyncContext, page_id: int, document, page_number: int
+) -> PageFingerprint:
+    """
+    A page's fingerprint, computed from its FINGERPRINT_IMAGE_SIZE image the
+    first time it is needed and stored in the pages table.
+    """
+    if page_id not in ctx.fingerprints:
+        page_image = await get_page_image(ctx, document, page_number, FINGERPRINT_IMAGE_SIZE)
+        content_hash, phash = await run_image_task(
+            ctx.image_executor, fingerprint_page_image, page_image
+        )
+        ctx.fingerprints[page_id] = PageFingerprint(content_hash, phash)
+        await ctx.writer.write(
+            "UPDATE pages SET content_hash = ?, phash = ? WHERE id = ?",
+            (content_hash, phash_hex(phash), page_id)
+        )
+    return ctx.fingerprints[page_id]
+
 
+async def reuse_parsed_page(
+    ctx: SyncContext,
+    page_id: int,
+    document,
+    page_number: int,
+    page_type: str,
+    parser_model: str,
+) -> bool:
+    """
+    If a byte-identical page has already been parsed as this page type by
+    this model, copy its result to this page and return True.
 
-SCHEMA = (Path(__file__).parent / "schema.sql").read_text()
+    Only exact copies are reused: a near-identical page could differ in the
+    very line items being extracted.
+    """
+    fingerprint = await get_page_fingerprint(ctx, page_id, document, page_number)
+
+    def _find(conn):
+        row = conn.execute(
+            """SELECT pp.id FROM page_parsed pp
+            JOIN pages p ON p.id = pp.page_id
+            WHERE p.content_hash = ? AND p.id != ? AND pp.page_type = ? AND pp.model = ?
+            ORDER BY pp.id LIMIT 1""",
+            (fingerprint.content_hash, page_id, page_type, parser_model)
+        ).fetchone()
+        return row[0] if row else None
+
+    source_id = await ctx.db.execute_fn(_find)
+    if source_id is None:
+        return False
+    # Inserted like any other parse, so the page_parsed triggers fill in
+    # the itemization and summary tables for this page too
+    await ctx.writer.write(
+        """INSERT INTO page_parsed
+        (page_id, page_type, model, image_profile, parsed_data, reused_from)
+        SELECT ?, page_type, model, image_profile, parsed_data, id
+        FROM page_parsed WHERE id = ?
+        ON CONFLICT (page_id, page_type, model) DO NOTHING""",
+        (page_id, source_id)
+    )
+    return True
+
+
+@dataclass
+class PageWork:
+    """A single page moving through the sync pipeline."""
+    document: Any
+    page_id: int
+    page_number: int
+    predicted_page_type: Optional[str] = None
+
+
+@dataclass
+class DocumentQueued:
+    """
+    Put on the parse queue once every page of a document that needs parsing
+    has been, so Schedule A pages still waiting for a full batch are parsed.
+    """
+    document: Any
 
 
 async def log_event(db, sync_job_id: str, event_type: str, message: str):
-    """Log a sync event to the database."""
+    """Log a sync event to the database and publish it to progress streams."""
+    created_at = now_timestamp()
+
     def _log(conn):
-        conn.execute(
-            "INSERT INTO sync_events (sync_job_id, event_type, message) VALUES (?, ?, ?)",
-            (sync_job_id, event_type, message)
+        cursor = conn.execute(
+            INSERT_EVENT_SQL,
+            (sync_job_id, event_type, message, created_at)
         )
         conn.commit()
+        return cursor.lastrowid
 
-    await db.execute_write_fn(_log)
+    event_id = await db.execute_write_fn(_log)
+    broker_for(db).publish_event(sync_job_id, {
+        "id": event_id,
+        "type": event_type,
+        "message": message,
+        "created_at": created_at,
+    })
 
 
-async def sync_document(db, document) -> int:
-    """Sync a document to the database if it doesn't exist. Returns document_id."""
-    def _sync(conn):
-        cursor = conn.execute(
-            "SELECT id FROM documents WHERE id = ?",
-            (document.id,)
-        )
-        row = cursor.fetchone()
+async def set_job_status(db, sync_job_id: str, status: str, error: Optional[str] = None):
+    """Record a job's final status and publish it to progress streams."""
+    completed_at = datetime.now().isoformat()
 
-        if not row:
-            conn.execute(
-                "INSERT INTO documents (id, page_count, data) VALUES (?, ?, ?)",
-                (document.id, document.page_count, json.dumps(document.data))
-            )
+    def _update(conn):
+        conn.execute(
+            "UPDATE sync_jobs SET status = ?, completed_at = ?, error = ? WHERE id = ?",
+            (status, completed_at, error, sync_job_id)
+        )
         conn.commit()
 
-    await db.execute_write_fn(_sync)
-    return document.id
+    await db.execute_write_fn(_update)
+    broker_for(db).publish_job(sync_job_id, {
+        "status": status,
+        "error": error,
+        "completed_at": completed_at,
+    })
 
 
-async def sync_page(db, document_id: int, page_number: int) -> int:
-    """Sync a page to the database if it doesn't exist. Returns page_id."""
-    def _sync(conn):
+async def create_work_units(db, sync_job_id: str, document_ids: list[int]) -> set[int]:
+    """
+    Record a work unit for each document in a job, keeping any that already
+    exist from an earlier, interrupted run. Returns the IDs of documents
+    that are already done.
+    """
+    def _create(conn):
+        conn.executemany(
+            """INSERT INTO sync_work_units (sync_job_id, document_id) VALUES (?, ?)
+            ON CONFLICT (sync_job_id, document_id) DO NOTHING""",
+            [(sync_job_id, document_id) for document_id in document_ids]
+        )
+        conn.commit()
         cursor = conn.execute(
-            "SELECT id FROM pages WHERE document_id = ? AND page_number = ?",
-            (document_id, page_number)
+            "SELECT document_id FROM sync_work_units WHERE sync_job_id = ? AND status = 'done'",
+            (sync_job_id,)
         )
-        row = cursor.fetchone()
+        return {row[0] for row in cursor.fetchall()}
+
+    return await db.execute_write_fn(_create)
+
+
+async def lease_work_unit(ctx: SyncContext, document_id: int):
+    """Mark a document as being worked on by this run of the job."""
+    await ctx.writer.write(
+        """UPDATE sync_work_units
+        SET status = 'leased', lease_owner = ?
+        WHERE sync_job_id = ? AND document_id = ?""",
+        (ctx.worker_id, ctx.sync_job_id, document_id)
+    )
 
-        if row:
-            return row[0]
 
+async def complete_work_unit(ctx: SyncContext, document_id: int):
+    """Mark a document as done, so a resumed job skips it."""
+    await ctx.writer.write(
+        """UPDATE sync_work_units
+        SET status = 'done', lease_owner = NULL, completed_at = CURRENT_TIMESTAMP
+        WHERE sync_job_id = ? AND document_id = ?""",
+        (ctx.sync_job_id, document_id)
+    )
+
+
+async def record_document_synced(
+    ctx: SyncContext, document, page_type_model: str, parser_model: str
+):
+    """
+    Record the version of a document whose pages have all been classified
+    and parsed with these models, so later syncs can skip it until it changes.
+    """
+    await ctx.writer.write(
+        """INSERT INTO document_syncs (document_id, page_type_model, parser_model, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (document_id, page_type_model, parser_model) DO UPDATE SET
+            updated_at = excluded.updated_at, synced_at = CURRENT_TIMESTAMP""",
+        (document.id, page_type_model, parser_model, document_version(document))
+    )
+
+
+async def release_work_unit(ctx: SyncContext, document_id: int):
+    """Give up a document that still has work left, for a later run to pick up."""
+    await ctx.writer.write(
+        """UPDATE sync_work_units
+        SET status = 'pending', lease_owner = NULL
+        WHERE sync_job_id = ? AND document_id = ?""",
+        (ctx.sync_job_id, document_id)
+    )
+
+
+async def record_page_failure(
+    ctx: SyncContext, work: PageWork, stage: str, model_id: str, ex: Exception
+):
+    """Record that a page couldn't be classified or parsed, without failing the job."""
+    error = str(ex) or ex.__class__.__name__
+    await ctx.writer.write(
+        """INSERT INTO page_failures (sync_job_id, page_id, stage, model, error)
+        VALUES (?, ?, ?, ?, ?)""",
+        (ctx.sync_job_id, work.page_id, stage, model_id, error)
+    )
+    action = "classify" if stage == "page_type" else "parse"
+    await ctx.log(
+        "error",
+        f"Couldn't {action} page {work.page_number} from document {work.document.id}: {error}"
+    )
+
+
+async def sync_document(db, document) -> dict[int, int]:
+    """
+    Sync a document and all of its pages to the database in one transaction,
+    creating any that don't exist. Its metadata is only rewritten when its
+    version (updated_at) has changed. Returns a {page_number: page_id} mapping.
+    """
+    def _sync(conn):
+        conn.execute(
+            """INSERT INTO documents (id, page_count, data, title, updated_at, file_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                page_count = excluded.page_count,
+                data = excluded.data,
+                title = excluded.title,
+                updated_at = excluded.updated_at,
+                file_hash = excluded.file_hash
+            WHERE documents.updated_at IS NOT excluded.updated_at""",
+            (
+                document.id,
+                document.page_count,
+                json.dumps(document.data),
+                getattr(document, "title", None),
+                document_version(document),
+                document_file_hash(document),
+            )
+        )
+        conn.executemany(
+            """INSERT INTO pages (document_id, page_number) VALUES (?, ?)
+            ON CONFLICT (document_id, page_number) DO NOTHING""",
+            [
+                (document.id, page_number)
+                for page_number in range(1, document.page_count + 1)
+            ]
+        )
         cursor = conn.execute(
-            "INSERT INTO pages (document_id, page_number) VALUES (?, ?)",
-            (document_id, page_number)
+            "SELECT page_number, id FROM pages WHERE document_id = ?",
+            (document.id,)
         )
-        conn.commit()
-        return cursor.lastrowid
+        return dict(cursor.fetchall())
 
     return await db.execute_write_fn(_sync)
 
 
 async def predict_page_type(
-    datasette,
-    db,
+    ctx: SyncContext,
     page_id: int,
     document,
     page_number: int,
     page_type_model: str
 ) -> str:
-    """Predict page type if not already predicted with this model. Returns predicted page type."""
-    # Check if already predicted
-    def _check_existing(conn):
-        cursor = conn.execute(
-            "SELECT predicted_page_type FROM page_type_predictions WHERE page_id = ? AND model = ?",
-            (page_id, page_type_model)
-        )
-        row = cursor.fetchone()
-        return row[0] if row else None
+    """
+    Predict the page type with this model and store the prediction. Returns
+    the predicted page type.
 
-    existing = await db.execute_write_fn(_check_existing)
-    if existing:
-        return existing
+    The job's local classifiers are tried first, and the model is only
+    prompted if none of them is confident; its answer is then passed back
+    to them to learn from.
 
-    # Get and process the page image
-    page_image_url: str = document.get_xlarge_image_url(page_number)
+    Callers are expected to have already checked (see load_document_plan)
+    that the page has no prediction from this model.
+    """
+    with timer() as get_elapsed:
+        prediction = await classify_locally(ctx, page_id, document, page_number, page_type_model)
+        if prediction is None:
+            prediction = await prompt_page_type(ctx, document, page_number, page_type_model)
+            await learn_page_type(ctx, page_id, document, page_number, page_type_model, prediction.page_type)
 
-    # Fetch image in thread pool since httpx.get is sync
-    loop = asyncio.get_event_loop()
-    page_image = await loop.run_in_executor(
-        None,
-        lambda: httpx.get(page_image_url).content
-    )
+    await store_prediction(ctx, page_id, page_type_model, prediction, {"time_taken_s": get_elapsed()})
+    return prediction.page_type
 
-    cropped_page_image = crop_page_image_for_prediction(page_image)
-    cropped_page_jpeg = gif_to_jpeg(cropped_page_image, quality=95)
 
-    # Make prediction using LlmWrapper
-    llm_wrapper = LlmWrapper(datasette)
-    model = llm_wrapper.get_async_model(page_type_model)
-    with timer() as get_elapsed:
-        response = await model.prompt(
-            PAGE_TYPE_PROMPT,
-            schema=Form460PageTypeModel,
-            attachments=[
-                llm.Attachment(
-                    type="image/jpeg",
-                    content=cropped_page_jpeg
-                )
-            ]
+async def classify_locally(
+    ctx: SyncContext,
+    page_id: int,
+    document,
+    page_number: int,
+    page_type_model: str
+) -> Optional[PagePrediction]:
+    """
+    The first prediction from the job's local classifiers with at least the
+    classifier_min_confidence option's confidence, if any.
+    """
+    for classifier in ctx.page_classifiers:
+        prediction = await classifier.classify(
+            ctx, page_id, document, page_number, page_type_model
         )
+        if prediction is not None and (prediction.confidence or 0) >= ctx.options.classifier_min_confidence:
+            return prediction
+    return None
 
-    response_text = await response.text()
-    data = json.loads(response_text)
-    predicted_page_type = data["page_type"]
-    
-    response_usage = await response.usage()
 
-    # Store prediction
-    def _store_prediction(conn):
-        conn.execute(
-            """INSERT INTO page_type_predictions
-            (page_id, model, predicted_page_type, model_usage, timing)
-            VALUES (?, ?, ?, ?, ?)""",
-            (
-                page_id,
-                page_type_model,
-                predicted_page_type,
-                json.dumps(asdict(response_usage)),
-                json.dumps({"time_taken_s": get_elapsed()})
-            )
+async def learn_page_type(
+    ctx: SyncContext,
+    page_id: int,
+    document,
+    page_number: int,
+    page_type_model: str,
+    page_type: str
+) -> None:
+    """Show the job's local classifiers the page type model's answer."""
+    for classifier in ctx.page_classifiers:
+        await classifier.learn(ctx, page_id, document, page_number, page_type_model, page_type)
+
+
+async def store_prediction(
+    ctx: SyncContext,
+    page_id: int,
+    page_type_model: str,
+    prediction: PagePrediction,
+    timing: dict
+) -> None:
+    await ctx.writer.write(
+        """INSERT INTO page_type_predictions
+        (page_id, model, predicted_page_type, classifier, confidence,
+         model_usage, image_profile, timing)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (page_id, model) DO NOTHING""",
+        (
+            page_id,
+            page_type_model,
+            prediction.page_type,
+            prediction.classifier,
+            prediction.confidence,
+            json.dumps(prediction.model_usage) if prediction.model_usage else None,
+            json.dumps(prediction.image_profile) if prediction.image_profile else None,
+            json.dumps(timing)
         )
-        conn.commit()
+    )
 
-    await db.execute_write_fn(_store_prediction)
-    return predicted_page_type
+
+async def prompt_page_type(
+    ctx: SyncContext,
+    document,
+    page_number: int,
+    page_type_model: str
+) -> PagePrediction:
+    """Ask the page type model for a page's type."""
+    # Get and process the page image
+    profile = ctx.options.image_profile_for_model(page_type_model)
+    page_image = await get_page_image(ctx, document, page_number, profile.size)
+
+    cropped_page_image = await ctx.encode_image(page_image, profile=profile, crop=PREDICTION_CROP)
+
+    # Make prediction
+    response_text, response_usage = await run_prompt(
+        ctx,
+        page_type_model,
+        PAGE_TYPE_PROMPT,
+        schema=Form460PageTypeModel,
+        attachments=[
+            llm.Attachment(
+                type=profile.mime_type,
+                content=cropped_page_image
+            )
+        ]
+    )
+
+    data = json.loads(response_text)
+
+    return PagePrediction(
+        data["page_type"],
+        "llm",
+        model_usage=asdict(response_usage),
+        image_profile=profile.to_dict(),
+    )
 
 
 async def parse_summary_page(
-    datasette,
-    db,
+    ctx: SyncContext,
     page_id: int,
     document,
     page_number: int,
     parser_model: str
 ) -> None:
-    """Parse a summary page if not already parsed with this model."""
-    # Get and process the page image
-    page_image_url: str = document.get_xlarge_image_url(page_number)
+    """Parse a summary page with this model and store the result."""
+    if await reuse_parsed_page(
+        ctx, page_id, document, page_number, "campaign_disclosure_summary_page", parser_model
+    ):
+        return
 
-    loop = asyncio.get_event_loop()
-    page_image = await loop.run_in_executor(
-        None,
-        lambda: httpx.get(page_image_url).content
-    )
+    # Get and process the page image
+    profile = ctx.options.image_profile_for_model(parser_model)
+    page_image = await get_page_image(ctx, document, page_number, profile.size)
 
-    page_jpeg = gif_to_jpeg(page_image, quality=95)
+    page_attachment = await ctx.encode_image(page_image, profile=profile)
 
-    # Parse the page using LlmWrapper
-    llm_wrapper = LlmWrapper(datasette)
-    model = llm_wrapper.get_async_model(parser_model)
+    # Parse the page
     with timer() as get_elapsed:
-        response = await model.prompt(
+        response_text, response_usage = await run_prompt(
+            ctx,
+            parser_model,
             SUMMARY_PAGE_PROMPT,
             schema=Form460SummaryPage,
             attachments=[
                 llm.Attachment(
-                    type="image/jpeg",
-                    content=page_jpeg
+                    type=profile.mime_type,
+                    content=page_attachment
                 )
             ]
         )
 
-    response_text = await response.text()
     data = json.loads(response_text)
     
-    response_usage = await response.usage()
-
     # Store parsed data
-    def _store_parsed(conn):
-        conn.execute(
-            """INSERT INTO page_parsed
-            (page_id, page_type, model, model_usage, timing, parsed_data)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (
-                page_id,
-                "campaign_disclosure_summary_page",
-                parser_model,
-                json.dumps(asdict(response_usage)),
-                json.dumps({"time_taken_s": get_elapsed()}),
-                json.dumps(data)
-            )
+    await ctx.writer.write(
+        """INSERT INTO page_parsed
+        (page_id, page_type, model, model_usage, image_profile, timing, parsed_data)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (page_id, page_type, model) DO NOTHING""",
+        (
+            page_id,
+            "campaign_disclosure_summary_page",
+            parser_model,
+            json.dumps(asdict(response_usage)),
+            json.dumps(profile.to_dict()),
+            json.dumps({"time_taken_s": get_elapsed()}),
+            json.dumps(data)
         )
-        conn.commit()
-
-    await db.execute_write_fn(_store_parsed)
+    )
 
 
 async def parse_schedule_a_page(
-    datasette,
-    db,
+    ctx: SyncContext,
     page_id: int,
     document,
     page_number: int,
     parser_model: str
 ) -> None:
-    """Parse a Schedule A page if not already parsed with this model."""
-    # Get and process the page image
-    page_image_url: str = document.get_xlarge_image_url(page_number)
+    """Parse a Schedule A page with this model and store the result."""
+    if await reuse_parsed_page(ctx, page_id, document, page_number, "schedule_a", parser_model):
+        return
 
-    loop = asyncio.get_event_loop()
-    page_image = await loop.run_in_executor(
-        None,
-        lambda: httpx.get(page_image_url).content
-    )
+    # Get and process the page image
+    profile = ctx.options.image_profile_for_model(parser_model)
+    page_image = await get_page_image(ctx, document, page_number, profile.size)
 
-    page_jpeg = gif_to_jpeg(page_image, quality=95)
+    page_attachment = await ctx.encode_image(page_image, profile=profile)
 
-    # Parse the page using LlmWrapper
-    llm_wrapper = LlmWrapper(datasette)
-    model = llm_wrapper.get_async_model(parser_model)
+    # Parse the page
     with timer() as get_elapsed:
-        response = await model.prompt(
+        response_text, response_usage = await run_prompt(
+            ctx,
+            parser_model,
             SCHEDULE_A_PROMPT,
             schema=Form460ScheduleA,
             attachments=[
                 llm.Attachment(
-                    type="image/jpeg",
-                    content=page_jpeg
+                    type=profile.mime_type,
+                    content=page_attachment
                 )
             ]
         )
 
-    response_text = await response.text()
     data = json.loads(response_text)
     
-    response_usage = await response.usage()
+    # Store parsed data
+    await ctx.writer.write(
+        """INSERT INTO page_parsed
+        (page_id, page_type, model, model_usage, image_profile, timing, parsed_data)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (page_id, page_type, model) DO NOTHING""",
+        (
+            page_id,
+            "schedule_a",
+            parser_model,
+            json.dumps(asdict(response_usage)),
+            json.dumps(profile.to_dict()),
+            json.dumps({"time_taken_s": get_elapsed()}),
+            json.dumps(data)
+        )
+    )
+
+
+async def parse_schedule_a_pages(
+    ctx: SyncContext,
+    works: list[PageWork],
+    parser_model: str
+) -> None:
+    """
+    Parse several Schedule A pages of one document with a single prompt,
+    storing a page_parsed row for each page so the Schedule A trigger still
+    runs once per page.
+
+    The whole batch's model_usage is stored with its first page; timing
+    records the batch size for every page. If the response doesn't validate
+    against the schema, or doesn't have one entry per page, each page is
+    parsed on its own instead.
+    """
+    pending = [
+        work for work in works
+        if not await reuse_parsed_page(
+            ctx, work.page_id, work.document, work.page_number, "schedule_a", parser_model
+        )
+    ]
+    if len(pending) < 2:
+        for work in pending:
+            await parse_schedule_a_page(
+                ctx, work.page_id, work.document, work.page_number, parser_model
+            )
+        return
+
+    # Get and process the page images
+    profile = ctx.options.image_profile_for_model(parser_model)
+    page_images = await asyncio.gather(*(
+        get_page_image(ctx, work.document, work.page_number, profile.size) for work in pending
+    ))
+    page_attachments = await asyncio.gather(*(
+        ctx.encode_image(page_image, profile=profile) for page_image in page_images
+    ))
+
+    # Parse the pages
+    with timer() as get_elapsed:
+        response_text, response_usage = await run_prompt(
+            ctx,
+            parser_model,
+            SCHEDULE_A_BATCH_PROMPT.format(count=len(pending)),
+            schema=Form460ScheduleAPages,
+            attachments=[
+                llm.Attachment(
+                    type=profile.mime_type,
+                    content=page_attachment
+                )
+                for page_attachment in page_attachments
+            ]
+        )
+
+    try:
+        Form460ScheduleAPages.model_validate_json(response_text)
+        pages = json.loads(response_text)["pages"]
+        if len(pages) != len(pending):
+            raise ValueError(f"expected {len(pending)} pages, got {len(pages)}")
+    except (ValidationError, ValueError) as ex:
+        page_numbers = ", ".join(str(work.page_number) for work in pending)
+        await ctx.log(
+            "info",
+            f"Batched parse of Schedule A pages {page_numbers} from document "
+            f"{pending[0].document.id} was invalid ({ex.__class__.__name__}), "
+            "parsing them one at a time"
+        )
+        await asyncio.gather(*(
+            parse_schedule_a_page(ctx, work.page_id, work.document, work.page_number, parser_model)
+            for work in pending
+        ))
+        return
+
+    elapsed = get_elapsed()
 
     # Store parsed data
-    def _store_parsed(conn):
-        conn.execute(
+    for i, (work, data) in enumerate(zip(pending, pages)):
+        await ctx.writer.write(
             """INSERT INTO page_parsed
-            (page_id, page_type, model, model_usage, timing, parsed_data)
-            VALUES (?, ?, ?, ?, ?, ?)""",
+            (page_id, page_type, model, model_usage, image_profile, timing, parsed_data)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (page_id, page_type, model) DO NOTHING""",
             (
-                page_id,
+                work.page_id,
                 "schedule_a",
                 parser_model,
-                json.dumps(asdict(response_usage)),
-                json.dumps({"time_taken_s": get_elapsed()}),
+                json.dumps(asdict(response_usage)) if i == 0 else None,
+                json.dumps(profile.to_dict()),
+                json.dumps({"time_taken_s": elapsed, "batch_size": len(pending), "batch_index": i}),
                 json.dumps(data)
             )
         )
-        conn.commit()
 
-    await db.execute_write_fn(_store_parsed)
+
+@dataclass
+class DocumentPlan:
+    """The work remaining for one document, computed before any is done."""
+    to_classify: list[PageWork]
+    to_parse: list[PageWork]
+    done: int
+    # Fingerprints of pages computed by earlier syncs, by page ID
+    fingerprints: dict[int, PageFingerprint] = field(default_factory=dict)
+
+
+async def load_document_plan(
+    db,
+    document,
+    page_ids: dict[int, int],
+    page_type_model: str,
+    parser_model: str,
+) -> DocumentPlan:
+    """
+    Work out which pages of a document still need classifying or parsing,
+    with one set-based query rather than a lookup per page.
+    """
+    def _load(conn):
+        cursor = conn.execute(
+            """SELECT
+                p.id,
+                p.content_hash,
+                p.phash,
+                ptp.predicted_page_type,
+                (
+                    SELECT json_group_array(pp.page_type)
+                    FROM page_parsed pp
+                    WHERE pp.page_id = p.id AND pp.model = :parser_model
+                ) AS parsed_page_types
+            FROM pages p
+            LEFT JOIN page_type_predictions ptp
+                ON ptp.page_id = p.id AND ptp.model = :page_type_model
+            WHERE p.document_id = :document_id""",
+            {
+                "document_id": document.id,
+                "page_type_model": page_type_model,
+                "parser_model": parser_model,
+            }
+        )
+        return cursor.fetchall()
+
+    existing = {}
+    plan = DocumentPlan(to_classify=[], to_parse=[], done=0)
+    for page_id, content_hash, phash, predicted_page_type, parsed_page_types in await db.execute_fn(_load):
+        existing[page_id] = (predicted_page_type, set(json.loads(parsed_page_types)))
+        if content_hash is not None:
+            plan.fingerprints[page_id] = PageFingerprint(content_hash, int(phash, 16))
+
+    for page_number in sorted(page_ids):
+        page_id = page_ids[page_number]
+        predicted_page_type, parsed_page_types = existing.get(page_id, (None, set()))
+        work = PageWork(document, page_id, page_number, predicted_page_type)
+        if predicted_page_type is None:
+            plan.to_classify.append(work)
+        elif (
+            predicted_page_type in PARSED_PAGE_TYPES
+            and PARSED_PAGE_TYPES[predicted_page_type] not in parsed_page_types
+        ):
+            plan.to_parse.append(work)
+        else:
+            plan.done += 1
+    return plan
 
 
 async def sync_project(
@@ -312,140 +871,608 @@ async def sync_project(
     sync_job_id: str,
     project_id: int,
     page_type_model: str,
-    parser_model: str
+    parser_model: str,
+    options: Optional[SyncOptions] = None,
+    worker_id: Optional[str] = None,
 ):
-    """Sync a DocumentCloud project to the database."""
-    # Initialize database schema
-    def init_schema(conn):
-        conn.executescript(SCHEMA)
+    """
+    Sync a DocumentCloud project to the database.
 
-    await db.execute_write_fn(init_schema)
+    Pages stream through a pipeline of stages connected by bounded queues:
 
-    await log_event(db, sync_job_id, "info", f"Starting sync for project {project_id}")
+        enumerate documents/pages -> classify (fetch image + predict) -> parse + store
 
-    
-    # Get project and documents
-    await log_event(db, sync_job_id, "info", "Fetching project from DocumentCloud...")
-    loop = asyncio.get_event_loop()
-    client = DocumentCloud()
-    project = await loop.run_in_executor(
-        None,
-        lambda: client.projects.get_by_id(project_id)
+    so a page predicted as a summary or Schedule A page is parsed as soon as
+    it has been classified, rather than after the whole project has been.
+
+    Each document is a work unit: once all of its pages have been classified
+    and parsed it is marked done, and a resumed job skips it.
+
+    With the batch_backend option, prompts are sent in batches instead (see
+    _sync_project_batched).
+    """
+    options = options or SyncOptions()
+    writer = BatchWriter(
+        db,
+        max_rows=options.write_batch_size,
+        max_delay=options.write_batch_delay_ms / 1000,
     )
+    async with create_http_client(options) as http, writer:
+        ctx = SyncContext(
+            datasette,
+            db,
+            sync_job_id,
+            options,
+            images=get_page_image_cache(datasette),
+            http=http,
+            writer=writer,
+            worker_id=worker_id,
+            image_executor=get_image_executor(datasette),
+            page_classifiers=[PAGE_CLASSIFIERS[name](options) for name in options.page_classifiers],
+        )
+        try:
+            if options.batch_backend:
+                await _sync_project_batched(ctx, project_id, page_type_model, parser_model)
+            else:
+                await _sync_project(ctx, project_id, page_type_model, parser_model)
+        finally:
+            ctx.close()
 
-    await log_event(db, sync_job_id, "info", f"Found {len(project.documents)} documents")
-
-    # Sync documents and pages
-    for document in project.documents:
-        document_id = await sync_document(db, document)
-        await log_event(db, sync_job_id, "info", f"Processing document {document.id} ({document.page_count} pages)...")
-
-        # Sync all pages for this document
-        for page_idx in range(document.page_count):
-            page_number = page_idx + 1
-            page_id = await sync_page(db, document_id, page_number)
-
-            # Predict page type if not already done with this model
-            await predict_page_type(
-                datasette,
-                db,
-                page_id,
-                document,
-                page_number,
-                page_type_model
-            )
 
-        await log_event(db, sync_job_id, "info", f"Completed page type predictions for document {document.id}")
+# How often the state of each model's limiter is logged during a sync
+LIMITER_REPORT_SECONDS = 60
+
 
-    # Parse summary pages for this project
-    def _get_summary_pages(conn):
+async def report_limiters(ctx: SyncContext, interval: float = LIMITER_REPORT_SECONDS):
+    """Log each model's limiter state every `interval` seconds, until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        for limiter in list(ctx.limiters.values()):
+            await ctx.log("info", limiter.describe())
+
+
+async def load_synced_versions(db, page_type_model: str, parser_model: str) -> dict[int, str]:
+    """{document_id: updated_at} for documents fully synced with these models."""
+    def _load(conn):
         cursor = conn.execute(
-            """SELECT DISTINCT p.id, p.document_id, p.page_number
-            FROM pages p
-            JOIN page_type_predictions ptp ON p.id = ptp.page_id
-            LEFT JOIN page_parsed pp ON p.id = pp.page_id
-                AND pp.page_type = 'campaign_disclosure_summary_page'
-                AND pp.model = ?
-            WHERE ptp.predicted_page_type = 'campaign_disclosure_summary_page'
-            AND ptp.model = ?
-            AND pp.id IS NULL""",
-            (parser_model, page_type_model)
+            """SELECT document_id, updated_at FROM document_syncs
+            WHERE page_type_model = ? AND parser_model = ?""",
+            (page_type_model, parser_model)
         )
-        return cursor.fetchall()
+        return dict(cursor.fetchall())
 
-    summary_pages = await db.execute_write_fn(_get_summary_pages)
+    return await db.execute_fn(_load)
 
-    if not summary_pages:
-        await log_event(db, sync_job_id, "info", "No summary pages to parse")
-    else:
-        await log_event(db, sync_job_id, "info", f"Parsing {len(summary_pages)} summary pages...")
-        for page_id, document_id, page_number in summary_pages:
-            # Get the document object
-            document = next(
-                (d for d in project.documents if d.id == document_id),
-                None
+
+async def fetch_project_documents(
+    ctx: SyncContext, project_id: int, page_type_model: str, parser_model: str
+) -> list:
+    """
+    Fetch a project's documents from DocumentCloud, and create this job's
+    work units for them. Documents finished by an earlier run of the job
+    are left out, as are documents that haven't changed since they were
+    last synced with these models, unless the incremental option is off.
+
+    The listing is compared with the project's last one, and the pages of
+    documents that were re-uploaded are deleted, so they are classified and
+    parsed again.
+    """
+    await ctx.log("info", "Fetching project from DocumentCloud...")
+    documents = await list_project_documents(
+        ctx.http, project_id, retries=ctx.options.http_retries
+    )
+
+    await ctx.log("info", f"Found {len(documents)} documents")
+    changes = await ctx.db.execute_write_fn(
+        lambda conn: apply_project_listing(conn, project_id, documents)
+    )
+    await ctx.log("info", changes.describe())
+    if changes.invalidated:
+        await ctx.log(
+            "info", f"Discarded the pages of {len(changes.invalidated)} re-uploaded documents"
+        )
+
+    done = await create_work_units(ctx.db, ctx.sync_job_id, [document.id for document in documents])
+    if done:
+        await ctx.log("info", f"Skipping {len(done)} documents finished by an earlier run")
+        documents = [document for document in documents if document.id not in done]
+
+    if not ctx.options.incremental:
+        return documents
+    synced = await load_synced_versions(ctx.db, page_type_model, parser_model)
+    unchanged = [
+        document for document in documents
+        if document_version(document) and synced.get(document.id) == document_version(document)
+    ]
+    if unchanged:
+        await ctx.log("info", f"Skipping {len(unchanged)} unchanged documents")
+        for document in unchanged:
+            await complete_work_unit(ctx, document.id)
+        unchanged_ids = {document.id for document in unchanged}
+        documents = [document for document in documents if document.id not in unchanged_ids]
+    return documents
+
+
+async def _sync_project(
+    ctx: SyncContext,
+    project_id: int,
+    page_type_model: str,
+    parser_model: str,
+):
+    db = ctx.db
+    concurrency = ctx.options.max_concurrent_pages
+
+    # No-op unless this database has not been migrated yet
+    await ensure_schema(db)
+
+    await ctx.log("info", f"Starting sync for project {project_id}")
+
+    documents = await fetch_project_documents(ctx, project_id, page_type_model, parser_model)
+
+    classify_queue: asyncio.Queue = asyncio.Queue(maxsize=ctx.options.queue_size)
+    parse_queue: asyncio.Queue = asyncio.Queue(maxsize=ctx.options.queue_size)
+    parsed_counts = {"campaign_disclosure_summary_page": 0, "schedule_a": 0}
+
+    # Schedule A pages are parsed in batches of this many, if more than one
+    batch_size = ctx.options.schedule_a_batch_size_for_model(parser_model)
+    # document ID -> Schedule A pages waiting for a full batch
+    schedule_a_batches: dict[int, list[PageWork]] = {}
+
+    # documentcloud's Document objects aren't hashable, so completions are
+    # tracked by document ID
+    documents_by_id = {document.id: document for document in documents}
+
+    async def _document_classified(document_id):
+        await ctx.log("info", f"Completed page type predictions for document {document_id}")
+        if batch_size > 1:
+            await parse_queue.put(DocumentQueued(documents_by_id[document_id]))
+
+    classified = OrderedCompletions(_document_classified)
+
+    # Pages of each document still to be classified or parsed
+    remaining: dict[int, int] = {}
+
+    async def document_done(document):
+        await complete_work_unit(ctx, document.id)
+        await record_document_synced(ctx, document, page_type_model, parser_model)
+
+    async def page_done(document):
+        remaining[document.id] -= 1
+        if remaining[document.id] == 0:
+            await document_done(document)
+
+    async def enumerate_pages():
+        for document in documents:
+            await lease_work_unit(ctx, document.id)
+            page_ids = await sync_document(db, document)
+            plan = await load_document_plan(
+                db, document, page_ids, page_type_model, parser_model
             )
-            if not document:
-                await log_event(db, sync_job_id, "warning", f"Could not find document {document_id}, skipping page {page_number}")
-                continue
-
-            await parse_summary_page(
-                datasette,
-                db,
-                page_id,
-                document,
-                page_number,
-                parser_model
+            await ctx.log(
+                "info",
+                f"Processing document {document.id} ({document.page_count} pages, "
+                f"{len(plan.to_classify)} to classify, {len(plan.to_parse)} to parse)..."
             )
-            await log_event(db, sync_job_id, "info", f"Parsed summary page {page_number} from document {document_id}")
-
-    # Parse Schedule A pages for this project
-    def _get_schedule_a_pages(conn):
-        cursor = conn.execute(
-            """SELECT DISTINCT p.id, p.document_id, p.page_number
-            FROM pages p
-            JOIN page_type_predictions ptp ON p.id = ptp.page_id
-            LEFT JOIN page_parsed pp ON p.id = pp.page_id
-                AND pp.page_type = 'schedule_a'
-                AND pp.model = ?
-            WHERE ptp.predicted_page_type IN ('schedule_a', 'schedule_a_continuation')
-            AND ptp.model = ?
-            AND pp.id IS NULL""",
-            (parser_model, page_type_model)
+            ctx.fingerprints.update(plan.fingerprints)
+            remaining[document.id] = len(plan.to_classify) + len(plan.to_parse)
+            if remaining[document.id] == 0:
+                await document_done(document)
+            # Pages classified by an earlier sync go straight to parsing
+            for work in plan.to_parse:
+                await parse_queue.put(work)
+            await classified.register(document.id, len(plan.to_classify))
+            for work in plan.to_classify:
+                await classify_queue.put(work)
+        await close_stage(classify_queue, concurrency)
+
+    # Pages that failed, retried once everything else is done
+    failed: list[PageWork] = []
+
+    async def page_failed(work: PageWork, stage: str, ex: Exception):
+        failed.append(work)
+        model_id = page_type_model if stage == "page_type" else parser_model
+        await record_page_failure(ctx, work, stage, model_id, ex)
+
+    async def predict(work: PageWork) -> bool:
+        try:
+            work.predicted_page_type = await predict_page_type(
+                ctx,
+                work.page_id,
+                work.document,
+                work.page_number,
+                page_type_model
+            )
+        except Exception as ex:
+            await page_failed(work, "page_type", ex)
+            return False
+        if work.predicted_page_type not in PARSED_PAGE_TYPES:
+            await page_done(work.document)
+            return False
+        return True
+
+    async def classify(work: PageWork):
+        if await predict(work):
+            await parse_queue.put(work)
+        await classified.finish(work.document.id)
+
+    async def classify_stage():
+        await stage_workers(classify_queue, classify, concurrency)
+        await close_stage(parse_queue, concurrency)
+
+    async def parse_batch(batch: list[PageWork]):
+        batch.sort(key=lambda work: work.page_number)
+        try:
+            await parse_schedule_a_pages(ctx, batch, parser_model)
+        except Exception as ex:
+            for work in batch:
+                await page_failed(work, "parse", ex)
+            return
+        parsed_counts["schedule_a"] += len(batch)
+        page_numbers = ", ".join(str(work.page_number) for work in batch)
+        label = "page" if len(batch) == 1 else "pages"
+        await ctx.log(
+            "info", f"Parsed Schedule A {label} {page_numbers} from document {batch[0].document.id}"
         )
-        return cursor.fetchall()
+        for work in batch:
+            await page_done(work.document)
+
+    async def parse(item):
+        if isinstance(item, DocumentQueued):
+            batch = schedule_a_batches.pop(item.document.id, None)
+            if batch:
+                await parse_batch(batch)
+            return
+        work: PageWork = item
+        page_type = PARSED_PAGE_TYPES[work.predicted_page_type]
+        if page_type == "schedule_a" and batch_size > 1:
+            batch = schedule_a_batches.setdefault(work.document.id, [])
+            batch.append(work)
+            if len(batch) == batch_size:
+                await parse_batch(schedule_a_batches.pop(work.document.id))
+            return
+        await parse_page(work)
+
+    async def parse_page(work: PageWork):
+        page_type = PARSED_PAGE_TYPES[work.predicted_page_type]
+        if page_type == "campaign_disclosure_summary_page":
+            parse_fn, label = parse_summary_page, "summary"
+        else:
+            parse_fn, label = parse_schedule_a_page, "Schedule A"
+        try:
+            await parse_fn(ctx, work.page_id, work.document, work.page_number, parser_model)
+        except Exception as ex:
+            await page_failed(work, "parse", ex)
+            return
+        parsed_counts[page_type] += 1
+        await ctx.log("info", f"Parsed {label} page {work.page_number} from document {work.document.id}")
+        await page_done(work.document)
+
+    async def parse_stage():
+        await stage_workers(parse_queue, parse, concurrency)
+        # Every batch should have been flushed by its DocumentQueued; don't
+        # leave a document's work unit unfinished if one wasn't
+        for batch in list(schedule_a_batches.values()):
+            await parse_batch(batch)
+        schedule_a_batches.clear()
+
+    async def retry(work: PageWork):
+        if work.predicted_page_type is None and not await predict(work):
+            return
+        await parse_page(work)
+
+    async def retry_failed():
+        retry_queue: asyncio.Queue = asyncio.Queue(maxsize=ctx.options.queue_size)
+        retries = failed[:]
+        failed.clear()
+        await ctx.log("info", f"Retrying {len(retries)} failed pages")
+
+        async def enqueue_retries():
+            for work in retries:
+                await retry_queue.put(work)
+            await close_stage(retry_queue, concurrency)
+
+        await run_stages(enqueue_retries(), stage_workers(retry_queue, retry, concurrency))
+
+    reporter = asyncio.ensure_future(report_limiters(ctx))
+    try:
+        await run_stages(
+            enumerate_pages(),
+            classify_stage(),
+            parse_stage(),
+        )
+        if failed:
+            await retry_failed()
+    finally:
+        reporter.cancel()
+
+    await ctx.log(
+        "info",
+        f"Parsed {parsed_counts['campaign_disclosure_summary_page']} summary pages "
+        f"and {parsed_counts['schedule_a']} Schedule A pages"
+    )
+    for limiter in ctx.limiters.values():
+        await ctx.log("info", limiter.describe())
+    if failed:
+        failed_documents = {work.document.id for work in failed}
+        for document_id in failed_documents:
+            await release_work_unit(ctx, document_id)
+        await ctx.log(
+            "error",
+            f"{len(failed)} pages in {len(failed_documents)} documents failed twice, "
+            "and will be retried by the next sync"
+        )
+    await ctx.log("info", f"Downloaded {ctx.image_downloads} page images")
+    await ctx.log("success", "Sync complete!")
+
+
+async def _batch_request_line(
+    ctx: SyncContext,
+    custom_id: str,
+    work: PageWork,
+    model_id: str,
+    prompt: str,
+    schema,
+    crop: Optional[tuple[float, float]] = None,
+) -> str:
+    profile = ctx.options.image_profile_for_model(model_id)
+    page_image = await get_page_image(ctx, work.document, work.page_number, profile.size)
+    attachment = await ctx.encode_image(page_image, profile=profile, crop=crop)
+    return batch_request(custom_id, model_id, prompt, schema, [(profile.mime_type, attachment)])
 
-    schedule_a_pages = await db.execute_write_fn(_get_schedule_a_pages)
 
-    if not schedule_a_pages:
-        await log_event(db, sync_job_id, "info", "No Schedule A pages to parse")
+async def write_batch_file(
+    ctx: SyncContext,
+    works: list[PageWork],
+    build: Callable[[PageWork], Awaitable[Optional[str]]],
+) -> tuple[Path, int]:
+    """
+    Write a batch job file with a line from build() for each page that
+    needs one, building up to max_concurrent_pages lines at a time. Returns
+    the file and the number of requests in it.
+    """
+    concurrency = ctx.options.max_concurrent_pages
+    queue: asyncio.Queue = asyncio.Queue(maxsize=ctx.options.queue_size)
+    fd, name = tempfile.mkstemp(prefix="ca460-batch-", suffix=".jsonl")
+    count = 0
+
+    async def enqueue():
+        for work in works:
+            await queue.put(work)
+        await close_stage(queue, concurrency)
+
+    async def build_line(work: PageWork):
+        nonlocal count
+        line = await build(work)
+        if line is not None:
+            fp.write(line + "\n")
+            count += 1
+
+    try:
+        with os.fdopen(fd, "w") as fp:
+            await run_stages(enqueue(), stage_workers(queue, build_line, concurrency))
+    except BaseException:
+        os.unlink(name)
+        raise
+    return Path(name), count
+
+
+async def run_batch_stage(
+    ctx: SyncContext,
+    backend: BatchBackend,
+    stage: str,
+    works: list[PageWork],
+    build: Callable[[PageWork], Awaitable[Optional[str]]],
+    ingest: Callable[[str, dict, str], Awaitable[None]],
+) -> set[int]:
+    """
+    Run one stage of a batch mode sync: submit a batch with a request for
+    each of `works` that build() returns one for, wait for it to finish,
+    then pass each result to ingest(custom_id, result, batch_id).
+
+    If this job already submitted a batch for the stage that hasn't been
+    ingested, it is waited on instead. Returns the IDs of pages whose
+    requests failed, or whose results couldn't be ingested.
+    """
+    db = ctx.db
+
+    def _unfinished(conn):
+        return conn.execute(
+            """SELECT id, request_count FROM sync_batches
+            WHERE sync_job_id = ? AND stage = ? AND status IN ('submitted', 'completed')
+            ORDER BY submitted_at DESC LIMIT 1""",
+            (ctx.sync_job_id, stage)
+        ).fetchone()
+
+    async def _set_status(batch_id: str, status: str):
+        def _update(conn):
+            conn.execute(
+                """UPDATE sync_batches SET status = ?,
+                completed_at = CASE WHEN ? = 'completed' THEN CURRENT_TIMESTAMP ELSE completed_at END
+                WHERE id = ?""",
+                (status, status, batch_id)
+            )
+            conn.commit()
+
+        await db.execute_write_fn(_update)
+
+    row = await db.execute_fn(_unfinished)
+    if row is not None:
+        batch_id, count = row
+        await ctx.log("info", f"Resuming {stage} batch {batch_id} ({count} requests)")
     else:
-        await log_event(db, sync_job_id, "info", f"Parsing {len(schedule_a_pages)} Schedule A pages...")
-        for page_id, document_id, page_number in schedule_a_pages:
-            # Get the document object
-            document = next(
-                (d for d in project.documents if d.id == document_id),
-                None
+        path, count = await write_batch_file(ctx, works, build)
+        try:
+            if not count:
+                return set()
+            batch_id = await backend.submit(path)
+        finally:
+            path.unlink()
+
+        def _record(conn):
+            conn.execute(
+                """INSERT INTO sync_batches (id, sync_job_id, backend, stage, request_count)
+                VALUES (?, ?, ?, ?, ?)""",
+                (batch_id, ctx.sync_job_id, backend.name, stage, count)
             )
-            if not document:
-                await log_event(db, sync_job_id, "warning", f"Could not find document {document_id}, skipping page {page_number}")
-                continue
+            conn.commit()
 
-            await parse_schedule_a_page(
-                datasette,
-                db,
-                page_id,
-                document,
-                page_number,
-                parser_model
+        await db.execute_write_fn(_record)
+        await ctx.log("info", f"Submitted {count} {stage} requests as batch {batch_id}")
+
+    while (status := await backend.poll(batch_id)) == BATCH_RUNNING:
+        await asyncio.sleep(ctx.options.batch_poll_seconds)
+    if status == BATCH_FAILED:
+        await _set_status(batch_id, "failed")
+        raise BatchError(f"Batch {batch_id} failed")
+    await _set_status(batch_id, "completed")
+
+    failed: set[int] = set()
+    for result in read_jsonl(await backend.results(batch_id)):
+        custom_id = result["custom_id"]
+        page_id = int(custom_id.rsplit(":", 1)[1])
+        if result.get("error"):
+            failed.add(page_id)
+            await ctx.log("error", f"Batch request {custom_id} failed: {result['error']}")
+            continue
+        try:
+            await ingest(custom_id, result, batch_id)
+        except (ValueError, KeyError, TypeError) as ex:
+            failed.add(page_id)
+            await ctx.log("error", f"Couldn't ingest batch result {custom_id}: {ex!r}")
+    await ctx.writer.flush()
+    await _set_status(batch_id, "ingested")
+    await ctx.log("info", f"Ingested {stage} batch {batch_id} ({len(failed)} failed)")
+    return failed
+
+
+async def _sync_project_batched(
+    ctx: SyncContext,
+    project_id: int,
+    page_type_model: str,
+    parser_model: str,
+):
+    """
+    Sync a project through the job's batch backend: every page that needs
+    classifying goes in one batch, then every page that needs parsing in
+    another. Local classifiers and reused parses are applied while the
+    batch files are written, so only pages that need a model are sent.
+
+    Pages whose requests fail are logged and left for a later sync; their
+    documents' work units are left unfinished.
+    """
+    db = ctx.db
+    backend = BATCH_BACKENDS[ctx.options.batch_backend](ctx.datasette, limiter=ctx.limiter)
+
+    await ensure_schema(db)
+    await ctx.log("info", f"Starting batch sync for project {project_id} with the {backend.name} backend")
+    documents = await fetch_project_documents(ctx, project_id, page_type_model, parser_model)
+
+    page_ids = {}
+    for document in documents:
+        await lease_work_unit(ctx, document.id)
+        page_ids[document.id] = await sync_document(db, document)
+
+    async def load_plans() -> list[DocumentPlan]:
+        await ctx.writer.flush()
+        plans = []
+        for document in documents:
+            plan = await load_document_plan(
+                db, document, page_ids[document.id], page_type_model, parser_model
             )
-            await log_event(db, sync_job_id, "info", f"Parsed Schedule A page {page_number} from document {document_id}")
+            ctx.fingerprints.update(plan.fingerprints)
+            plans.append(plan)
+        return plans
+
+    # Page type predictions
+    to_classify = {
+        work.page_id: work for plan in await load_plans() for work in plan.to_classify
+    }
+
+    async def build_page_type(work: PageWork) -> Optional[str]:
+        with timer() as get_elapsed:
+            prediction = await classify_locally(
+                ctx, work.page_id, work.document, work.page_number, page_type_model
+            )
+        if prediction is not None:
+            await store_prediction(
+                ctx, work.page_id, page_type_model, prediction, {"time_taken_s": get_elapsed()}
+            )
+            return None
+        return await _batch_request_line(
+            ctx, f"page_type:{work.page_id}", work, page_type_model,
+            PAGE_TYPE_PROMPT, Form460PageTypeModel, crop=PREDICTION_CROP,
+        )
 
-    await log_event(db, sync_job_id, "success", "Sync complete!")
+    async def ingest_page_type(custom_id: str, result: dict, batch_id: str):
+        page_id = int(custom_id.split(":")[1])
+        prediction = PagePrediction(
+            json.loads(result["text"])["page_type"],
+            "llm",
+            model_usage=result.get("usage"),
+            image_profile=ctx.options.image_profile_for_model(page_type_model).to_dict(),
+        )
+        await store_prediction(ctx, page_id, page_type_model, prediction, {"batch_id": batch_id})
+        work = to_classify.get(page_id)
+        if work is not None:
+            await learn_page_type(
+                ctx, page_id, work.document, work.page_number, page_type_model, prediction.page_type
+            )
 
+    failed = await run_batch_stage(
+        ctx, backend, "page_type", list(to_classify.values()), build_page_type, ingest_page_type
+    )
 
+    # Parses of summary and Schedule A pages
+    to_parse = [work for plan in await load_plans() for work in plan.to_parse]
+
+    async def build_parse(work: PageWork) -> Optional[str]:
+        page_type = PARSED_PAGE_TYPES[work.predicted_page_type]
+        if await reuse_parsed_page(
+            ctx, work.page_id, work.document, work.page_number, page_type, parser_model
+        ):
+            return None
+        prompt, schema = PARSERS[page_type]
+        return await _batch_request_line(
+            ctx, f"{page_type}:{work.page_id}", work, parser_model, prompt, schema
+        )
 
+    async def ingest_parse(custom_id: str, result: dict, batch_id: str):
+        page_type, page_id = custom_id.split(":")
+        data = json.loads(result["text"])
+        await ctx.writer.write(
+            """INSERT INTO page_parsed
+            (page_id, page_type, model, model_usage, image_profile, timing, parsed_data)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (page_id, page_type, model) DO NOTHING""",
+            (
+                int(page_id),
+                page_type,
+                parser_model,
+                json.dumps(result["usage"]) if result.get("usage") else None,
+                json.dumps(ctx.options.image_profile_for_model(parser_model).to_dict()),
+                json.dumps({"batch_id": batch_id}),
+                json.dumps(data)
+            )
+        )
 
+    failed |= await run_batch_stage(ctx, backend, "parse", to_parse, build_parse, ingest_parse)
+
+    failed_documents = set()
+    for document in documents:
+        if failed & set(page_ids[document.id].values()):
+            failed_documents.add(document.id)
+            await release_work_unit(ctx, document.id)
+        else:
+            await complete_work_unit(ctx, document.id)
+            await record_document_synced(ctx, document, page_type_model, parser_model)
+    if failed:
+        await ctx.log(
+            "error",
+            f"{len(failed)} pages in {len(failed_documents)} documents failed, "
+            "and will be retried by the next sync"
+        )
+    await ctx.log("info", f"Downloaded {ctx.image_downloads} page images")
+    await ctx.log("success", "Sync complete!")
 
 
 async def run_sync_in_background(
@@ -454,9 +1481,16 @@ async def run_sync_in_background(
     sync_job_id: str,
     project_id: int,
     page_type_model: str,
-    parser_model: str
+    parser_model: str,
+    options: Optional[SyncOptions] = None,
+    worker_id: Optional[str] = None,
 ):
-    """Run sync in background, updating job status."""
+    """
+    Run sync in background, updating job status.
+
+    Called by the job scheduler (see jobs.py). If the job is paused or
+    cancelled the task is cancelled, and its status is left to the caller.
+    """
     db = datasette.get_database(database_name)
 
     try:
@@ -466,31 +1500,18 @@ async def run_sync_in_background(
             sync_job_id,
             project_id,
             page_type_model,
-            parser_model
+            parser_model,
+            options,
+            worker_id,
         )
 
         # Mark job as completed
-        def _complete_job(conn):
-            conn.execute(
-                "UPDATE sync_jobs SET status = 'completed', completed_at = ? WHERE id = ?",
-                (datetime.now().isoformat(), sync_job_id)
-            )
-            conn.commit()
-
-        await db.execute_write_fn(_complete_job)
+        await set_job_status(db, sync_job_id, "completed")
 
     except Exception as e:
         # Log error and mark job as failed
         error_msg = f"{str(e)}\n\n{traceback.format_exc()}"
         error_msg_short = str(e)
         await log_event(db, sync_job_id, "error", error_msg)
-
-        def _fail_job(conn):
-            conn.execute(
-                "UPDATE sync_jobs SET status = 'failed', completed_at = ?, error = ? WHERE id = ?",
-                (datetime.now().isoformat(), error_msg_short, sync_job_id)
-            )
-            conn.commit()
-
-        await db.execute_write_fn(_fail_job)
+        await set_job_status(db, sync_job_id, "failed", error_msg_short)
 
@@ -0,0 +1,104 @@
+import asyncio
+from itertools import groupby
+from typing import Callable, Optional, Sequence
+
+
+class BatchWriter:
+    """
+    Buffers INSERT statements and writes them in batches.
+
+    Every write() is queued in memory and flushed with executemany() inside
+    a single transaction on Datasette's write thread, either once
+    `max_rows` rows are pending or `max_delay` seconds after the oldest
+    pending row, whichever comes first. Rows are written in the order they
+    were queued, so triggers and AUTOINCREMENT ids behave exactly as if each
+    statement had been executed individually.
+
+    Pass on_insert to be called with a row's id once its batch has been
+    committed.
+
+    Use as an async context manager so pending rows are flushed on exit.
+    """
+
+    def __init__(self, db, max_rows: int = 500, max_delay: float = 0.25):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._pending: list[tuple[str, Sequence, Optional[Callable[[int], None]]]] = []
+        self._flush_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timed_flush: Optional[asyncio.Task] = None
+        # Error from a timer-triggered flush, re-raised on the next write
+        self._error: Optional[Exception] = None
+        # Number of write transactions issued, for reporting
+        self.flushes = 0
+
+    async def write(
+        self,
+        sql: str,
+        params: Sequence,
+        on_insert: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        if self._error is not None:
+            raise self._error
+        self._pending.append((sql, params, on_insert))
+        if len(self._pending) >= self.max_rows:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self._schedule_flush
+            )
+
+    def _schedule_flush(self) -> None:
+        self._timer = None
+        self._timed_flush = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        try:
+            await self.flush()
+        except Exception as e:
+            self._error = e
+
+    async def flush(self) -> None:
+        if self._error is not None:
+            raise self._error
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._flush_lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+
+            def _write(conn):
+                inserted = []
+                for sql, rows in groupby(pending, key=lambda item: item[0]):
+                    rows = list(rows)
+                    if not any(on_insert for _, _, on_insert in rows):
+                        conn.executemany(sql, [params for _, params, _ in rows])
+                        continue
+                    # executemany() doesn't report row ids, so rows that
+                    # want theirs are executed one at a time
+                    for _, params, on_insert in rows:
+                        cursor = conn.execute(sql, params)
+                        if on_insert:
+                            inserted.append((on_insert, cursor.lastrowid))
+                return inserted
+
+            inserted = await self.db.execute_write_fn(_write)
+            self.flushes += 1
+            for on_insert, rowid in inserted:
+                on_insert(rowid)
+
+    async def __aenter__(self) -> "BatchWriter":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self._timed_flush is not None:
+            await self._timed_flush
+        try:
+            await self.flush()
+        except Exception:
+            # Don't mask the exception that is already propagating
+            if exc_type is None:
+                raise
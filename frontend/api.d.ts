@@ -118,7 +118,13 @@ export interface paths {
         };
         get: {
             parameters: {
-                query?: never;
+                query?: {
+                    before?: number;
+                    limit?: number;
+                    model?: string;
+                    q?: string;
+                    min_models?: number;
+                };
                 header?: never;
                 path: {
                     database: string;
@@ -136,6 +142,8 @@ export interface paths {
                         "application/json": {
                             /** Documents */
                             documents: components["schemas"]["DocumentListItem"][];
+                            /** Next */
+                            next: number | null;
                         };
                     };
                 };
@@ -221,6 +229,42 @@ export interface paths {
         patch?: never;
         trace?: never;
     };
+    "/{database}/-/ca460/sync/{sync_job_id}/events/stream": {
+        parameters: {
+            query?: never;
+            header?: never;
+            path?: never;
+            cookie?: never;
+        };
+        get: {
+            parameters: {
+                query?: never;
+                header?: never;
+                path: {
+                    database: string;
+                    sync_job_id: string;
+                };
+                cookie?: never;
+            };
+            requestBody?: never;
+            responses: {
+                /** @description OK */
+                200: {
+                    headers: {
+                        [name: string]: unknown;
+                    };
+                    content?: never;
+                };
+            };
+        };
+        put?: never;
+        post?: never;
+        delete?: never;
+        options?: never;
+        head?: never;
+        patch?: never;
+        trace?: never;
+    };
     "/{database}/-/ca460/api/sync": {
         parameters: {
             query?: never;
@@ -256,6 +300,43 @@ export interface paths {
         patch?: never;
         trace?: never;
     };
+    "/{database}/-/ca460/api/sync/{sync_job_id}/{action}": {
+        parameters: {
+            query?: never;
+            header?: never;
+            path?: never;
+            cookie?: never;
+        };
+        get?: never;
+        put?: never;
+        post: {
+            parameters: {
+                query?: never;
+                header?: never;
+                path: {
+                    database: string;
+                    sync_job_id: string;
+                    action: "pause" | "resume" | "cancel";
+                };
+                cookie?: never;
+            };
+            requestBody?: never;
+            responses: {
+                /** @description OK */
+                200: {
+                    headers: {
+                        [name: string]: unknown;
+                    };
+                    content?: never;
+                };
+            };
+        };
+        delete?: never;
+        options?: never;
+        head?: never;
+        patch?: never;
+        trace?: never;
+    };
 }
 export type webhooks = Record<string, never>;
 export interface components {
@@ -270,6 +351,14 @@ export interface components {
             title: string | null;
             /** Model Count */
             model_count: number;
+            /** Parsed Pages */
+            parsed_pages: number;
+            /** Summary Pages */
+            summary_pages: number;
+            /** Schedule A Pages */
+            schedule_a_pages: number;
+            /** Last Parsed At */
+            last_parsed_at: string | null;
         };
     };
     responses: never;
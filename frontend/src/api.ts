@@ -7,8 +7,8 @@ const client = createClient<paths>({
   baseUrl: BASE_URL,
 });
 
-export async function documents(database: string) {
+export async function documents(database: string, before?: number) {
   return client.GET("/{database}/-/ca460/api/documents", {
-    params: { path: { database } },
+    params: { path: { database }, query: before ? { before } : {} },
   });
 }
@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+from datasette.app import Datasette
+from datasette_ca460 import models
+from datasette_ca460.batch_api import (
+    BATCH_COMPLETED,
+    BATCH_RUNNING,
+    LocalBatchBackend,
+    batch_request,
+    read_jsonl,
+)
+from datasette_ca460.limiter import ModelLimiter
+from extract_ca460.form460_page_type import Form460PageTypeModel
+import asyncio
+import json
+import pytest
+
+
+@dataclass
+class Usage:
+    input: int = 10
+    output: int = 2
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self._text = text
+
+    async def text(self):
+        return self._text
+
+    async def usage(self):
+        return Usage()
+
+
+class FakeModel:
+    async def prompt(self, prompt, schema=None, attachments=None):
+        if attachments[0].content == b"bad":
+            raise ValueError("unreadable image")
+        return FakeResponse(json.dumps({"page_type": attachments[0].content.decode()}))
+
+
+class FakeLlmWrapper:
+    def __init__(self, datasette):
+        pass
+
+    def get_async_model(self, model_id):
+        return FakeModel()
+
+
+@pytest.mark.asyncio
+async def test_local_batch_backend_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(models, "LlmWrapper", FakeLlmWrapper)
+    datasette = Datasette(
+        memory=True,
+        config={"plugins": {"datasette-ca460": {"batch_dir": str(tmp_path / "batches")}}},
+    )
+    job_file = tmp_path / "job.jsonl"
+    job_file.write_text("".join(
+        batch_request(f"page_type:{i}", "m", "prompt", Form460PageTypeModel, [("image/jpeg", content)]) + "\n"
+        for i, content in enumerate([b"cover_page", b"bad", b"schedule_a"])
+    ))
+    # Prompts go through the job's limiter for the model
+    limiter = ModelLimiter("m", 1)
+    backend = LocalBatchBackend(datasette, limiter=lambda model_id: limiter)
+    batch_id = await backend.submit(job_file)
+    assert (tmp_path / "batches" / batch_id / "input.jsonl").exists()
+    # Running batches are tracked per Datasette instance
+    assert batch_id in LocalBatchBackend(datasette)._tasks
+    assert LocalBatchBackend(Datasette(memory=True))._tasks == {}
+
+    status = await backend.poll(batch_id)
+    while status == BATCH_RUNNING:
+        await asyncio.sleep(0.01)
+        status = await backend.poll(batch_id)
+    assert status == BATCH_COMPLETED
+
+    results = {
+        result["custom_id"]: result
+        for result in read_jsonl(await backend.results(batch_id))
+    }
+    assert json.loads(results["page_type:0"]["text"]) == {"page_type": "cover_page"}
+    assert results["page_type:0"]["usage"] == {"input": 10, "output": 2}
+    assert results["page_type:1"]["error"] == "unreadable image"
+    assert json.loads(results["page_type:2"]["text"]) == {"page_type": "schedule_a"}
+    assert (limiter.succeeded, limiter.failed, limiter.in_flight) == (2, 1, 0)
@@ -0,0 +1,88 @@
+from datasette_ca460.classifiers import (
+    HeaderHashClassifier, PageClassifier, PagePrediction, classify_page_text,
+)
+from datasette_ca460.image_processing import PREDICTION_CROP, page_dhash
+from datasette_ca460.options import SyncOptions
+from datasette_ca460.sync import classify_locally
+from io import BytesIO
+from PIL import Image, ImageDraw
+from types import SimpleNamespace
+import pytest
+
+
+def _page(header, noise):
+    # A page with a boxed header that depends on the page type, and a body
+    # that differs from page to page
+    im = Image.new("L", (1700, 2200), 255)
+    draw = ImageDraw.Draw(im)
+    draw.rectangle((40, 40, 840, 360), outline=0, width=6)
+    for x in range(60, 820, header):
+        draw.line((x, 60, x, 340), fill=0, width=8)
+    for y in range(400, 2100, 60):
+        draw.line((80, y, 80 + (y * noise) % 1500, y), fill=0, width=3)
+    out = BytesIO()
+    im.convert("P").save(out, format="GIF")
+    return out.getvalue()
+
+
+def _hash(header, noise):
+    return page_dhash(_page(header, noise), PREDICTION_CROP)
+
+
+def test_header_hash_classifier_matches_nearest_templates():
+    classifier = HeaderHashClassifier(SyncOptions())
+    templates = [(_hash(40, n), "schedule_a") for n in range(1, 4)]
+    # Too few templates to be confident about anything
+    assert classifier.match(templates, _hash(40, 7)) is None
+
+    templates += [(_hash(40, n), "schedule_a") for n in range(4, 6)]
+    templates += [(_hash(90, n), "cover_page") for n in range(1, 6)]
+    prediction = classifier.match(templates, _hash(40, 7))
+    assert (prediction.page_type, prediction.classifier, prediction.confidence) == (
+        "schedule_a", "header-hash", 1.0
+    )
+    assert classifier.match(templates, _hash(90, 7)).page_type == "cover_page"
+    # A header unlike any template is left to the model
+    assert classifier.match(templates, _hash(65, 7)) is None
+
+
+class FixedClassifier(PageClassifier):
+    def __init__(self, name, confidence):
+        self.name = name
+        self.confidence = confidence
+
+    async def classify(self, ctx, page_id, document, page_number, model_id):
+        return PagePrediction("schedule_a", self.name, self.confidence)
+
+
+@pytest.mark.asyncio
+async def test_unconfident_predictions_are_passed_on():
+    ctx = SimpleNamespace(
+        options=SyncOptions(),
+        page_classifiers=[FixedClassifier("unsure", 0.6), FixedClassifier("sure", 0.8)],
+    )
+    prediction = await classify_locally(ctx, 1, None, 1, "m1")
+    assert prediction.classifier == "sure"
+    ctx.options.classifier_min_confidence = 0.9
+    assert await classify_locally(ctx, 1, None, 1, "m1") is None
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("SCHEDULE A MONETARY CONTRIBUTIONS RECEIVED Statement covers period", "schedule_a"),
+        ("Schedule A (Continuation Sheet)\nMonetary Contributions Received", "schedule_a_continuation"),
+        ("SCHEDULE E (CONT.) PAYMENTS MADE", "schedule_e_payments_made_continuation"),
+        ("Schedule B – Part 2 Loan Guarantors", "schedule_b_part2_loan_guarantors"),
+        ("Campaign Disclosure Statement Summary Page", "campaign_disclosure_summary_page"),
+        ("Recipient Committee Campaign Statement Cover Page — Part 2", "cover_page_2"),
+        ("Recipient Committee Campaign Statement Cover Page", "cover_page"),
+        # Ambiguous or missing titles are left to the next classifier
+        ("Summary Page ... Schedule A, Line 3", None),
+        ("Schedule B Loans Received", None),
+        ("", None),
+        ("x" * 400 + " SCHEDULE A", None),
+    ],
+)
+def test_classify_page_text(text, expected):
+    assert classify_page_text(text) == expected
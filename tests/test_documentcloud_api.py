@@ -0,0 +1,67 @@
+from datasette_ca460.documentcloud_api import document_version, list_project_documents
+from documentcloud import DocumentCloud
+import httpx
+import pytest
+
+
+def document(id):
+    return {
+        "document": {
+            "id": id,
+            "title": f"Document {id}",
+            "slug": f"document-{id}",
+            "page_count": 3,
+            "asset_url": "https://assets.example.com/",
+            "created_at": "2024-01-01T00:00:00Z",
+            "updated_at": f"2024-01-0{id}T00:00:00Z",
+        }
+    }
+
+
+@pytest.mark.asyncio
+async def test_list_project_documents_fetches_pages_concurrently():
+    # Two documents per page, and document 2 shows up again on page 2
+    pages = {1: [1, 2], 2: [2, 3], 3: [4, 5]}
+    requested = []
+
+    def handler(request):
+        page = int(request.url.params.get("page", 1))
+        requested.append(page)
+        next_url = None
+        if page < 3:
+            next_url = str(request.url.copy_set_param("page", page + 1))
+        return httpx.Response(200, json={
+            "count": 6,
+            "next": next_url,
+            "results": [document(id) for id in pages[page]],
+        })
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        documents = await list_project_documents(client, 1, api_url="https://api.example.com/")
+    assert sorted(requested) == [1, 2, 3]
+    assert [d.id for d in documents] == [1, 2, 3, 4, 5]
+    assert documents[0].title == "Document 1"
+    # Documents can make their own API calls
+    assert isinstance(documents[0]._client, DocumentCloud)
+    assert documents[0]._client.base_uri == "https://api.example.com/"
+    assert document_version(documents[2]) == "2024-01-03T00:00:00+00:00"
+
+
+@pytest.mark.asyncio
+async def test_list_project_documents_follows_cursors():
+    def handler(request):
+        cursor = request.url.params.get("cursor")
+        if cursor is None:
+            return httpx.Response(200, json={
+                "next": "https://api.example.com/projects/1/documents/?cursor=abc",
+                "results": [document(1)],
+            })
+        return httpx.Response(200, json={"next": None, "results": [document(2)]})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        documentcloud = DocumentCloud(base_uri="https://api.example.com/")
+        documents = await list_project_documents(
+            client, 1, api_url="https://api.example.com/", client=documentcloud
+        )
+    assert [d.id for d in documents] == [1, 2]
+    assert all(d._client is documentcloud for d in documents)
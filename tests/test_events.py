@@ -0,0 +1,30 @@
+from datasette_ca460.events import EventBroker, load_job_events
+from datasette_ca460.migrations import migrate
+import sqlite3
+
+
+def test_load_job_events_since():
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    conn.execute("insert into sync_jobs (id, project_id) values ('job', 1)")
+    conn.executemany(
+        "insert into sync_events (sync_job_id, event_type, message) values ('job', 'info', ?)",
+        [("one",), ("two",), ("three",)],
+    )
+    assert [e["message"] for e in load_job_events(conn, "job")["events"]] == ["one", "two", "three"]
+    assert [e["message"] for e in load_job_events(conn, "job", since=2)["events"]] == ["three"]
+    assert load_job_events(conn, "missing") is None
+
+
+def test_event_broker_only_delivers_to_job_subscribers():
+    broker = EventBroker()
+    queue = broker.subscribe("job")
+    other = broker.subscribe("other")
+    broker.publish_event("job", {"id": 1})
+    broker.publish_job("job", {"status": "completed"})
+    assert queue.get_nowait() == ("event", {"id": 1})
+    assert queue.get_nowait() == ("job", {"status": "completed"})
+    assert other.empty()
+    broker.unsubscribe("job", queue)
+    broker.publish_event("job", {"id": 2})
+    assert queue.empty()
@@ -0,0 +1,28 @@
+from datasette_ca460.fetch import fetch_bytes
+import httpx
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_fetch_bytes_retries_transient_errors():
+    statuses = [429, 503, 200]
+    seen = []
+
+    def handler(request):
+        status = statuses[len(seen)]
+        seen.append(status)
+        return httpx.Response(status, headers={"retry-after": "0"}, content=b"image")
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        assert await fetch_bytes(client, "https://example.com/p1.gif") == b"image"
+    assert seen == [429, 503, 200]
+
+
+@pytest.mark.asyncio
+async def test_fetch_bytes_gives_up_after_retries():
+    def handler(request):
+        return httpx.Response(503, headers={"retry-after": "0"})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        with pytest.raises(httpx.HTTPStatusError):
+            await fetch_bytes(client, "https://example.com/p1.gif", retries=1)
@@ -0,0 +1,35 @@
+from datasette.app import Datasette
+from datasette_ca460.http_cache import CachedResponse, ResponseCache, get_response_cache
+
+
+def entry(size):
+    return CachedResponse(b"x" * size, 200, "application/json")
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2, max_bytes=100)
+    cache.put("a", entry(10))
+    cache.put("b", entry(10))
+    assert cache.get("a") is not None
+    cache.put("c", entry(10))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+    # Too many bytes evicts entries too
+    cache.put("d", entry(95))
+    assert (cache.get("a"), cache.get("c")) == (None, None)
+    assert cache.get("d") is not None
+    assert (cache.hits, cache.misses) == (3, 3)
+
+
+def test_response_cache_size_is_configurable():
+    assert get_response_cache(Datasette(memory=True)).max_entries == 200
+    datasette = Datasette(
+        memory=True,
+        config={"plugins": {"datasette-ca460": {
+            "response_cache_max_entries": 10,
+            "response_cache_max_bytes": 1024,
+        }}},
+    )
+    cache = get_response_cache(datasette)
+    assert (cache.max_entries, cache.max_bytes) == (10, 1024)
@@ -0,0 +1,54 @@
+from concurrent.futures import ProcessPoolExecutor
+from datasette_ca460.image_processing import (
+    PREDICTION_CROP,
+    encode_page_image,
+    fingerprint_page_image,
+    run_image_task,
+)
+from datasette_ca460.options import ImageProfile
+from io import BytesIO
+from PIL import Image
+import pytest
+
+
+def _gif(width=600, height=1200):
+    out = BytesIO()
+    Image.new("L", (width, height), 200).convert("P").save(out, format="GIF")
+    return out.getvalue()
+
+
+def test_encode_page_image_crops_and_converts_to_jpeg():
+    full = Image.open(BytesIO(encode_page_image(_gif())))
+    assert (full.format, full.mode, full.size) == ("JPEG", "RGB", (600, 1200))
+    cropped = Image.open(BytesIO(encode_page_image(_gif(), crop=PREDICTION_CROP)))
+    assert cropped.size == (300, 200)
+
+
+def test_encode_page_image_applies_profile():
+    profile = ImageProfile(max_long_edge=300, grayscale=True, quality=60)
+    image = Image.open(BytesIO(encode_page_image(_gif(), profile)))
+    assert (image.format, image.mode, image.size) == ("JPEG", "L", (150, 300))
+    image = Image.open(BytesIO(encode_page_image(_gif(), ImageProfile(format="webp"))))
+    assert image.format == "WEBP"
+    # Images already within max_long_edge aren't scaled up
+    image = Image.open(BytesIO(encode_page_image(_gif(), profile, crop=PREDICTION_CROP)))
+    assert image.size == (300, 200)
+
+
+@pytest.mark.asyncio
+async def test_run_image_task_on_thread_and_process_pool():
+    expected = encode_page_image(_gif(), crop=PREDICTION_CROP)
+    assert await run_image_task(None, encode_page_image, _gif(), crop=PREDICTION_CROP) == expected
+    with ProcessPoolExecutor(1) as executor:
+        assert await run_image_task(
+            executor, encode_page_image, _gif(), crop=PREDICTION_CROP
+        ) == expected
+
+
+def test_fingerprint_page_image():
+    content_hash, phash = fingerprint_page_image(_gif())
+    assert fingerprint_page_image(_gif()) == (content_hash, phash)
+    # A re-rendered copy of the same page: different bytes, same difference hash
+    other_hash, other_phash = fingerprint_page_image(_gif(width=601))
+    assert other_hash != content_hash
+    assert (phash ^ other_phash).bit_count() <= 8
@@ -0,0 +1,77 @@
+from datasette_ca460.images import PageImageCache, page_image_key
+import asyncio
+import pytest
+
+
+class Document:
+    def __init__(self, id, updated_at):
+        self.id = id
+        self.updated_at = updated_at
+
+
+def test_page_image_key_changes_with_asset_version():
+    key = page_image_key(Document(1, "2024-01-01"), 3)
+    assert key == page_image_key(Document(1, "2024-01-01"), 3)
+    assert key != page_image_key(Document(1, "2024-02-01"), 3)
+    assert key != page_image_key(Document(1, "2024-01-01"), 4)
+    assert key != page_image_key(Document(1, "2024-01-01"), 3, size="large")
+
+
+@pytest.mark.asyncio
+async def test_page_image_cache_fetches_once_and_evicts(tmp_path):
+    fetches = []
+
+    def fetcher(content):
+        async def fetch():
+            fetches.append(content)
+            await asyncio.sleep(0)
+            return content
+        return fetch
+
+    cache = PageImageCache(tmp_path, max_bytes=20, memory_bytes=0)
+    # Concurrent misses for the same key share one download
+    results = await asyncio.gather(*(cache.get("aa", fetcher(b"a" * 10)) for _ in range(3)))
+    assert results == [b"a" * 10] * 3
+    assert fetches == [b"a" * 10]
+
+    # A fresh cache over the same directory is served from disk
+    cache = PageImageCache(tmp_path, max_bytes=20, memory_bytes=0)
+    assert await cache.get("aa", fetcher(b"x")) == b"a" * 10
+    assert len(fetches) == 1
+
+    # Exceeding max_bytes evicts the least recently used image
+    await cache.get("bb", fetcher(b"b" * 10))
+    await cache.get("aa", fetcher(b"x"))
+    await cache.get("cc", fetcher(b"c" * 10))
+    assert not (tmp_path / "bb" / "bb").exists()
+    assert (tmp_path / "aa" / "aa").exists()
+    assert (tmp_path / "cc" / "cc").exists()
+
+
+@pytest.mark.asyncio
+async def test_page_image_cache_survives_cancelled_download(tmp_path):
+    started = asyncio.Event()
+    fetches = []
+
+    async def slow_fetch():
+        fetches.append("slow")
+        started.set()
+        await asyncio.sleep(10)
+        return b"slow"
+
+    async def fetch():
+        fetches.append("fetch")
+        return b"image"
+
+    cache = PageImageCache(tmp_path, memory_bytes=0)
+    first = asyncio.ensure_future(cache.get("aa", slow_fetch))
+    await started.wait()
+    second = asyncio.ensure_future(cache.get("aa", fetch))
+    await asyncio.sleep(0)
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    # The waiter downloads the page itself rather than being cancelled too
+    assert await second == b"image"
+    assert fetches == ["slow", "fetch"]
+    assert cache._inflight == {}
@@ -0,0 +1,66 @@
+from datasette_ca460.incremental import apply_project_listing
+from datasette_ca460.migrations import migrate
+from documentcloud.documents import Document
+import sqlite3
+
+
+def document(id, updated_at="2024-01-01T00:00:00Z", page_count=2, file_hash=None):
+    return Document(None, {
+        "id": id,
+        "page_count": page_count,
+        "file_hash": file_hash or f"hash-{id}",
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": updated_at,
+    })
+
+
+def test_apply_project_listing_detects_changes_and_invalidates_pages():
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    for id in (1, 2, 3):
+        conn.execute(
+            "insert into documents (id, page_count, file_hash) values (?, 2, ?)",
+            (id, f"hash-{id}")
+        )
+        conn.execute(
+            "insert into pages (document_id, page_number) values (?, 1), (?, 2)", (id, id)
+        )
+    conn.executescript("""
+    insert into page_type_predictions (page_id, model, predicted_page_type)
+      select id, 'm', 'schedule_a' from pages;
+    insert into page_parsed (page_id, page_type, model, parsed_data)
+      select id, 'schedule_a', 'p', '{"line_items": [{"full_name": "A"}]}' from pages;
+    insert into document_syncs (document_id, page_type_model, parser_model, updated_at)
+      select id, 'm', 'p', '2024-01-01T00:00:00+00:00' from documents;
+    """)
+
+    changes = apply_project_listing(conn, 1, [document(1), document(2), document(3)])
+    assert (changes.added, changes.modified, changes.removed) == ([1, 2, 3], [], [])
+    assert changes.invalidated == []
+
+    changes = apply_project_listing(conn, 1, [
+        # Retitled: a new version, but the same pages
+        document(1, updated_at="2024-02-01T00:00:00Z"),
+        # Re-uploaded
+        document(2, updated_at="2024-02-01T00:00:00Z", file_hash="new"),
+        document(4),
+    ])
+    assert (changes.added, changes.modified, changes.removed) == ([4], [1, 2], [3])
+    assert changes.invalidated == [2]
+    assert conn.execute(
+        "select document_id, count(*) from pages group by 1"
+    ).fetchall() == [(1, 2), (3, 2)]
+    assert conn.execute(
+        "select count(*) from page_parsed where page_id not in (select id from pages)"
+    ).fetchone()[0] == 0
+    assert conn.execute(
+        "select count(*) from schedule_a_itemizations"
+    ).fetchone()[0] == 4
+    assert conn.execute("select document_id from document_syncs").fetchall() == [(1,), (3,)]
+    assert conn.execute(
+        "select document_id from project_documents where removed_at is not null"
+    ).fetchall() == [(3,)]
+
+    # A removed document that comes back counts as new
+    changes = apply_project_listing(conn, 1, [document(3)])
+    assert (changes.added, changes.removed) == ([3], [1, 2, 4])
@@ -0,0 +1,134 @@
+from datasette.app import Datasette
+from datasette_ca460.jobs import (
+    JobScheduler,
+    claim_next_job,
+    enqueue_job,
+    record_heartbeat,
+    requeue_orphaned_jobs,
+    run_worker_id,
+)
+from datasette_ca460.migrations import ensure_schema, migrate
+from datasette_ca460.options import SyncOptions
+import asyncio
+import pytest
+import sqlite3
+
+
+def _conn():
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    return conn
+
+
+def test_claim_next_job_in_queue_order():
+    conn = _conn()
+    enqueue_job(conn, "first", 1, "m1", "m2", SyncOptions(max_concurrent_pages=8))
+    enqueue_job(conn, "second", 2, "m1", "m2", SyncOptions())
+    job = claim_next_job(conn, "worker")
+    assert job["id"] == "first"
+    assert job["options"]["max_concurrent_pages"] == 8
+    assert claim_next_job(conn, "worker")["id"] == "second"
+    assert claim_next_job(conn, "worker") is None
+    assert conn.execute(
+        "select distinct status, worker_id from sync_jobs"
+    ).fetchall() == [("running", "worker")]
+
+
+def test_orphaned_jobs_are_requeued_with_work_units_released():
+    conn = _conn()
+    enqueue_job(conn, "live", 1, "m1", "m2", SyncOptions())
+    enqueue_job(conn, "orphan", 1, "m1", "m2", SyncOptions())
+    claim_next_job(conn, "worker")
+    claim_next_job(conn, "dead-worker")
+    conn.execute(
+        "update sync_jobs set heartbeat_at = datetime('now', '-10 minutes') where id = 'orphan'"
+    )
+    conn.executescript("""
+    insert into sync_work_units (sync_job_id, document_id, status, lease_owner)
+      values ('orphan', 1, 'done', null), ('orphan', 2, 'leased', 'dead-worker');
+    """)
+
+    assert requeue_orphaned_jobs(conn) == ["orphan"]
+    assert conn.execute("select id, status from sync_jobs order by id").fetchall() == [
+        ("live", "running"),
+        ("orphan", "queued"),
+    ]
+    assert conn.execute(
+        "select document_id, status from sync_work_units order by document_id"
+    ).fetchall() == [(1, "done"), (2, "pending")]
+    # The live job's heartbeat still counts; the requeued job's doesn't
+    assert record_heartbeat(conn, "live", "worker")
+    assert not record_heartbeat(conn, "orphan", "dead-worker")
+
+
+def test_heartbeats_only_renew_the_run_that_claimed_the_job():
+    conn = _conn()
+    enqueue_job(conn, "slow", 1, "m1", "m2", SyncOptions())
+    first_run = run_worker_id()
+    claim_next_job(conn, first_run)
+    conn.execute("update sync_jobs set heartbeat_at = datetime('now', '-10 minutes')")
+    # Late, but still running in the process checking
+    assert requeue_orphaned_jobs(conn, running=["slow"]) == []
+    # Requeued by another process and claimed again, the first run can't
+    # renew it
+    assert requeue_orphaned_jobs(conn) == ["slow"]
+    second_run = run_worker_id()
+    assert second_run != first_run
+    claim_next_job(conn, second_run)
+    assert not record_heartbeat(conn, "slow", first_run)
+    assert record_heartbeat(conn, "slow", second_run)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_doesnt_requeue_jobs_it_is_running(tmp_path):
+    path = tmp_path / "data.db"
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    enqueue_job(conn, "slow", 1, "m1", "m2", SyncOptions())
+    claim_next_job(conn, run_worker_id())
+    conn.execute("update sync_jobs set heartbeat_at = datetime('now', '-10 minutes')")
+    conn.commit()
+    conn.close()
+    datasette = Datasette([str(path)])
+    db = datasette.get_database("data")
+    await ensure_schema(db)
+    scheduler = JobScheduler(datasette)
+    task = asyncio.get_running_loop().create_future()
+    scheduler.running[("data", "slow")] = task
+
+    assert await scheduler._tick()
+    # Not requeued, so not claimed and started a second time
+    assert scheduler.running == {("data", "slow"): task}
+    assert [tuple(row) for row in await db.execute("select status from sync_jobs")] == [("running",)]
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_pause_resume_and_cancel(tmp_path, monkeypatch):
+    # Keep the scheduler from picking up the job while it is being tested
+    monkeypatch.setattr(JobScheduler, "wake", lambda self: None)
+    path = tmp_path / "data.db"
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    enqueue_job(conn, "waiting", 1, "m1", "m2", SyncOptions())
+    conn.close()
+    datasette = Datasette([str(path)])
+    db = datasette.get_database("data")
+
+    async def action(name):
+        return await datasette.client.post(f"/data/-/ca460/api/sync/waiting/{name}")
+
+    response = await action("pause")
+    assert response.json() == {"sync_job_id": "waiting", "status": "paused"}
+    assert (await action("pause")).status_code == 409
+    assert (await action("cancel")).json()["status"] == "cancelled"
+    assert (await action("resume")).status_code == 409
+    response = await datasette.client.post("/data/-/ca460/api/sync/missing/cancel")
+    assert response.status_code == 404
+    messages = [
+        row["message"]
+        for row in await db.execute(
+            "select message from sync_events where sync_job_id = 'waiting' order by id"
+        )
+    ]
+    assert messages == ["Sync paused", "Sync cancelled"]
@@ -0,0 +1,90 @@
+from datasette_ca460.limiter import (
+    ModelLimiter, TokenBucket, get_model_limiter, is_throttled, is_transient,
+)
+import asyncio
+import httpx
+import pytest
+
+
+class ProviderError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@pytest.mark.parametrize(
+    "ex,transient,throttled",
+    [
+        (ProviderError("slow down", status_code=429), True, True),
+        (ProviderError("Resource has been exhausted (e.g. check quota)."), True, True),
+        (ProviderError("upstream", status_code=503), True, False),
+        (httpx.ConnectError("refused"), True, False),
+        (ValueError("Invalid JSON in response"), False, False),
+        (ProviderError("API key not valid", status_code=400), False, False),
+    ],
+)
+def test_error_classification(ex, transient, throttled):
+    assert is_transient(ex) == transient
+    assert is_throttled(ex) == throttled
+
+
+@pytest.mark.asyncio
+async def test_limiter_halves_on_failure_and_grows_back():
+    decreases = []
+
+    async def on_decrease(limiter):
+        decreases.append(limiter.concurrency)
+
+    limiter = ModelLimiter("m", 8, on_decrease=on_decrease)
+    with pytest.raises(ProviderError):
+        async with limiter.slot():
+            raise ProviderError("slow down", status_code=429)
+    assert limiter.concurrency == 4
+    assert decreases == [4]
+    assert limiter.state()["throttled"] == 1
+
+    # About one more slot per round of successful prompts
+    for _ in range(5):
+        async with limiter.slot() as record_tokens:
+            record_tokens(100)
+    assert limiter.concurrency == 5
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_limiter_caps_in_flight_prompts():
+    limiter = ModelLimiter("m", 2)
+    peak = 0
+
+    async def prompt():
+        nonlocal peak
+        async with limiter.slot():
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(prompt() for _ in range(6)))
+    assert peak == 2
+
+
+class FakeDatasette:
+    pass
+
+
+def test_model_limiters_are_shared_per_instance():
+    datasette, other = FakeDatasette(), FakeDatasette()
+    limiter = get_model_limiter(datasette, "m", 8, requests_per_minute=60)
+    limiter.limit = 6.0
+    requests = limiter.requests
+    assert get_model_limiter(datasette, "m", 4, requests_per_minute=60) is limiter
+    # The latest caps apply, without resetting an unchanged rate limit
+    assert (limiter.max_concurrency, limiter.concurrency, limiter.requests) == (4, 4, requests)
+    assert get_model_limiter(datasette, "m", 4).requests is None
+    assert get_model_limiter(other, "m", 4) is not limiter
+
+
+def test_token_bucket_waits_out_debt():
+    bucket = TokenBucket(600)
+    assert bucket.wait_time() == 0
+    bucket.take(1200)
+    # 600 tokens in debt at 10 a second
+    assert bucket.wait_time() == pytest.approx(60, rel=0.01)
@@ -0,0 +1,67 @@
+from datasette.app import Datasette
+from datasette_ca460.migrations import MIGRATIONS, ensure_schema, migrate
+from pathlib import Path
+import pytest
+import sqlite3
+
+SCHEMA = (Path(__file__).parent.parent / "datasette_ca460" / "schema.sql").read_text()
+
+
+def test_migrate_is_idempotent():
+    conn = sqlite3.connect(":memory:")
+    assert migrate(conn) == [m.name for m in MIGRATIONS]
+    assert migrate(conn) == []
+    versions = [r[0] for r in conn.execute("select version from ca460_schema_migrations")]
+    assert versions == [m.version for m in MIGRATIONS]
+
+
+def test_migrate_upgrades_database_with_duplicates():
+    # A database created by executescript(SCHEMA) before migrations existed
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(SCHEMA)
+    conn.executescript("""
+    insert into documents (id, page_count) values (1, 1);
+    insert into pages (id, document_id, page_number) values (1, 1, 1), (2, 1, 1);
+    insert into page_type_predictions (page_id, model, predicted_page_type)
+      values (1, 'm', 'schedule_a'), (2, 'm', 'schedule_a');
+    insert into page_parsed (page_id, page_type, model, parsed_data)
+      values (1, 'schedule_a', 'p', '{"line_items": [{"full_name": "A"}]}'),
+             (2, 'schedule_a', 'p', '{"line_items": [{"full_name": "B"}]}');
+    """)
+    migrate(conn)
+    assert conn.execute("select id from pages").fetchall() == [(1,)]
+    assert conn.execute("select page_id from page_type_predictions").fetchall() == [(1,)]
+    assert conn.execute("select page_id from page_parsed").fetchall() == [(1,)]
+    assert conn.execute("select full_name from schedule_a_itemizations").fetchall() == [("A",)]
+    # Unique indexes now reject duplicates
+    conn.execute(
+        "insert into pages (document_id, page_number) values (1, 1) on conflict do nothing"
+    )
+    assert conn.execute("select count(*) from pages").fetchone()[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_startup_migrates_existing_ca460_databases(tmp_path):
+    existing = tmp_path / "existing.db"
+    conn = sqlite3.connect(existing)
+    conn.executescript(SCHEMA)
+    conn.close()
+    other = tmp_path / "other.db"
+    sqlite3.connect(other).close()
+
+    datasette = Datasette([str(existing), str(other)])
+    await datasette.invoke_startup()
+
+    assert await datasette.get_database("existing").table_exists("ca460_schema_migrations")
+    # Databases that have never been synced are left alone
+    assert not await datasette.get_database("other").table_exists("ca460_schema_migrations")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("wal,expected", [(None, "wal"), (False, "delete")])
+async def test_ensure_schema_enables_wal(tmp_path, wal, expected):
+    config = {} if wal is None else {"plugins": {"datasette-ca460": {"wal": wal}}}
+    datasette = Datasette([str(tmp_path / "filings.db")], config=config)
+    db = datasette.get_database("filings")
+    await ensure_schema(db)
+    assert (await db.execute("pragma journal_mode")).single_value() == expected
@@ -0,0 +1,61 @@
+from datasette.app import Datasette
+from datasette_ca460 import models
+from datasette_ca460.models import JobModels, get_model_cache
+import llm
+import pytest
+
+
+class FakeModel:
+    def __init__(self, model_id):
+        self.model_id = model_id
+
+
+class FakeLlmWrapper:
+    created = 0
+    resolved = []
+
+    def __init__(self, datasette):
+        FakeLlmWrapper.created += 1
+
+    def get_async_model(self, model_id):
+        FakeLlmWrapper.resolved.append(model_id)
+        return FakeModel(model_id)
+
+    def get_async_models(self):
+        return [FakeModel("m1"), FakeModel("m2")]
+
+
+@pytest.fixture
+def fake_llm(tmp_path, monkeypatch):
+    FakeLlmWrapper.created = 0
+    FakeLlmWrapper.resolved = []
+    monkeypatch.setattr(models, "LlmWrapper", FakeLlmWrapper)
+    monkeypatch.setattr(llm, "user_dir", lambda: tmp_path)
+    return tmp_path
+
+
+def test_models_are_resolved_once_until_config_changes(fake_llm):
+    datasette = Datasette(memory=True)
+    cache = get_model_cache(datasette)
+    job = JobModels(datasette)
+    first = job.get_async_model("m1")
+    assert job.get_async_model("m1") is first
+    assert cache.get_async_model("m1") is first
+    assert cache.model_ids() == ["m1", "m2"]
+    assert (FakeLlmWrapper.created, FakeLlmWrapper.resolved) == (1, ["m1"])
+
+    # Adding an API key resolves models again
+    (fake_llm / "keys.json").write_text('{"gemini": "key"}')
+    assert cache.get_async_model("m1") is not first
+    assert (FakeLlmWrapper.created, FakeLlmWrapper.resolved) == (2, ["m1", "m1"])
+    # A job keeps the models it started with
+    assert job.get_async_model("m1") is first
+
+
+@pytest.mark.asyncio
+async def test_models_endpoint_is_cached(fake_llm):
+    datasette = Datasette(memory=True)
+    for _ in range(2):
+        response = await datasette.client.get("/_memory/-/ca460/api/models")
+        assert response.json() == {"models": ["m1", "m2"]}
+    assert FakeLlmWrapper.created == 1
@@ -0,0 +1,115 @@
+from datasette.app import Datasette
+from datasette_ca460.options import (
+    ImageProfile,
+    InvalidOptionError,
+    resolve_sync_options,
+    sync_options_from_dict,
+)
+import pytest
+
+
+def test_resolve_sync_options_merges_config_and_overrides():
+    datasette = Datasette(
+        memory=True,
+        config={
+            "plugins": {
+                "datasette-ca460": {
+                    "max_concurrent_pages": 8,
+                    "model_concurrency": {"llama-server": 4, "gemini-3-flash-preview": 32},
+                }
+            }
+        },
+    )
+    options = resolve_sync_options(
+        datasette, "_memory", {"model_concurrency": {"llama-server": 2}}
+    )
+    assert options.max_concurrent_pages == 8
+    assert options.concurrency_for_model("llama-server") == 2
+    assert options.concurrency_for_model("gemini-3-flash-preview") == 32
+    assert options.concurrency_for_model("other") == options.default_model_concurrency
+
+
+@pytest.mark.parametrize("value", [0, -1, "x", True, None])
+def test_resolve_sync_options_rejects_invalid(value):
+    datasette = Datasette(memory=True)
+    with pytest.raises(InvalidOptionError):
+        resolve_sync_options(datasette, "_memory", {"max_concurrent_pages": value})
+
+
+def test_image_profiles_round_trip_through_to_dict():
+    datasette = Datasette(
+        memory=True,
+        config={
+            "plugins": {
+                "datasette-ca460": {
+                    "default_image_profile": {"quality": 85},
+                    "image_profiles": {
+                        "llama-server": {"size": "large", "max_long_edge": 800, "grayscale": True},
+                    },
+                }
+            }
+        },
+    )
+    options = resolve_sync_options(datasette, "_memory")
+    assert options.image_profile_for_model("llama-server") == ImageProfile(
+        size="large", max_long_edge=800, grayscale=True
+    )
+    assert options.image_profile_for_model("other") == ImageProfile(quality=85)
+    assert sync_options_from_dict(options.to_dict()) == options
+
+
+@pytest.mark.parametrize(
+    "profile",
+    [{"size": "huge"}, {"format": "png"}, {"quality": 101}, {"max_long_edge": 0}, {"dpi": 300}],
+)
+def test_invalid_image_profiles_are_rejected(profile):
+    datasette = Datasette(memory=True)
+    with pytest.raises(InvalidOptionError):
+        resolve_sync_options(datasette, "_memory", {"image_profiles": {"m": profile}})
+
+
+def test_schedule_a_batch_size_per_model():
+    datasette = Datasette(
+        memory=True,
+        config={"plugins": {"datasette-ca460": {"schedule_a_batch_size": {"gemini-3-flash-preview": 4}}}},
+    )
+    options = resolve_sync_options(
+        datasette, "_memory", {"schedule_a_batch_size": {"llama-server": 2}}
+    )
+    assert options.schedule_a_batch_size_for_model("gemini-3-flash-preview") == 4
+    assert options.schedule_a_batch_size_for_model("llama-server") == 2
+    assert options.schedule_a_batch_size_for_model("other") == 1
+    assert sync_options_from_dict(options.to_dict()) == options
+    with pytest.raises(InvalidOptionError):
+        resolve_sync_options(datasette, "_memory", {"schedule_a_batch_size": {"m": 0}})
+
+
+def test_batch_backend_must_be_registered():
+    datasette = Datasette(memory=True)
+    options = resolve_sync_options(datasette, "_memory", {"batch_backend": "local"})
+    assert options.batch_backend == "local"
+    assert resolve_sync_options(datasette, "_memory", {"batch_backend": None}).batch_backend is None
+    with pytest.raises(InvalidOptionError):
+        resolve_sync_options(datasette, "_memory", {"batch_backend": "openai"})
+
+
+def test_page_classifiers_are_opt_in():
+    datasette = Datasette(memory=True)
+    assert resolve_sync_options(datasette, "_memory").page_classifiers == []
+    options = resolve_sync_options(datasette, "_memory", {"page_classifiers": ["header-hash"]})
+    assert options.page_classifiers == ["header-hash"]
+    with pytest.raises(InvalidOptionError):
+        resolve_sync_options(datasette, "_memory", {"page_classifiers": ["ocr"]})
+
+
+def test_unknown_sync_options_are_rejected():
+    datasette = Datasette(
+        memory=True,
+        # Instance-level settings share the plugin configuration
+        config={"plugins": {"datasette-ca460": {"image_workers": 2, "max_concurrent_pages": 8}}},
+    )
+    assert resolve_sync_options(datasette, "_memory").max_concurrent_pages == 8
+    with pytest.raises(InvalidOptionError, match="Unknown sync options: max_concurent_pages"):
+        resolve_sync_options(datasette, "_memory", {"max_concurent_pages": 16})
+    with pytest.raises(InvalidOptionError):
+        sync_options_from_dict({"max_concurent_pages": 16})
@@ -0,0 +1,69 @@
+from datasette_ca460.pipeline import OrderedCompletions, close_stage, run_stages, stage_workers
+import asyncio
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_run_stages_cancels_siblings_on_first_exception():
+    queue = asyncio.Queue(maxsize=1)
+    cancelled = []
+
+    async def producer():
+        # Blocks on the full queue once the consumer has died
+        try:
+            for i in range(10):
+                await queue.put(i)
+        except asyncio.CancelledError:
+            cancelled.append("producer")
+            raise
+
+    async def consumer():
+        await queue.get()
+        raise ValueError("bad page")
+
+    with pytest.raises(ValueError, match="bad page"):
+        await asyncio.wait_for(run_stages(producer(), consumer()), timeout=1)
+    assert cancelled == ["producer"]
+
+
+@pytest.mark.asyncio
+async def test_close_stage_stops_every_worker():
+    queue = asyncio.Queue(maxsize=2)
+    handled = []
+
+    async def handle(item):
+        await asyncio.sleep(0)
+        handled.append(item)
+
+    async def produce():
+        for i in range(5):
+            await queue.put(i)
+        await close_stage(queue, 3)
+
+    await asyncio.wait_for(run_stages(produce(), stage_workers(queue, handle, 3)), timeout=1)
+    assert sorted(handled) == [0, 1, 2, 3, 4]
+    assert queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_ordered_completions_complete_in_registration_order():
+    completed = []
+
+    async def on_complete(key):
+        completed.append(key)
+
+    completions = OrderedCompletions(on_complete)
+    await completions.register("a", 2)
+    await completions.register("b", 1)
+    await completions.register("c", 0)
+    # b and c are done, but wait for a
+    await completions.finish("b")
+    assert completed == []
+    await completions.finish("a")
+    assert completed == []
+    await completions.finish("a")
+    assert completed == ["a", "b", "c"]
+
+    # Keys registered with nothing left to do complete straight away
+    await completions.register("d", 0)
+    assert completed == ["a", "b", "c", "d"]
@@ -0,0 +1,168 @@
+from datasette.app import Datasette
+from datasette_ca460 import routes
+from datasette_ca460.http_cache import get_response_cache
+from datasette_ca460.migrations import ensure_schema
+import json
+import pytest
+import pytest_asyncio
+
+
+@pytest_asyncio.fixture
+async def datasette(tmp_path):
+    datasette = Datasette([str(tmp_path / "filings.db")])
+    db = datasette.get_database("filings")
+    await ensure_schema(db)
+
+    def _populate(conn):
+        for id in range(1, 6):
+            conn.execute(
+                "insert into documents (id, page_count, title) values (?, 2, ?)",
+                (id, f"Filing {id}")
+            )
+            conn.execute(
+                "insert into pages (document_id, page_number) values (?, 1), (?, 2)", (id, id)
+            )
+        # Documents 1-4 parsed by m1, even ones by m2 as well; 5 isn't parsed
+        conn.execute("""
+            insert into page_parsed (page_id, page_type, model, parsed_data)
+            select p.id, 'schedule_a', 'm1', '{"line_items": []}'
+            from pages p where p.document_id < 5
+        """)
+        conn.execute("""
+            insert into page_parsed (page_id, page_type, model, parsed_data)
+            select p.id, 'campaign_disclosure_summary_page', 'm2', '{}'
+            from pages p where p.document_id % 2 = 0 and p.page_number = 1
+        """)
+
+    await db.execute_write_fn(_populate)
+    return datasette
+
+
+@pytest.mark.asyncio
+async def test_documents_api_pages_and_filters(datasette):
+    response = await datasette.client.get("/filings/-/ca460/api/documents?limit=3")
+    data = response.json()
+    assert [d["id"] for d in data["documents"]] == [4, 3, 2]
+    assert data["documents"][0] == {
+        "id": 4,
+        "page_count": 2,
+        "title": "Filing 4",
+        "model_count": 2,
+        "parsed_pages": 3,
+        "summary_pages": 1,
+        "schedule_a_pages": 2,
+        "last_parsed_at": data["documents"][0]["last_parsed_at"],
+    }
+    assert data["next"] == 2
+
+    response = await datasette.client.get("/filings/-/ca460/api/documents?limit=3&before=2")
+    data = response.json()
+    assert ([d["id"] for d in data["documents"]], data["next"]) == ([1], None)
+
+    for query, expected in (
+        ("model=m2", [4, 2]),
+        ("min_models=2", [4, 2]),
+        ("q=ing 3", [3]),
+    ):
+        response = await datasette.client.get(f"/filings/-/ca460/api/documents?{query}")
+        assert [d["id"] for d in response.json()["documents"]] == expected
+
+    response = await datasette.client.get("/filings/-/ca460/api/documents?limit=0")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_document_stats_follow_parses(datasette):
+    db = datasette.get_database("filings")
+    await db.execute_write("delete from page_parsed where model = 'm2'")
+    await db.execute_write("update documents set title = 'Amended' where id = 4")
+    response = await datasette.client.get("/filings/-/ca460/api/documents?limit=1")
+    document = response.json()["documents"][0]
+    assert (document["title"], document["model_count"], document["summary_pages"]) == ("Amended", 1, 0)
+
+
+@pytest.mark.asyncio
+async def test_documents_api_before_first_sync():
+    datasette = Datasette(memory=True)
+    response = await datasette.client.get("/_memory/-/ca460/api/documents")
+    assert response.json() == {"documents": [], "next": None}
+
+
+@pytest.mark.asyncio
+async def test_document_parsed_api(datasette, monkeypatch):
+    response = await datasette.client.get("/filings/-/ca460/api/document/4/parsed")
+    data = response.json()
+    assert data["document"] == {"id": 4, "page_count": 2, "title": "Filing 4"}
+    assert [(p["page_number"], p["page_type"]) for p in data["models"]["m1"]] == [
+        (1, "schedule_a"), (2, "schedule_a"),
+    ]
+    assert data["models"]["m2"][0]["parsed_data"] == {}
+    assert data["models"]["m1"][0]["parsed_data"] == {"line_items": []}
+    assert data["next"] is None
+
+    response = await datasette.client.get(
+        "/filings/-/ca460/api/document/4/parsed?limit=1&page_type=schedule_a"
+    )
+    data = response.json()
+    assert list(data["models"]) == ["m1"]
+    assert [p["page_number"] for p in data["models"]["m1"]] == [1]
+    assert data["next"] == 1
+    response = await datasette.client.get(
+        "/filings/-/ca460/api/document/4/parsed?limit=1&page_type=schedule_a&after=1"
+    )
+    assert [p["page_number"] for p in response.json()["models"]["m1"]] == [2]
+
+    # Streamed a page at a time
+    monkeypatch.setattr(routes, "PARSED_STREAM_PAGES", 1)
+    response = await datasette.client.get(
+        "/filings/-/ca460/api/document/4/parsed?format=ndjson&model=m1&model=m2"
+    )
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [(line["page_number"], line["model"]) for line in lines] == [
+        (1, "m1"), (1, "m2"), (2, "m1"),
+    ]
+
+    response = await datasette.client.get("/filings/-/ca460/api/document/99/parsed")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_read_endpoints_are_cached_until_data_changes(datasette):
+    db = datasette.get_database("filings")
+    cache = get_response_cache(datasette)
+    for path in ("/filings/-/ca460/api/documents", "/filings/-/ca460/api/document/4/parsed"):
+        first = await datasette.client.get(path)
+        etag = first.headers["etag"]
+        assert first.headers["last-modified"]
+        hits = cache.hits
+        second = await datasette.client.get(path)
+        assert (second.text, second.headers["etag"], cache.hits) == (first.text, etag, hits + 1)
+
+        response = await datasette.client.get(path, headers={"if-none-match": etag})
+        assert (response.status_code, response.text) == (304, "")
+        # Only the ETag is trusted to tell whether a copy is current
+        response = await datasette.client.get(
+            path, headers={"if-modified-since": first.headers["last-modified"]}
+        )
+        assert response.status_code == 200
+
+    await db.execute_write(
+        "delete from page_parsed where page_id in (select id from pages where document_id = 4)"
+    )
+    response = await datasette.client.get(
+        "/filings/-/ca460/api/documents", headers={"if-none-match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert [d["id"] for d in response.json()["documents"]] == [3, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_sync_api_rejects_unknown_options(datasette):
+    response = await datasette.client.post(
+        "/filings/-/ca460/api/sync",
+        json={"project_id": 1, "page_type_model": "m1", "max_concurent_pages": 16},
+    )
+    assert response.status_code == 400
+    assert response.json() == {"error": "Unknown sync options: max_concurent_pages"}
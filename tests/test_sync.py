@@ -0,0 +1,429 @@
+from collections import Counter
+from dataclasses import dataclass
+from datasette.app import Datasette
+from datasette_ca460 import models, sync
+from datasette_ca460.options import sync_options_from_dict
+from extract_ca460.form460_page_type import Form460PageTypeModel
+from extract_ca460.form460_summary_page import Form460SummaryPage
+from extract_ca460.form_460_schedule_a import Form460ScheduleA
+from io import BytesIO
+from PIL import Image, ImageDraw
+import asyncio
+import hashlib
+import httpx
+import json
+import pytest
+import pytest_asyncio
+
+# Page types are drawn as a shade of gray, which the fake page type model
+# reads back
+PAGE_TYPE_SHADES = {
+    "cover_page": 10,
+    "campaign_disclosure_summary_page": 60,
+    "schedule_a": 110,
+    "schedule_a_continuation": 160,
+    "schedule_e_payments_made": 210,
+}
+IMAGE_SIZES = {"normal": (100, 130), "large": (150, 195), "xlarge": (200, 260)}
+
+
+def page_image(page_type, mark, size="normal"):
+    """A page of one shade, with `mark` written at the bottom to tell copies apart."""
+    im = Image.new("L", IMAGE_SIZES[size], PAGE_TYPE_SHADES[page_type])
+    ImageDraw.Draw(im).text((5, IMAGE_SIZES[size][1] - 15), mark, fill=255)
+    out = BytesIO()
+    im.save(out, format="GIF")
+    return out.getvalue()
+
+
+class FakeDocumentCloud:
+    """
+    Project 1, with documents whose pages are the given page types. Pages
+    are all different unless given the same mark.
+    """
+
+    def __init__(self, documents: dict[int, list[str]], marks: dict = None):
+        self.documents = documents
+        self.marks = marks or {}
+        self.image_requests = []
+
+    def document(self, id):
+        return {
+            "id": id,
+            "title": f"Filing {id}",
+            "slug": f"filing-{id}",
+            "page_count": len(self.documents[id]),
+            "asset_url": "https://assets.example.com/",
+            "data": {},
+            "created_at": "2024-01-01T00:00:00Z",
+            "updated_at": "2024-01-01T00:00:00Z",
+        }
+
+    def handler(self, request):
+        if request.url.host == "api.www.documentcloud.org":
+            return httpx.Response(200, json={
+                "count": len(self.documents),
+                "next": None,
+                "results": [{"document": self.document(id)} for id in self.documents],
+            })
+        # .../documents/<id>/pages/<slug>-p<page>-<size>.gif
+        parts = request.url.path.split("/")
+        document_id = int(parts[2])
+        page, size = parts[-1].rsplit("-p", 1)[1].removesuffix(".gif").split("-")
+        page_number = int(page)
+        self.image_requests.append((document_id, page_number, size))
+        page_type = self.documents[document_id][page_number - 1]
+        mark = self.marks.get((document_id, page_number), f"{document_id}-{page_number}")
+        return httpx.Response(200, content=page_image(page_type, mark, size))
+
+
+@dataclass
+class Usage:
+    input: int = 10
+    output: int = 2
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self._text = text
+
+    async def text(self):
+        return self._text
+
+    async def usage(self):
+        return Usage()
+
+
+class Prompts(list):
+    """Prompts sent to the fake models, and the most in flight at once for each model."""
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight = Counter()
+        self.peak_in_flight = Counter()
+
+
+class FakeModel:
+    # Answer batched Schedule A prompts with a response that doesn't match
+    # the schema
+    invalid_batches = False
+
+    def __init__(self, model_id, prompts):
+        self.model_id = model_id
+        self.prompts = prompts
+
+    async def prompt(self, prompt, schema=None, attachments=None):
+        self.prompts.append((self.model_id, schema.__name__, len(attachments)))
+        in_flight = self.prompts.in_flight
+        in_flight[self.model_id] += 1
+        self.prompts.peak_in_flight[self.model_id] = max(
+            self.prompts.peak_in_flight[self.model_id], in_flight[self.model_id]
+        )
+        try:
+            # Give other prompts a chance to start
+            await asyncio.sleep(0.001)
+            return self._respond(schema, attachments)
+        finally:
+            in_flight[self.model_id] -= 1
+
+    def _respond(self, schema, attachments):
+        if schema is Form460PageTypeModel:
+            with Image.open(BytesIO(attachments[0].content)) as im:
+                shade = im.convert("L").getpixel((im.width // 2, im.height // 2))
+            page_type = min(PAGE_TYPE_SHADES, key=lambda t: abs(PAGE_TYPE_SHADES[t] - shade))
+            return FakeResponse(json.dumps({"page_type": page_type}))
+        if schema is Form460SummaryPage:
+            return FakeResponse(json.dumps({"name_of_filer": "Filer"}))
+        if schema is Form460ScheduleA:
+            return FakeResponse(json.dumps({"line_items": []}))
+        if self.invalid_batches:
+            return FakeResponse(json.dumps({"pages": [{"items": []} for _ in attachments]}))
+        return FakeResponse(json.dumps({"pages": [{"line_items": []} for _ in attachments]}))
+
+
+def make_datasette(path, prompts):
+    path.mkdir(exist_ok=True)
+    datasette = Datasette(
+        [str(path / "filings.db")],
+        config={"plugins": {"datasette-ca460": {
+            "image_cache_dir": str(path / "images"),
+            "image_workers": 0,
+        }}},
+    )
+    datasette.prompts = prompts
+    return datasette
+
+
+@pytest_asyncio.fixture
+async def datasette(tmp_path, monkeypatch):
+    prompts = Prompts()
+
+    class FakeLlmWrapper:
+        def __init__(self, datasette):
+            pass
+
+        def get_async_model(self, model_id):
+            return FakeModel(model_id, prompts)
+
+    monkeypatch.setattr(models, "LlmWrapper", FakeLlmWrapper)
+    return make_datasette(tmp_path, prompts)
+
+
+async def run_sync(datasette, monkeypatch, documentcloud, job_id="job", parser_model="m2", **options):
+    monkeypatch.setattr(
+        sync,
+        "create_http_client",
+        lambda options: httpx.AsyncClient(transport=httpx.MockTransport(documentcloud.handler)),
+    )
+    db = datasette.get_database("filings")
+    options = sync_options_from_dict(options)
+    await sync.sync_project(datasette, db, job_id, 1, "m1", parser_model, options)
+
+
+async def rows(datasette, sql, params=None):
+    return [tuple(row) for row in await datasette.get_database("filings").execute(sql, params)]
+
+
+async def events(datasette, job_id="job"):
+    return [
+        message for (message,) in await rows(
+            datasette, "select message from sync_events where sync_job_id = ? order by id", [job_id]
+        )
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rerunning_a_synced_project_only_loads_each_document_plan(datasette, monkeypatch):
+    documentcloud = FakeDocumentCloud({
+        1: ["cover_page", "campaign_disclosure_summary_page", "schedule_a"],
+        2: ["schedule_a_continuation", "schedule_e_payments_made"],
+    })
+    await run_sync(datasette, monkeypatch, documentcloud, job_id="first")
+    assert len(datasette.prompts) == 8
+
+    # Record every read query from here on
+    db = datasette.get_database("filings")
+    reads = []
+    execute, execute_fn = db.execute, db.execute_fn
+
+    async def record_execute(sql, *args, **kwargs):
+        reads.append(sql)
+        return await execute(sql, *args, **kwargs)
+
+    async def record_execute_fn(fn):
+        reads.append(fn.__qualname__)
+        return await execute_fn(fn)
+
+    monkeypatch.setattr(db, "execute", record_execute)
+    monkeypatch.setattr(db, "execute_fn", record_execute_fn)
+    datasette.prompts.clear()
+    documentcloud.image_requests.clear()
+    # Without the incremental skip of unchanged documents
+    await run_sync(datasette, monkeypatch, documentcloud, job_id="second", incremental=False)
+
+    # Nothing left to do, found with one query per document
+    assert (datasette.prompts, documentcloud.image_requests) == ([], [])
+    assert reads == ["load_document_plan.<locals>._load"] * 2
+
+
+@pytest.mark.asyncio
+async def test_pages_are_fingerprinted_at_one_size(datasette, monkeypatch):
+    documentcloud = FakeDocumentCloud({1: ["schedule_a", "cover_page"]})
+    await run_sync(
+        datasette, monkeypatch, documentcloud,
+        image_profiles={"m2": {"size": "large"}},
+    )
+    # Whatever size the parser model is sent, the fingerprint is of the
+    # normal size image
+    assert (1, 1, "large") in documentcloud.image_requests
+    assert await rows(
+        datasette, "select page_number, content_hash from pages where content_hash is not null"
+    ) == [(1, hashlib.sha256(page_image("schedule_a", "1-1")).hexdigest())]
+
+
+@pytest.mark.asyncio
+async def test_identical_pages_reuse_parses_from_the_same_model(datasette, monkeypatch):
+    # Page 2 of document 2 is a copy of page 1 of document 1
+    documentcloud = FakeDocumentCloud(
+        {1: ["schedule_a"], 2: ["cover_page", "schedule_a"]}, marks={(2, 2): "1-1"}
+    )
+    documents = documentcloud.documents
+    documentcloud.documents = {1: documents[1]}
+    await run_sync(datasette, monkeypatch, documentcloud, job_id="first")
+    [(source_id,)] = await rows(datasette, "select id from page_parsed")
+
+    def parses(model):
+        return sum(
+            1 for model_id, schema, _ in datasette.prompts
+            if model_id == model and schema == "Form460ScheduleA"
+        )
+
+    # Parsed by another model, the copy isn't reused
+    documentcloud.documents = {2: documents[2]}
+    await run_sync(datasette, monkeypatch, documentcloud, job_id="second", parser_model="m3")
+    assert parses("m3") == 1
+
+    await run_sync(datasette, monkeypatch, documentcloud, job_id="third")
+    assert parses("m2") == 1
+    assert await rows(datasette, """
+        select p.document_id, p.page_number, pp.model, pp.reused_from
+        from page_parsed pp join pages p on p.id = pp.page_id
+        order by pp.id
+    """) == [(1, 1, "m2", None), (2, 2, "m3", None), (2, 2, "m2", source_id)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("invalid_batches", [False, True])
+async def test_schedule_a_pages_are_parsed_in_batches(datasette, monkeypatch, invalid_batches):
+    monkeypatch.setattr(FakeModel, "invalid_batches", invalid_batches)
+    documentcloud = FakeDocumentCloud({
+        # Four Schedule A pages: a full batch of three, and one flushed
+        # when the document has been classified
+        1: [
+            "cover_page", "campaign_disclosure_summary_page", "schedule_a",
+            "schedule_a_continuation", "schedule_a_continuation", "schedule_e_payments_made",
+            "schedule_a",
+        ],
+        # A batch of two
+        2: ["schedule_a", "schedule_a_continuation"],
+    })
+    await run_sync(
+        datasette, monkeypatch, documentcloud,
+        schedule_a_batch_size={"m2": 3}, max_concurrent_pages=2,
+    )
+    parsed = await rows(datasette, """
+        select p.document_id, p.page_number, count(pp.id)
+        from pages p
+        join page_type_predictions ptp on ptp.page_id = p.id
+        left join page_parsed pp on pp.page_id = p.id and pp.page_type = 'schedule_a'
+        where ptp.predicted_page_type in ('schedule_a', 'schedule_a_continuation')
+        group by p.id order by p.id
+    """)
+    assert parsed == [(1, 3, 1), (1, 4, 1), (1, 5, 1), (1, 7, 1), (2, 1, 1), (2, 2, 1)]
+    assert await rows(datasette, "select count(*) from page_failures") == [(0,)]
+
+    batch_sizes = sorted(
+        size for _, schema, size in datasette.prompts if schema == "Form460ScheduleAPages"
+    )
+    single_pages = sum(1 for _, schema, _ in datasette.prompts if schema == "Form460ScheduleA")
+    stored_batch_sizes = await rows(datasette, """
+        select json_extract(timing, '$.batch_size') as size, count(*) from page_parsed
+        where page_type = 'schedule_a' group by size order by size
+    """)
+    if invalid_batches:
+        # Every batch is parsed again a page at a time
+        assert single_pages == 6
+        assert stored_batch_sizes == [(None, 6)]
+    else:
+        assert (batch_sizes, single_pages) == ([2, 3], 1)
+        assert stored_batch_sizes == [(None, 1), (2, 2), (3, 3)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("failures", [1, 2])
+async def test_failed_pages_are_retried_once(datasette, monkeypatch, failures):
+    documentcloud = FakeDocumentCloud({1: ["schedule_a", "schedule_a"], 2: ["schedule_a"]})
+    parse_schedule_a_page = sync.parse_schedule_a_page
+    attempts = []
+
+    async def flaky_parse(ctx, page_id, document, page_number, parser_model):
+        if (document.id, page_number) == (1, 2):
+            attempts.append(page_number)
+            if len(attempts) <= failures:
+                raise ValueError("unreadable page")
+        await parse_schedule_a_page(ctx, page_id, document, page_number, parser_model)
+
+    monkeypatch.setattr(sync, "parse_schedule_a_page", flaky_parse)
+    await run_sync(datasette, monkeypatch, documentcloud)
+
+    # Each failure is recorded, and the page tried once more at the end
+    assert len(attempts) == 2
+    assert await rows(datasette, """
+        select p.document_id, p.page_number, f.stage, f.model, f.error
+        from page_failures f join pages p on p.id = f.page_id
+    """) == [(1, 2, "parse", "m2", "unreadable page")] * failures
+    parsed = await rows(datasette, "select count(*) from page_parsed")
+    work_units = await rows(
+        datasette, "select document_id, status from sync_work_units order by document_id"
+    )
+    synced = await rows(datasette, "select document_id from document_syncs order by document_id")
+    if failures == 1:
+        assert (parsed, work_units, synced) == ([(3,)], [(1, "done"), (2, "done")], [(1,), (2,)])
+    else:
+        # Left for the next sync
+        assert (parsed, work_units, synced) == ([(2,)], [(1, "pending"), (2, "done")], [(2,)])
+        assert await rows(
+            datasette, "select message from sync_events where message like '%failed twice%'"
+        ) == [("1 pages in 1 documents failed twice, and will be retried by the next sync",)]
+
+
+@pytest.mark.asyncio
+async def test_unchanged_documents_are_not_synced_again(datasette, monkeypatch):
+    documentcloud = FakeDocumentCloud({
+        1: ["cover_page", "campaign_disclosure_summary_page", "schedule_a"],
+        2: ["schedule_a_continuation", "schedule_e_payments_made"],
+    })
+    await run_sync(datasette, monkeypatch, documentcloud, job_id="first")
+    assert len(datasette.prompts) == 8
+    parsed = await rows(datasette, "select page_id, page_type from page_parsed order by 1")
+
+    datasette.prompts.clear()
+    documentcloud.image_requests.clear()
+    await run_sync(datasette, monkeypatch, documentcloud, job_id="second")
+    assert (datasette.prompts, documentcloud.image_requests) == ([], [])
+    assert await rows(
+        datasette, "select message from sync_events where sync_job_id = 'second' and message like 'Skipping%'"
+    ) == [("Skipping 2 unchanged documents",)]
+
+    # Without the incremental skip, the plan for each document finds
+    # nothing left to do
+    await run_sync(datasette, monkeypatch, documentcloud, job_id="third", incremental=False)
+    assert (datasette.prompts, documentcloud.image_requests) == ([], [])
+    assert await rows(datasette, "select page_id, page_type from page_parsed order by 1") == parsed
+    assert await rows(
+        datasette, "select status from sync_work_units where sync_job_id = 'third'"
+    ) == [("done",), ("done",)]
+
+
+@pytest.mark.asyncio
+async def test_model_concurrency_is_capped_across_jobs(datasette, monkeypatch):
+    documentcloud = FakeDocumentCloud({
+        1: ["cover_page", "campaign_disclosure_summary_page", "schedule_a", "schedule_a"],
+        2: ["schedule_a_continuation", "schedule_e_payments_made", "schedule_a"],
+    })
+    # Two jobs at once, parsing with different models
+    await asyncio.gather(
+        run_sync(datasette, monkeypatch, documentcloud, job_id="first", model_concurrency={"m1": 2}),
+        run_sync(
+            datasette, monkeypatch, documentcloud, job_id="second", parser_model="m3",
+            model_concurrency={"m1": 2},
+        ),
+    )
+    assert datasette.prompts.peak_in_flight["m1"] == 2
+    assert datasette.prompts.peak_in_flight["m2"] <= 4
+    assert await rows(
+        datasette, "select sync_job_id, count(*) from sync_work_units where status = 'done' group by 1"
+    ) == [("first", 2), ("second", 2)]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_sync_logs_events_in_sequential_order(datasette, tmp_path, monkeypatch):
+    documentcloud = FakeDocumentCloud({
+        1: ["cover_page", "campaign_disclosure_summary_page", "schedule_a", "schedule_a"],
+        2: ["schedule_a_continuation", "schedule_e_payments_made", "schedule_a"],
+        3: ["schedule_a", "cover_page"],
+    })
+    await run_sync(datasette, monkeypatch, documentcloud)
+    assert datasette.prompts.peak_in_flight["m1"] > 1
+
+    sequential = make_datasette(tmp_path / "sequential", datasette.prompts)
+    await run_sync(sequential, monkeypatch, documentcloud, max_concurrent_pages=1)
+    concurrent_events, sequential_events = await events(datasette), await events(sequential)
+
+    # Pages are parsed as soon as they are classified, so parses are logged
+    # as they finish. Every other event is in the same order.
+    def split(messages):
+        parses = [message for message in messages if message.startswith("Parsed ") and " from document " in message]
+        return [message for message in messages if message not in parses], sorted(parses)
+
+    assert split(concurrent_events) == split(sequential_events)
@@ -0,0 +1,25 @@
+from datasette.app import Datasette
+from datasette_ca460.writer import BatchWriter
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_batch_writer_flushes_in_order():
+    datasette = Datasette()
+    db = datasette.add_memory_database("test_batch_writer")
+    await db.execute_write("create table t (id integer primary key, value text)")
+    await db.execute_write("create table u (id integer primary key, value text)")
+
+    async with BatchWriter(db, max_rows=3, max_delay=60) as writer:
+        await writer.write("insert into t (value) values (?)", ("a",))
+        await writer.write("insert into u (value) values (?)", ("b",))
+        assert (await db.execute("select count(*) from t")).single_value() == 0
+        # Reaching max_rows flushes everything pending in one transaction
+        await writer.write("insert into t (value) values (?)", ("c",))
+        assert writer.flushes == 1
+        assert [r[0] for r in (await db.execute("select value from t order by id")).rows] == ["a", "c"]
+        await writer.write("insert into u (value) values (?)", ("d",))
+
+    # Remaining rows are flushed on exit
+    assert writer.flushes == 2
+    assert [r[0] for r in (await db.execute("select value from u order by id")).rows] == ["b", "d"]